@@ -0,0 +1,26 @@
+"""
+Rebuilds the aggregates that ingest_articles maintains incrementally.
+
+Needed after articles were written without them, e.g. before config.MAINTAIN_AGGREGATES was set
+or by the per-article write methods, and to repair counts after articles were deleted:
+
+    python aggregates.py --batch-size 500
+"""
+import argparse
+import time
+
+from graph import NewsGraphClient
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rebuild the mention-count and co-mention aggregates')
+    parser.add_argument('--batch-size', type=int, default=500, help='articles aggregated per transaction')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    num_articles = NewsGraphClient().rebuild_aggregates(batch_size=args.batch_size)
+    print(f"Aggregated {num_articles} articles in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,265 @@
+import json
+import threading
+from collections.abc import Iterable
+from datetime import date, datetime
+from pathlib import Path
+
+import numpy as np
+
+import config
+from quantization import dequantize, quantize
+from schema import ArticleChunk, ArticleChunkCategory
+
+
+NO_DATE = np.iinfo(np.int64).min  # days since epoch of chunks without publishing date
+NO_SOURCE = -1
+CATEGORIES = list(ArticleChunkCategory)
+
+
+class ChunkIndex:
+    """
+    ChunkIndex is an in-process IVF index for approximate nearest neighbour search over chunk embeddings.
+
+    Embeddings are L2-normalised, so scores are cosine similarities. They are stored as float32,
+    float16 or int8 and the vectors of a saved index are memory-mapped, chunks added afterwards
+    are kept in memory until the next save.
+    Metadata filters (category, publishing date, source) are applied before any scoring.
+    """
+    def __init__(self, dim: int = config.EMBEDDING_SIZE, centroids: np.ndarray | None = None,
+                 dtype: str = config.EMBEDDING_STORAGE_DTYPE):
+        self.dim = dim
+        self.dtype = dtype
+        self.centroids = centroids
+        self.sources: list[str] = []
+        self._source_codes: dict[str, int] = {}
+        self._segments: list[dict[str, np.ndarray]] = []
+        self._pending: list[dict] = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return sum(len(segment['uids']) for segment in self._segments) + len(self._pending)
+
+    def add_chunks(self, chunks: Iterable[ArticleChunk], publishing_date: date | None = None, source: str | None = None):
+        """Adds the chunks of one article"""
+        self.add(
+            (chunk.uid, chunk.embedding, chunk.category, publishing_date, source)
+            for chunk in chunks
+        )
+
+    def add(self, rows: Iterable[tuple]):
+        """Adds (uid, embedding, category, publishing date, source) rows"""
+        with self._lock:
+            for uid, embedding, category, publishing_date, source in rows:
+                self._pending.append({
+                    'uid': uid,
+                    'embedding': _normalize(np.asarray(embedding, dtype=np.float32)),
+                    'category': _category_code(category),
+                    'day': _to_day(publishing_date),
+                    'source': self._source_code(source),
+                })
+
+    def search(self, query_embedding: np.ndarray, k: int = 10, categories: Iterable[str] | None = None,
+               date_from: date | None = None, date_to: date | None = None, sources: Iterable[str] | None = None,
+               n_probe: int = config.CHUNK_INDEX_N_PROBE) -> list[tuple[str, float]]:
+        """Returns the uids and cosine similarities of the k most similar chunks that pass the filters"""
+        query = _normalize(np.asarray(query_embedding, dtype=np.float32))
+        with self._lock:
+            self._flush_pending()
+            segments = list(self._segments)
+        probed_lists = None
+        if self.centroids is not None:
+            centroid_scores = self.centroids @ query
+            probed_lists = np.argpartition(-centroid_scores, min(n_probe, len(centroid_scores)) - 1)[:n_probe]
+
+        category_codes = None if categories is None else [_category_code(c) for c in categories]
+        source_codes = None if sources is None else [self._source_codes.get(s, NO_SOURCE - 1) for s in sources]
+        results = []
+        for segment in segments:
+            mask = np.ones(len(segment['uids']), dtype=bool)
+            if probed_lists is not None:
+                mask &= np.isin(segment['lists'], probed_lists)
+            if category_codes is not None:
+                mask &= np.isin(segment['categories'], category_codes)
+            if source_codes is not None:
+                mask &= np.isin(segment['sources'], source_codes)
+            if date_from is not None:
+                mask &= segment['days'] >= _to_day(date_from)
+            if date_to is not None:
+                mask &= (segment['days'] <= _to_day(date_to)) & (segment['days'] != NO_DATE)
+            rows = np.flatnonzero(mask)
+            if not len(rows):
+                continue
+            scores = _vectors(segment, rows) @ query
+            top = np.argpartition(-scores, min(k, len(scores)) - 1)[:k]
+            results.extend((str(segment['uids'][rows[i]]), float(scores[i])) for i in top)
+        return sorted(results, key=lambda result: result[1], reverse=True)[:k]
+
+    def train(self, n_lists: int | None = None, sample_size: int = 50_000, iterations: int = 10, seed: int = 0):
+        """Learns the coarse quantizer with k-means on a sample of the indexed embeddings"""
+        with self._lock:
+            self._flush_pending(assign=False)
+            total = len(self)
+            if not total:
+                return
+            n_lists = n_lists or max(1, int(np.sqrt(total)))
+            rng = np.random.default_rng(seed)
+            # Every segment contributes to the sample in proportion to its size
+            sample_parts = []
+            for segment in self._segments:
+                segment_size = len(segment['uids'])
+                part_size = min(segment_size, sample_size * segment_size // total + 1)
+                rows = np.sort(rng.choice(segment_size, size=part_size, replace=False))
+                sample_parts.append(_vectors(segment, rows))
+            sample = np.concatenate(sample_parts)
+            centroids = sample[rng.choice(len(sample), size=min(n_lists, len(sample)), replace=False)]
+            for _ in range(iterations):
+                assignments = np.argmax(sample @ centroids.T, axis=1)
+                for i in range(len(centroids)):
+                    members = sample[assignments == i]
+                    if len(members):
+                        centroids[i] = _normalize(members.mean(axis=0))
+            self.centroids = centroids
+            for segment in self._segments:
+                segment['lists'] = self._assign(segment)
+
+    def save(self, directory: str | Path):
+        """Writes all chunks to directory, the embeddings as a raw matrix for memory-mapping"""
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        with self._lock:
+            self._flush_pending()
+            tmp_path = directory / f'embeddings.{self.dtype}.tmp'
+            with open(tmp_path, 'wb') as f:
+                for segment in self._segments:
+                    for batch_start in range(0, len(segment['uids']), 10_000):
+                        f.write(np.ascontiguousarray(segment['embeddings'][batch_start:batch_start + 10_000]).tobytes())
+            tmp_path.replace(directory / f'embeddings.{self.dtype}')
+            names = ['uids', 'categories', 'days', 'sources', 'lists'] + (['scales'] if self.dtype == 'int8' else [])
+            metadata = {
+                name: np.concatenate([segment[name] for segment in self._segments])
+                for name in names
+            } if self._segments else {}
+            np.savez(directory / 'metadata.npz', **metadata)
+            if self.centroids is not None:
+                np.save(directory / 'centroids.npy', self.centroids)
+            (directory / 'sources.json').write_text(
+                json.dumps({'dim': self.dim, 'dtype': self.dtype, 'sources': self.sources})
+            )
+            # Swapped while still locked, so that no segment is flushed in between and lost
+            self._segments = self.load(directory)._segments
+
+    @classmethod
+    def load(cls, directory: str | Path) -> 'ChunkIndex':
+        directory = Path(directory)
+        info = json.loads((directory / 'sources.json').read_text())
+        centroids_path = directory / 'centroids.npy'
+        index = cls(
+            dim=info['dim'], centroids=np.load(centroids_path) if centroids_path.exists() else None, dtype=info['dtype']
+        )
+        index.sources = info['sources']
+        index._source_codes = {source: code for code, source in enumerate(index.sources)}
+        metadata = dict(np.load(directory / 'metadata.npz'))
+        if metadata:
+            embeddings = np.memmap(directory / f'embeddings.{index.dtype}', dtype=index.dtype, mode='r',
+                                   shape=(len(metadata['uids']), index.dim))
+            index._segments.append({'embeddings': embeddings, **metadata})
+        return index
+
+    @classmethod
+    def build_from_graph(cls, db, directory: str | Path, n_lists: int | None = None,
+                         dtype: str = config.EMBEDDING_STORAGE_DTYPE) -> 'ChunkIndex':
+        """
+        Exports the chunk embeddings of the graph to directory, then trains and saves the index.
+
+        db can also be a snapshot.Snapshot, to build the index without a database.
+        """
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        index = cls(dtype=dtype)
+        metadata = {'uids': [], 'categories': [], 'days': [], 'sources': [], 'scales': []}
+        # Embeddings are streamed to disk page by page, only the metadata is kept in memory
+        with open(directory / f'embeddings.{dtype}', 'wb') as f:
+            for records in db.iter_chunk_embeddings():
+                codes, scales = quantize(_normalize(np.asarray([r['embedding'] for r in records], dtype=np.float32)), dtype)
+                f.write(codes.tobytes())
+                if scales is not None:
+                    metadata['scales'].extend(scales)
+                metadata['uids'].extend(r['uid'] for r in records)
+                metadata['categories'].extend(_category_code(r['category']) for r in records)
+                metadata['days'].extend(_to_day(r['publishing_date']) for r in records)
+                metadata['sources'].extend(index._source_code(r['source']) for r in records)
+        np.savez(
+            directory / 'metadata.npz',
+            uids=np.array(metadata['uids']),
+            categories=np.array(metadata['categories'], dtype=np.int8),
+            days=np.array(metadata['days'], dtype=np.int64),
+            sources=np.array(metadata['sources'], dtype=np.int32),
+            lists=np.zeros(len(metadata['uids']), dtype=np.int32),
+            **({'scales': np.array(metadata['scales'], dtype=np.float32)} if dtype == 'int8' else {})
+        )
+        (directory / 'sources.json').write_text(json.dumps({'dim': index.dim, 'dtype': dtype, 'sources': index.sources}))
+        index = cls.load(directory)
+        index.train(n_lists=n_lists)
+        index.save(directory)
+        return index
+
+    def _flush_pending(self, assign=True):
+        """Turns the pending chunks into an in-memory segment, must be called with the lock held"""
+        if not self._pending:
+            return
+        embeddings, scales = quantize(np.stack([row['embedding'] for row in self._pending]), self.dtype)
+        segment = {
+            'embeddings': embeddings,
+            'uids': np.array([row['uid'] for row in self._pending]),
+            'categories': np.array([row['category'] for row in self._pending], dtype=np.int8),
+            'days': np.array([row['day'] for row in self._pending], dtype=np.int64),
+            'sources': np.array([row['source'] for row in self._pending], dtype=np.int32),
+        }
+        if scales is not None:
+            segment['scales'] = scales
+        segment['lists'] = self._assign(segment) if assign else np.zeros(len(embeddings), dtype=np.int32)
+        self._segments.append(segment)
+        self._pending = []
+
+    def _assign(self, segment: dict[str, np.ndarray]) -> np.ndarray:
+        size = len(segment['uids'])
+        if self.centroids is None or not size:
+            return np.zeros(size, dtype=np.int32)
+        return np.concatenate([
+            np.argmax(_vectors(segment, np.arange(start, min(start + 10_000, size))) @ self.centroids.T, axis=1).astype(np.int32)
+            for start in range(0, size, 10_000)
+        ])
+
+    def _source_code(self, source: str | None) -> int:
+        if source is None:
+            return NO_SOURCE
+        if source not in self._source_codes:
+            self._source_codes[source] = len(self.sources)
+            self.sources.append(source)
+        return self._source_codes[source]
+
+
+def _vectors(segment: dict[str, np.ndarray], rows: np.ndarray) -> np.ndarray:
+    """Returns the given rows of a segment as float32 vectors"""
+    scales = segment.get('scales')
+    return dequantize(segment['embeddings'][rows], None if scales is None else scales[rows])
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+def _category_code(category: ArticleChunkCategory | str) -> int:
+    return CATEGORIES.index(ArticleChunkCategory(category))
+
+
+def _to_day(value) -> int:
+    """Days since epoch of a date, datetime or neo4j DateTime"""
+    if value is None:
+        return NO_DATE
+    if hasattr(value, 'to_native'):
+        value = value.to_native()
+    if isinstance(value, datetime):
+        value = value.date()
+    return int(np.datetime64(value, 'D').astype(np.int64))
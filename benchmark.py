@@ -0,0 +1,277 @@
+"""
+Offline benchmarks of chunking, embedding, NER, graph access and question answering.
+
+Models, Neo4j and Cortex are replaced by the stand-ins in fakes.py, so the numbers measure
+the code in this repository plus a realistic, fixed cost for the external services.
+Results can be stored as a baseline, later runs are compared against it:
+
+    python benchmark.py --articles 100 --save-baseline
+    python benchmark.py --articles 100  # exits with 1 if a benchmark regressed
+"""
+import argparse
+import json
+import sys
+import time
+from collections.abc import Callable, Iterable
+from pathlib import Path
+
+import numpy as np
+
+import config
+from fakes import (
+    CYPHER_QUERY, FakeEmbeddingModel, FakeGLiNER, FakeGraph, FakeTokenizer, StubLLM, load_corpus, make_corpus
+)
+
+
+BASELINE_PATH = 'benchmark_baseline.json'
+DEFAULT_TOLERANCE = 0.2  # allowed relative loss of throughput or gain of p90 latency
+QUESTIONS = [
+    'What do the news have to say about Olaf Scholz?',
+    'How many sources mention the EU-Kommission?',
+    'List 5 article titles about Volt',
+    'What did Emmanuel Macron say in Paris?',
+    'Which articles mention Ursula von der Leyen and the NATO?',
+]
+
+
+def measure(func: Callable, items: Iterable, unit: str, count: Callable = lambda item: 1) -> dict:
+    """Calls func once per item and returns the throughput in units per second and latency percentiles"""
+    latencies, units = [], 0
+    start = time.perf_counter()
+    for item in items:
+        call_start = time.perf_counter()
+        func(item)
+        latencies.append(time.perf_counter() - call_start)
+        units += count(item)
+    total_seconds = time.perf_counter() - start
+    p50, p90, p99 = np.percentile(np.array(latencies) * 1000, [50, 90, 99]) if latencies else (0, 0, 0)
+    return {
+        'unit': unit,
+        'throughput': units / total_seconds if total_seconds else 0.0,
+        'calls': len(latencies),
+        'p50_ms': float(p50),
+        'p90_ms': float(p90),
+        'p99_ms': float(p99),
+    }
+
+
+def bench_chunking(corpus) -> dict[str, dict]:
+    from crawler import get_chunks_from_article_body
+    from embedding import count_tokens
+    from utils import chunk_by_tokens, split_into_combined_sentence_chunks
+
+    plaintexts = [article.plaintext for article in corpus]
+    return {
+        'chunk_article_body': measure(get_chunks_from_article_body, corpus, 'articles/s'),
+        'split_into_combined_sentence_chunks': measure(split_into_combined_sentence_chunks, plaintexts, 'articles/s'),
+        'chunk_by_tokens': measure(
+            lambda text: list(chunk_by_tokens(text, count_tokens, config.CHUNK_MAX_TOKENS)), plaintexts, 'articles/s'
+        ),
+    }
+
+
+def bench_embedding(corpus) -> dict[str, dict]:
+    import embedding
+    from crawler import get_chunks_from_article_body
+    from utils import batched
+
+    embedding.get_embedding_model.override(FakeEmbeddingModel())
+    embedding.get_embedding_cache.override(None)
+    texts_per_article = [[chunk.text for chunk in get_chunks_from_article_body(article)] for article in corpus]
+    texts_per_window = [
+        [text for texts in window for text in texts]
+        for window in batched(texts_per_article, config.EMBEDDING_ARTICLES_PER_BATCH)
+    ]
+    return {
+        'embed_sentences': measure(lambda texts: embedding.embed_sentences(*texts), texts_per_article, 'chunks/s', len),
+        'embed_sentences_across_articles': measure(
+            lambda texts: embedding.embed_sentences(*texts), texts_per_window, 'chunks/s', len
+        ),
+    }
+
+
+def bench_ner(corpus) -> dict[str, dict]:
+    from crawler import get_chunks_from_article_body
+    from ner import EntityFinder
+
+    entity_finder = EntityFinder(labels=config.RELEVANT_LABELS, model=FakeGLiNER())
+    texts_per_article = [[chunk.text for chunk in get_chunks_from_article_body(article)] for article in corpus]
+    return {
+        'entity_finder_find': measure(lambda texts: entity_finder.find(*texts), texts_per_article, 'chunks/s', len),
+        'entity_finder_find_batched': measure(entity_finder.find_batched, texts_per_article, 'chunks/s', len),
+    }
+
+
+def bench_graph(corpus, batch_size: int = config.INGEST_BATCH_SIZE) -> dict[str, dict]:
+    import embedding
+    from crawler import create_processed_article, embed_chunks, find_mentioned_entities_in_articles
+    from graph import NewsGraphClient
+    from ner import EntityFinder
+    from utils import batched
+
+    embedding.get_embedding_model.override(FakeEmbeddingModel(call_seconds=0, token_seconds=0))
+    embedding.get_embedding_cache.override(None)
+    entity_finder = EntityFinder(labels=config.RELEVANT_LABELS, model=FakeGLiNER(call_seconds=0, token_seconds=0))
+    processed_articles = [create_processed_article(article) for article in corpus]
+    for processed_article in processed_articles:
+        embed_chunks(processed_article.chunks)
+    find_mentioned_entities_in_articles(processed_articles, entity_finder)
+    db = NewsGraphClient(graph=FakeGraph(), schema_cache_path=None)
+
+    def write_article(pair):
+        article, processed_article = pair
+        article_id = db.create_article(article)
+        db.merge_article_chunks(processed_article.chunks, article_id, article.publishing_date,
+                                article.html.source_info.publisher)
+        db.merge_article_source(article.html.source_info, article_id)
+        db.merge_article_authors(processed_article.authors, article_id)
+        db.merge_mentioned_entities(processed_article.mentioned_entities)
+
+    def lookup(entities):
+        db._candidate_cache.clear()
+        db.lookup_mentioned_entities(entities)
+
+    entities_per_article = [
+        list({mention['entity'] for mention in processed_article.mentioned_entities})
+        for processed_article in processed_articles
+    ]
+    return {
+        'write_per_article': measure(write_article, zip(corpus, processed_articles), 'articles/s'),
+        'ingest_articles': measure(
+            lambda batch: db.ingest_articles(batch, batch_size=batch_size),
+            batched(processed_articles, batch_size), 'articles/s', len
+        ),
+        'lookup_mentioned_entities': measure(lookup, entities_per_article, 'lookups/s'),
+        'get_schema': measure(lambda _: db.get_schema(refresh=True), range(20), 'calls/s'),
+    }
+
+
+def bench_end_to_end(corpus) -> dict[str, dict]:
+    import chat
+    import embedding
+    from cache import CypherQueryCache
+    from graph import NewsGraphClient
+    from ner import EntityFinder
+
+    embedding.get_embedding_model.override(FakeEmbeddingModel())
+    embedding.get_embedding_cache.override(None)
+    chat.get_model.override(StubLLM())
+    chat.get_db.override(NewsGraphClient(graph=FakeGraph(), schema_cache_path=None))
+    chat.get_entity_finder.override(EntityFinder(labels=config.RELEVANT_LABELS, model=FakeGLiNER()))
+    query_cache = CypherQueryCache(path=None)
+    chat.get_query_cache.override(query_cache)
+    time_to_first_token = []
+
+    def generate(question):
+        query_cache.clear()
+        chat.generate_cypher_query(question)
+
+    def ask(question, mode='cypher'):
+        # Every question is answered from scratch, the query cache is measured separately
+        query_cache.clear()
+        timings = {}
+        for _ in chat.ask_question_stream(question, timings, mode=mode):
+            pass
+        time_to_first_token.append(timings['time_to_first_token'])
+
+    def ask_hybrid(question):
+        chat.get_question_embedding_cache().clear()
+        ask(question, mode='hybrid')
+
+    results = {
+        'generate_cypher_query': measure(generate, QUESTIONS, 'questions/s'),
+        'generate_cypher_query_cached': measure(chat.generate_cypher_query, QUESTIONS, 'questions/s'),
+        'answer_question': measure(
+            lambda question: chat.answer_question(question, CYPHER_QUERY), QUESTIONS, 'questions/s'
+        ),
+        'ask_question_stream': measure(ask, QUESTIONS, 'questions/s'),
+    }
+    results['ask_question_stream']['time_to_first_token_p50_ms'] = float(np.percentile(time_to_first_token, 50) * 1000)
+    time_to_first_token.clear()
+    results['ask_question_stream_hybrid'] = measure(ask_hybrid, QUESTIONS, 'questions/s')
+    results['ask_question_stream_hybrid']['time_to_first_token_p50_ms'] = float(
+        np.percentile(time_to_first_token, 50) * 1000
+    )
+    return results
+
+
+BENCHMARKS = {
+    'chunking': bench_chunking,
+    'embedding': bench_embedding,
+    'ner': bench_ner,
+    'graph': bench_graph,
+    'end_to_end': bench_end_to_end,
+}
+
+
+def run(names: Iterable[str], num_articles: int, seed: int = 0, snapshot: str | None = None) -> dict[str, dict]:
+    import embedding
+
+    corpus = load_corpus(snapshot, num_articles) if snapshot else make_corpus(num_articles, seed=seed)
+    # Chunking counts tokens with the tokenizer of the embedding model
+    embedding.get_tokenizer.override(FakeTokenizer())
+    results = {}
+    for name in names:
+        try:
+            results.update(BENCHMARKS[name](corpus))
+        except ImportError as e:
+            print(f"Skipped {name}: {e}", file=sys.stderr)
+    return results
+
+
+def compare(results: dict[str, dict], baseline: dict[str, dict], tolerance: float = DEFAULT_TOLERANCE) -> list[str]:
+    """Returns a description of every benchmark that got slower than the baseline by more than tolerance"""
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        base = baseline[name]
+        if result['throughput'] < base['throughput'] * (1 - tolerance):
+            regressions.append(
+                f"{name}: throughput {result['throughput']:.1f} {result['unit']}, baseline {base['throughput']:.1f}"
+            )
+        if result['p90_ms'] > base['p90_ms'] * (1 + tolerance):
+            regressions.append(f"{name}: p90 latency {result['p90_ms']:.1f} ms, baseline {base['p90_ms']:.1f} ms")
+    return regressions
+
+
+def format_results(results: dict[str, dict]) -> str:
+    lines = [f"{'benchmark':<38}{'throughput':>20}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}"]
+    lines.extend(
+        f"{name:<38}{result['throughput']:>9.1f} {result['unit']:<10}"
+        f"{result['p50_ms']:>10.2f}{result['p90_ms']:>10.2f}{result['p99_ms']:>10.2f}"
+        for name, result in results.items()
+    )
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--articles', type=int, default=50, help='size of the synthetic corpus')
+    parser.add_argument('--only', nargs='+', choices=list(BENCHMARKS), default=list(BENCHMARKS))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--snapshot', help='read the corpus from this snapshot directory instead of generating it')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--baseline', default=BASELINE_PATH, help='results of an earlier run to compare against')
+    parser.add_argument('--save-baseline', action='store_true', help='store the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE)
+    args = parser.parse_args()
+
+    results = run(args.only, args.articles, seed=args.seed, snapshot=args.snapshot)
+    print(format_results(results))
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2))
+    if args.save_baseline:
+        Path(args.baseline).write_text(json.dumps(results, indent=2))
+        print(f"Saved baseline to {args.baseline}")
+        return
+    if Path(args.baseline).exists():
+        regressions = compare(results, json.loads(Path(args.baseline).read_text()), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from hashlib import sha256
+from pathlib import Path
+
+import config
+from schema import GraphSchema
+
+
+_MISSING = object()
+
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries expire ttl seconds after they were set"""
+    def __init__(self, max_size: int = 1024, ttl: float | None = 3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            expires_at, value = self._entries.get(key, (None, _MISSING))
+            if value is not _MISSING and expires_at is not None and expires_at < time.time():
+                del self._entries[key]
+                value = _MISSING
+            if value is _MISSING:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        expires_at = time.time() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict[str, int]:
+        return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class CypherQueryCache(TTLCache):
+    """
+    Cache of generated Cypher queries keyed by the normalised question and its entity candidates.
+
+    All entries belong to one graph schema and are dropped as soon as a different schema is seen.
+    If a path is given, the cache is loaded from and written through to a JSON file.
+    """
+    def __init__(self, path: str | Path | None = None, max_size: int = config.CYPHER_CACHE_SIZE,
+                 ttl: float | None = config.CYPHER_CACHE_TTL):
+        super().__init__(max_size=max_size, ttl=ttl)
+        self.path = Path(path) if path else None
+        self.schema_fingerprint = None
+        if self.path and self.path.exists():
+            self._load()
+
+    @staticmethod
+    def make_key(question: str, candidates: list[dict[str, str]]) -> str:
+        candidate_keys = sorted({f"{c['label']}:{c['name']}" for c in candidates})
+        return normalize_question(question) + '|' + ';'.join(candidate_keys)
+
+    def validate_schema(self, schema: GraphSchema):
+        """Clears the cache if it was filled for a different schema"""
+        # Only the structure counts, node counts change with every ingest and do not affect queries
+        structure = {
+            'nodes': {label: sorted(properties) for label, properties in sorted(schema.node_properties.items())},
+            'relationships': sorted(map(list, schema.relationships)),
+            'relationship_properties': {
+                rel_type: sorted(properties) for rel_type, properties in sorted(schema.relationship_properties.items())
+            },
+        }
+        fingerprint = sha256(json.dumps(structure).encode('utf-8')).hexdigest()
+        if fingerprint != self.schema_fingerprint:
+            self.clear()
+            self.schema_fingerprint = fingerprint
+            self._save()
+
+    def set(self, key, value):
+        super().set(key, value)
+        self._save()
+
+    def _load(self):
+        data = json.loads(self.path.read_text())
+        self.schema_fingerprint = data['schema_fingerprint']
+        now = time.time()
+        with self._lock:
+            for key, expires_at, value in data['entries']:
+                if expires_at is None or expires_at >= now:
+                    self._entries[key] = (expires_at, value)
+
+    def _save(self):
+        if self.path is None:
+            return
+        with self._lock:
+            data = {
+                'schema_fingerprint': self.schema_fingerprint,
+                'entries': [[key, expires_at, value] for key, (expires_at, value) in self._entries.items()]
+            }
+        # Write to a temporary file first, so that readers never see a partial file
+        tmp_path = self.path.with_suffix('.tmp')
+        tmp_path.write_text(json.dumps(data))
+        os.replace(tmp_path, self.path)
+
+
+def normalize_question(question: str) -> str:
+    """Lower-cases a question and removes punctuation and extra whitespace, for use in cache keys"""
+    return ' '.join(re.sub(r'[^\w\s]', ' ', question.casefold()).split())
@@ -1,17 +1,76 @@
+import json
+import logging
+import time
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from itertools import islice
+
+import numpy as np
+
 import snowflake.connector
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import ChatPromptTemplate
 
 
 import config
+import utils
+from cache import CypherQueryCache, TTLCache, normalize_question
+from context_builder import build_context
+from embedding import embed_sentences, get_embedding_model
 from llm import Cortex
-from ner import EntityFinder
+from metrics import metrics
+from ner import get_entity_finder
 from graph import NewsGraphClient
+from query_guard import guard_query
+from retrieval import Ranking, RetrievalResult, retrieve
+from utils import lazy_singleton
+
+logger = logging.getLogger(__name__)
+
+
+@lazy_singleton
+def get_model() -> Cortex:
+    snowflake_connection = snowflake.connector.connect(**config.SNOWFLAKE_CONNECTION_PARAMS)
+    return Cortex(
+        connection=snowflake_connection,
+        connection_params=config.SNOWFLAKE_CONNECTION_PARAMS,
+        model=config.CHAT_MODEL
+    )
+
+
+@lazy_singleton
+def get_db() -> NewsGraphClient:
+    return NewsGraphClient()
+
+
+@lazy_singleton
+def get_query_cache() -> CypherQueryCache:
+    return CypherQueryCache(config.CYPHER_CACHE_PATH)
+
+
+@lazy_singleton
+def get_executor() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=4, thread_name_prefix='chat')
+
+
+@lazy_singleton
+def get_retrieval_executor() -> ThreadPoolExecutor:
+    # Separate from get_executor, as the Cypher retriever waits for tasks that it submits there
+    return ThreadPoolExecutor(max_workers=config.RETRIEVAL_WORKERS, thread_name_prefix='retrieval')
 
-snowflake_connection = snowflake.connector.connect(**config.SNOWFLAKE_CONNECTION_PARAMS)
-model = Cortex(connection=snowflake_connection, model=config.CHAT_MODEL)
-entity_finder = EntityFinder(config.RELEVANT_LABELS)
-db = NewsGraphClient()
+
+@lazy_singleton
+def get_question_embedding_cache() -> TTLCache:
+    return TTLCache(max_size=config.QUESTION_EMBEDDING_CACHE_SIZE, ttl=None)
+
+
+def warm_up() -> dict[str, float]:
+    """Connects to Snowflake and Neo4j and loads the NER model, returns the load times in seconds"""
+    getters = [get_model, get_entity_finder, get_db]
+    if config.CHAT_RETRIEVAL_MODE == 'hybrid':
+        getters.append(get_embedding_model)
+    return utils.warm_up(*getters)
 
 
 CYPHER_GENERATION_TEMPLATE = """Based on the graph schema below, write a Cypher query that answers the user's question. 
@@ -33,6 +92,23 @@ Example 3: For the question "News about France and Macron?" and the entity list
 Question: {question}
 Cypher query:"""
 
+# Appended to the schema once entity resolution linked spelling variants to their canonical entity,
+# which is the only one in the entity list
+SAME_AS_HINT = """
+Spelling variants of an entity point to it with SAME_AS relationships and mentions can point to any variant,
+so match mentions of an entity with (c:Chunk)-[:MENTIONS]->()-[:SAME_AS*0..1]->(o), e.g.
+"MATCH (a:Article)-[:CONTAINS]->(c:Chunk)-[:MENTIONS]->()-[:SAME_AS*0..1]->(o:Person) WHERE o.name = 'Ursula von der Leyen' RETURN DISTINCT a.title LIMIT 10"
+"""
+
+# Appended to the schema, which is inserted into the prompt as a value, once the graph contains the aggregates maintained by ingest_articles
+AGGREGATES_HINT = """
+Prefer the precomputed aggregates over traversing articles and chunks, they are much faster:
+entities have mention_count, article_count and source_count properties, (:Source)-[:MENTIONS_ENTITY]->(entity) links sources to the entities they mention,
+(entity)-[:MENTIONED_ON {mention_count, article_count}]->(:Day {date}) counts mentions per day and (entity)-[:CO_MENTIONED {article_count}]->(entity) links entities mentioned in the same articles.
+For example, "How many sources mention the EU commission?" becomes "MATCH (o:Organization) WHERE o.name IN ['EU-Kommission'] RETURN sum(o.source_count)"
+and "Who is mentioned together with Olaf Scholz?" becomes "MATCH (p:Person)-[r:CO_MENTIONED]-(o) WHERE p.name = 'Olaf Scholz' RETURN o.name, r.article_count ORDER BY r.article_count DESC LIMIT 10"
+"""
+
 ANSWER_PROMPT_TEMPLATE = (
     "Answer the question below in appropriate detail, given the following context. "
     # "Think step by step before providing a detailed answer. "
@@ -43,12 +119,36 @@ ANSWER_PROMPT_TEMPLATE = (
     "Answer: "
 )
 
+HYBRID_ANSWER_PROMPT_TEMPLATE = (
+    "Answer the question below in appropriate detail, given the following context. "
+    "The context was retrieved from the database by the following query, "
+    "together with the article passages that are most similar to the question:\n\n"
+    "Query: {query}\n\n"
+    "Context:\n{context}\n\n"
+    "Question: {question}\n\n"
+    "Answer: "
+)
+
 
+@metrics.timed('generate_cypher_query')
 def generate_cypher_query(question: str) -> str:
+    metrics.increment('questions')
+    db = get_db()
+    # The schema does not depend on the question, so it is fetched while NER runs
+    schema_future = get_executor().submit(get_schema_prompt, db)
     # Get entities from text
-    mentioned_entities = entity_finder.find(question)
+    mentioned_entities = get_entity_finder().find(question)
     # Perform fulltext search
     candidates = db.lookup_mentioned_entities(mentioned_entities)
+    # Reuse the query generated earlier for the same question and entities
+    schema = schema_future.result()
+    query_cache = get_query_cache()
+    query_cache.validate_schema(db.get_schema())
+    cache_key = query_cache.make_key(question, candidates)
+    if (cached_query := query_cache.get(cache_key)) is not None:
+        metrics.increment('cypher_cache_hits')
+        return cached_query
+
     candidate_context = map_candidates_to_context(candidates)
     # Define prompt
     cypher_prompt = ChatPromptTemplate.from_messages([
@@ -56,30 +156,145 @@ def generate_cypher_query(question: str) -> str:
         ("human", CYPHER_GENERATION_TEMPLATE),
     ])
     # Define chain
-    cypher_chain = cypher_prompt | model | StrOutputParser()
+    cypher_chain = cypher_prompt | get_model() | StrOutputParser()
     # Generate Cypher query with found entities
     generated_query = cypher_chain.invoke({
         'question': question,
         'entities_list': candidate_context,
-        'schema': db.graph.schema
+        'schema': schema
     })
+    query_cache.set(cache_key, generated_query)
     return generated_query
 
 
+def get_schema_prompt(db: NewsGraphClient) -> str:
+    schema = db.get_schema()
+    hints = []
+    if 'SAME_AS' in schema.relationship_types:
+        hints.append(SAME_AS_HINT)
+    if 'CO_MENTIONED' in schema.relationship_types:
+        hints.append(AGGREGATES_HINT)
+    return '\n'.join([schema.to_prompt(), *hints])
+
+
 def answer_question(question: str, generated_query: str):
-    # Perform query
-    response = db.query(generated_query)
-    context = map_records_to_context(response)
-    # Define prompt and chain
-    answer_prompt = ChatPromptTemplate.from_template(ANSWER_PROMPT_TEMPLATE)
-    answer_chain = answer_prompt | model | StrOutputParser()
+    answer_chain, inputs, _ = prepare_answer(question, generated_query)
     # Populate context and generate answer
-    answer = answer_chain.invoke(
-        {'question': question, 'context': context, 'query': generated_query}
-    )
+    answer = answer_chain.invoke(inputs)
     return answer
 
 
+def stream_answer(question: str, generated_query: str) -> Iterator[str]:
+    """Like answer_question, but yields the answer piece by piece as the LLM generates it"""
+    answer_chain, inputs, _ = prepare_answer(question, generated_query)
+    yield from answer_chain.stream(inputs)
+
+
+def ask_question_stream(question: str, timings: dict[str, float] | None = None,
+                        mode: str = config.CHAT_RETRIEVAL_MODE) -> Iterator[str]:
+    """
+    Retrieves the context for a question, with the generated Cypher query or by hybrid retrieval, and streams the answer.
+
+    If a dict is given as timings, it is filled with the seconds until the query was generated
+    (or until hybrid retrieval finished), until the first answer token and until the whole answer was received.
+    """
+    if mode not in ('cypher', 'hybrid'):
+        raise ValueError(f"Unknown retrieval mode {mode}, use 'cypher' or 'hybrid'")
+    timings = {} if timings is None else timings
+    start = time.perf_counter()
+    if mode == 'hybrid':
+        answer_chain, inputs, _ = prepare_hybrid_answer(question)
+        timings['retrieval'] = time.perf_counter() - start
+    else:
+        generated_query = generate_cypher_query(question)
+        timings['query_generation'] = time.perf_counter() - start
+        answer_chain, inputs, _ = prepare_answer(question, generated_query)
+    for token in answer_chain.stream(inputs):
+        timings.setdefault('time_to_first_token', time.perf_counter() - start)
+        yield token
+    timings['total'] = time.perf_counter() - start
+    for name, seconds in timings.items():
+        metrics.observe('ask_question', seconds, phase=name)
+
+
+def prepare_answer(question: str, generated_query: str):
+    """Runs the generated query and returns the answer chain, its inputs and the context built from the records"""
+    db = get_db()
+    # Check the plan of the generated query and cap its result size, records are fetched as the context is built
+    limited_query = guard_query(db, generated_query)
+    with closing(db.iter_query(limited_query)) as records:
+        context = build_context(records)
+    metrics.increment('answer_context_records', context.records_used)
+    metrics.increment('answer_context_tokens', context.tokens)
+    if context.records_dropped or context.truncated_fields or context.has_more_records:
+        logger.info("Answer context was cut to fit the budget: %s", context.report())
+    # Define prompt and chain
+    answer_prompt = ChatPromptTemplate.from_template(ANSWER_PROMPT_TEMPLATE)
+    answer_chain = answer_prompt | get_model() | StrOutputParser()
+    inputs = {'question': question, 'context': context.text, 'query': limited_query}
+    return answer_chain, inputs, context
+
+
+def retrieve_hybrid(question: str, k: int = config.RETRIEVAL_TOP_K) -> tuple[RetrievalResult, dict[str, str]]:
+    """
+    Runs graph, vector and fulltext retrieval for a question concurrently and fuses their results.
+
+    Returns the fused result and a dict that holds the generated Cypher query once the graph retriever ran.
+    """
+    db = get_db()
+    generated = {}
+
+    def graph_retriever() -> Ranking:
+        generated['query'] = guard_query(db, generate_cypher_query(question))
+        # Closing the stream releases its session and records the query time right away
+        with closing(db.iter_query(generated['query'])) as stream:
+            records = list(islice(stream, k))
+        # Records of the generated query have no common id, equal records are the same result
+        return [(json.dumps(record, sort_keys=True, default=str), record) for record in records]
+
+    def vector_retriever() -> Ranking:
+        return chunk_ranking(db.vector_search_chunks(embed_question(question), k=k))
+
+    def fulltext_retriever() -> Ranking:
+        return chunk_ranking(db.fulltext_search_chunks(question, k=k))
+
+    retrievers = {'graph': graph_retriever, 'vector': vector_retriever, 'fulltext': fulltext_retriever}
+    result = retrieve(retrievers, get_retrieval_executor(), limit=config.ANSWER_MAX_RECORDS)
+    return result, generated
+
+
+def prepare_hybrid_answer(question: str):
+    """Like prepare_answer, but builds the context from the fused results of hybrid retrieval"""
+    result, generated = retrieve_hybrid(question)
+    context = build_context(result.records)
+    metrics.increment('answer_context_records', context.records_used)
+    metrics.increment('answer_context_tokens', context.tokens)
+    logger.info("Hybrid retrieval: %s results, %s seconds, failed: %s", result.counts, result.seconds, result.failed)
+    answer_prompt = ChatPromptTemplate.from_template(HYBRID_ANSWER_PROMPT_TEMPLATE)
+    answer_chain = answer_prompt | get_model() | StrOutputParser()
+    inputs = {'question': question, 'context': context.text, 'query': generated.get('query', 'none')}
+    return answer_chain, inputs, context
+
+
+def embed_question(question: str) -> np.ndarray:
+    """Embeds a question, repeated questions are answered from an in-process cache"""
+    cache = get_question_embedding_cache()
+    key = normalize_question(question)
+    embedding = cache.get(key)
+    if embedding is None:
+        embedding = embed_sentences(question)[0]
+        cache.set(key, embedding)
+    return embedding
+
+
+def chunk_ranking(chunks: list[dict]) -> Ranking:
+    """Keys chunk search results by chunk uid and drops the fields that are not useful as context"""
+    return [
+        (chunk['uid'], {key: value for key, value in chunk.items() if key not in ('uid', 'score')})
+        for chunk in chunks
+    ]
+
+
 # Helper functions to map retrieved values to context strings
 
 def map_candidates_to_context(candidates: list[dict[str, str]]) -> str:
@@ -91,11 +306,7 @@ def map_candidates_to_context(candidates: list[dict[str, str]]) -> str:
 
 
 def map_records_to_context(db_records: list[dict]) -> str:
-    context_str = (f"\n{'='*5}\n").join(
-        '/n'.join(f"{k}: {v}" for k, v in record.items())
-        for record in db_records
-    )
-    return context_str
+    return build_context(db_records).text
 
 
 if __name__ == "__main__":
@@ -107,9 +318,12 @@ if __name__ == "__main__":
     question = 'List 5 article titles about Volt'
     question = 'How many sources mention the EU parliament?'
     question = 'What do the news have to say about Olaf Scholz?'
-    # Generate query
-    generated_query = generate_cypher_query(question)
-    print(generated_query)
-    # Generate answer
-    answer = answer_question(question, generated_query)
-    print(answer)
\ No newline at end of file
+    print(warm_up())
+    # Generate query and stream the answer
+    timings = {}
+    for token in ask_question_stream(question, timings):
+        print(token, end='', flush=True)
+    print()
+    print(timings)
+    if metrics.enabled:
+        print(metrics.to_prometheus())
\ No newline at end of file
@@ -0,0 +1,100 @@
+import math
+import sqlite3
+import threading
+from collections.abc import Iterable
+from hashlib import blake2b
+from pathlib import Path
+
+import config
+from utils import batched
+
+
+class BloomFilter:
+    """A compact probabilistic set: no false negatives, false positives at about the given rate"""
+    def __init__(self, expected_items: int = config.CRAWL_BLOOM_EXPECTED_ITEMS,
+                 false_positive_rate: float = config.CRAWL_BLOOM_FALSE_POSITIVE_RATE):
+        self.num_bits = max(8, int(-expected_items * math.log(false_positive_rate) / math.log(2) ** 2))
+        self.num_hashes = max(1, round(self.num_bits / expected_items * math.log(2)))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+
+    def add(self, key: str):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key: str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+    def _positions(self, key: str):
+        # Double hashing: k positions from two 64-bit hashes
+        digest = blake2b(key.encode('utf-8'), digest_size=16).digest()
+        h1, h2 = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        return ((h1 + i * h2) % self.num_bits for i in range(self.num_hashes))
+
+
+class CrawlCheckpoint:
+    """
+    CrawlCheckpoint remembers the URLs and content hashes of ingested articles in a SQLite file.
+
+    A Bloom filter in front of the database answers most lookups of unseen articles
+    without touching the disk.
+    """
+    def __init__(self, path: str | Path = config.CRAWL_CHECKPOINT_PATH):
+        self.path = Path(path)
+        self.bloom = BloomFilter()
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS seen (url TEXT PRIMARY KEY, content_hash TEXT)"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS seen_content_hash ON seen (content_hash)")
+        for url, content_hash in self._connection.execute("SELECT url, content_hash FROM seen"):
+            self._add_to_bloom(url, content_hash)
+
+    def is_known(self, url: str, content_hash: str | None = None) -> bool:
+        """Whether an article with this URL or, if given, the same content was seen before"""
+        candidates = [('url', url)]
+        if content_hash is not None:
+            candidates.append(('content_hash', content_hash))
+        with self._lock:
+            for column, value in candidates:
+                if f"{column}:{value}" not in self.bloom:
+                    continue
+                # The Bloom filter may give false positives, the database has the final say
+                row = self._connection.execute(f"SELECT 1 FROM seen WHERE {column} = ? LIMIT 1", (value,)).fetchone()
+                if row is not None:
+                    return True
+        return False
+
+    def add_many(self, items: Iterable[tuple[str, str | None]]):
+        """Marks (url, content hash) pairs as seen"""
+        items = list(items)
+        with self._lock:
+            self._connection.executemany("INSERT OR IGNORE INTO seen (url, content_hash) VALUES (?, ?)", items)
+            self._connection.commit()
+            for url, content_hash in items:
+                self._add_to_bloom(url, content_hash)
+
+    def seed_from_urls(self, urls: Iterable[str]) -> int:
+        """Marks URLs, e.g. of the articles already in the graph, as seen and returns how many were given"""
+        num_urls = 0
+        for batch in batched(((url, None) for url in urls if url), 10_000):
+            self.add_many(batch)
+            num_urls += len(batch)
+        return num_urls
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute("SELECT count(*) FROM seen").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def _add_to_bloom(self, url: str, content_hash: str | None):
+        self.bloom.add(f"url:{url}")
+        if content_hash is not None:
+            self.bloom.add(f"content_hash:{content_hash}")
+
+
+def content_hash(*texts: str) -> str:
+    return blake2b('\0'.join(texts).encode('utf-8'), digest_size=16).hexdigest()
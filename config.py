@@ -6,6 +6,49 @@ UID_LEN = 12
 EMBEDDING_SIZE = 768
 EMBEDDING_MODEL_CHECKPOINT = 'jinaai/jina-embeddings-v2-base-de'
 EMBEDDING_MODEL_HASH = '5078d9924a7b3bdd9556928fcfc08b8de041bfc1'
+# Precision of embeddings in local stores (embedding cache, chunk index): float32, float16 or int8.
+# Neo4j vector properties are always written as float32.
+EMBEDDING_STORAGE_DTYPE = 'float16'
+# On-disk embedding cache, disabled if no directory is set
+EMBEDDING_CACHE_DIR = os.getenv('EMBEDDING_CACHE_DIR')
+EMBEDDING_CACHE_SIZE = 200_000  # max. number of cached embeddings (~3 KB each)
+
+# Optional in-process ANN index over chunk embeddings, used once it was built and saved to this directory
+CHUNK_INDEX_DIR = os.getenv('CHUNK_INDEX_DIR')
+CHUNK_INDEX_N_PROBE = 8  # inverted lists scanned per query
+
+# Chunks are cut at sentence boundaries to at most this many tokens of the embedding model's tokenizer,
+# consecutive chunks of a split text share up to CHUNK_OVERLAP_TOKENS tokens of sentences
+CHUNK_MAX_TOKENS = 256
+CHUNK_OVERLAP_TOKENS = 0
+
+# Embedding: chunks of this many articles are embedded together, sorted by length into batches
+# of EMBEDDING_BATCH_SIZE texts. EMBEDDING_NUM_THREADS sets torch's intra-op threads, 0 keeps its default.
+EMBEDDING_ARTICLES_PER_BATCH = 32
+EMBEDDING_BATCH_SIZE = 32
+EMBEDDING_NUM_THREADS = int(os.getenv('EMBEDDING_NUM_THREADS', '0'))
+
+# Inference backend of the embedding model: 'torch' or 'onnx' (exported once to ONNX_MODEL_DIR, see inference.py).
+# With INFERENCE_QUANTIZE_INT8, the ONNX embedding model and GLiNER's linear layers use int8 weights.
+INFERENCE_BACKEND = os.getenv('INFERENCE_BACKEND', 'torch')
+INFERENCE_QUANTIZE_INT8 = os.getenv('INFERENCE_QUANTIZE_INT8', '0') == '1'
+ONNX_MODEL_DIR = os.getenv('ONNX_MODEL_DIR', 'onnx_models')
+# Accuracy check of the optimised models against the PyTorch reference
+INFERENCE_MIN_COSINE_SIMILARITY = 0.99
+INFERENCE_MIN_SPAN_F1 = 0.9
+
+# Number of fully processed articles written to the graph per transaction
+INGEST_BATCH_SIZE = 50
+# Pipelined ingestion: capacity of the queues between stages and worker threads per stage
+PIPELINE_QUEUE_SIZE = 16
+PIPELINE_WORKERS = {'chunk': 1, 'embed': 1, 'ner': 1, 'persist': 1}
+PIPELINE_REPORT_INTERVAL = 30  # seconds, None disables periodic stats output
+# Incremental crawling: articles already ingested are remembered here and skipped
+CRAWL_CHECKPOINT_PATH = os.getenv('CRAWL_CHECKPOINT_PATH', 'crawl_checkpoint.sqlite')
+CRAWL_BLOOM_EXPECTED_ITEMS = 2_000_000
+CRAWL_BLOOM_FALSE_POSITIVE_RATE = 0.01
+# Number of texts per GLiNER forward pass in batched NER
+NER_BATCH_SIZE = 16
 
 # NOTE: For performance refer to 
 #       https://docs.snowflake.com/user-guide/snowflake-cortex/llm-functions#small-models
@@ -15,6 +58,73 @@ CHAT_MODEL = 'snowflake-arctic'  # fully open source
 # CHAT_MODEL = 'mistral-large'  # large european LLM, proprietary
 # CHAT_MODEL = 'mixtral-8x7b'  # small european LLM, open source
 
+# Compact graph schema sent to the LLM, cached on disk
+SCHEMA_CACHE_PATH = os.getenv('SCHEMA_CACHE_PATH', 'graph_schema.json')
+SCHEMA_EXCLUDED_PROPERTIES = {'embedding'}
+# Seconds after which a schema held in memory is checked against the database again, as other
+# processes, e.g. the crawler or entity resolution, may add labels and relationship types
+SCHEMA_CHECK_INTERVAL = 60
+
+# In-process cache of fulltext entity candidate lookups
+CANDIDATE_CACHE_SIZE = 4096
+CANDIDATE_CACHE_TTL = 15 * 60  # seconds
+
+# Cache of generated Cypher queries, only persisted if a path is set
+CYPHER_CACHE_SIZE = 1024
+CYPHER_CACHE_TTL = 6 * 60 * 60  # seconds
+CYPHER_CACHE_PATH = os.getenv('CYPHER_CACHE_PATH')
+
+# Size limits of the context that the generated query retrieves for the answer prompt
+ANSWER_MAX_RECORDS = 50
+ANSWER_CONTEXT_TOKEN_BUDGET = 3000
+ANSWER_MAX_FIELD_TOKENS = 400
+
+# Cost guard for generated queries: plans estimated above this are rejected,
+# variable-length paths without upper bound are capped at this length
+QUERY_MAX_ESTIMATED_ROWS = 1_000_000
+QUERY_MAX_PATH_LENGTH = 4
+
+# Retrieval for chat answers: 'cypher' answers from the LLM-generated query alone, 'hybrid' runs it
+# together with vector and fulltext search over chunks and fuses the rankings
+CHAT_RETRIEVAL_MODE = os.getenv('CHAT_RETRIEVAL_MODE', 'cypher')
+RETRIEVAL_TOP_K = 10  # results per retriever
+RETRIEVAL_RRF_K = 60  # rank offset of reciprocal rank fusion, larger values flatten the rank weights
+RETRIEVAL_TIMEOUT = 15.0  # seconds, retrievers that take longer are left out
+RETRIEVAL_WORKERS = 8
+# Calls of one retriever that may run at the same time, including calls that timed out but are still
+# running, e.g. slow LLM query generation, so that one retriever cannot occupy the whole pool
+RETRIEVAL_MAX_RUNNING = 4
+QUESTION_EMBEDDING_CACHE_SIZE = 1024
+
+# Aggregates kept up to date by ingest_articles: mention, article and source counts on entities,
+# (:Source)-[:MENTIONS_ENTITY]->(entity), (entity)-[:MENTIONED_ON]->(:Day) and weighted CO_MENTIONED edges
+# between the AGGREGATE_MAX_CO_MENTIONED most mentioned entities of each article
+MAINTAIN_AGGREGATES = True
+AGGREGATE_MAX_CO_MENTIONED = 50
+
+# Columnar snapshots of the graph (see snapshot.py)
+SNAPSHOT_PAGE_SIZE = 10_000  # rows read from Neo4j per query on export
+SNAPSHOT_IMPORT_BATCH_SIZE = 5_000  # rows written per UNWIND transaction on import
+
+# Offline entity resolution (see entity_resolution.py): entities sharing a name token prefix of this length
+# are compared, blocks with more entities are skipped. Pairs above the string similarity threshold are
+# scored by a weighted sum of string and embedding similarity and linked by SAME_AS above THRESHOLD.
+ENTITY_RESOLUTION_PREFIX_LEN = 4
+ENTITY_RESOLUTION_MAX_BLOCK_SIZE = 500
+ENTITY_RESOLUTION_MIN_STRING_SIMILARITY = 0.8
+ENTITY_RESOLUTION_STRING_WEIGHT = 0.5
+ENTITY_RESOLUTION_THRESHOLD = 0.88
+
+# Timing spans and counters of ingest and chat (see metrics.py), off unless METRICS_ENABLED=1.
+# The export path decides the format: Prometheus text for .prom, JSON otherwise.
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', '0') == '1'
+METRICS_EXPORT_PATH = os.getenv('METRICS_EXPORT_PATH', 'metrics.prom')
+# Cypher queries, including generated ones, that take longer than this are appended to the slow query log
+# while metrics are enabled. Ingest transactions write whole batches and get a threshold of their own.
+SLOW_QUERY_SECONDS = 1.0
+SLOW_TRANSACTION_SECONDS = 30.0
+SLOW_QUERY_LOG_PATH = os.getenv('SLOW_QUERY_LOG_PATH', 'slow_queries.log')
+
 SNOWFLAKE_CONNECTION_PARAMS = {
    "account": os.getenv('SNOWFLAKE_ACCOUNT'),
    "user": os.getenv('SNOWFLAKE_USER'),
@@ -0,0 +1,111 @@
+import re
+from collections.abc import Iterable
+from dataclasses import dataclass
+
+import config
+
+
+LIMIT_PATTERN = re.compile(r'\bLIMIT\s+(\d+)\s*;?\s*$', re.IGNORECASE)
+UNION_PATTERN = re.compile(r'\s+(UNION(?:\s+ALL)?)\s+', re.IGNORECASE)
+RECORD_SEPARATOR = f"\n{'='*5}\n"
+
+
+@dataclass
+class AnswerContext:
+    """
+    The context string for the answer prompt and what was left out to fit the budget
+
+    records_dropped counts the records read after the budget was full,
+    has_more_records tells whether reading stopped at max_records before the end of the result,
+    so that further records may have been left out.
+    """
+    text: str
+    records_used: int
+    tokens: int
+    truncated_fields: int = 0
+    truncated_tokens: int = 0
+    records_dropped: int = 0
+    has_more_records: bool = False
+
+    def report(self) -> dict[str, int | bool]:
+        return {
+            'records_used': self.records_used,
+            'tokens': self.tokens,
+            'truncated_fields': self.truncated_fields,
+            'truncated_tokens': self.truncated_tokens,
+            'records_dropped': self.records_dropped,
+            'has_more_records': self.has_more_records,
+        }
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count, about four characters per token for the Cortex models"""
+    return (len(text) + 3) // 4
+
+
+def limit_query(query: str, max_records: int = config.ANSWER_MAX_RECORDS) -> str:
+    """Adds a LIMIT to the end of a query, or of each part of a UNION, or lowers an existing one to max_records"""
+    query = query.strip().rstrip(';').rstrip()
+    # A LIMIT at the end of a UNION only belongs to its last part
+    parts = UNION_PATTERN.split(query)
+    if len(parts) > 1:
+        return ' '.join(
+            part if i % 2 else _limit_single_query(part, max_records) for i, part in enumerate(parts)
+        )
+    return _limit_single_query(query, max_records)
+
+
+def _limit_single_query(query: str, max_records: int) -> str:
+    match = LIMIT_PATTERN.search(query)
+    if match is None:
+        return f"{query.rstrip(';').rstrip()} LIMIT {max_records}"
+    if int(match.group(1)) > max_records:
+        return query[:match.start()] + f"LIMIT {max_records}"
+    return query
+
+
+def build_context(records: Iterable[dict], token_budget: int = config.ANSWER_CONTEXT_TOKEN_BUDGET,
+                  max_records: int = config.ANSWER_MAX_RECORDS,
+                  max_field_tokens: int = config.ANSWER_MAX_FIELD_TOKENS) -> AnswerContext:
+    """
+    Maps records to a context string that fits into token_budget.
+
+    Records are consumed lazily and in order, up to max_records of them. Records after the first
+    one that does not fit are only counted as dropped. Long values are cut to max_field_tokens,
+    and a first record that alone exceeds the budget is cut to fit it.
+    """
+    parts, tokens, is_full = [], 0, False
+    context = AnswerContext(text='', records_used=0, tokens=0)
+    separator_tokens = estimate_tokens(RECORD_SEPARATOR)
+    for record in records:
+        if context.records_used + context.records_dropped >= max_records:
+            context.has_more_records = True
+            break
+        if is_full:
+            context.records_dropped += 1
+            continue
+        lines = []
+        for key, value in record.items():
+            value_str = str(value)
+            value_tokens = estimate_tokens(value_str)
+            if value_tokens > max_field_tokens:
+                value_str = value_str[:max_field_tokens * 4].rsplit(' ', 1)[0] + ' ...'
+                context.truncated_fields += 1
+                context.truncated_tokens += value_tokens - max_field_tokens
+            lines.append(f"{key}: {value_str}")
+        record_str = '\n'.join(lines)
+        record_tokens = estimate_tokens(record_str) + (separator_tokens if parts else 0)
+        if tokens + record_tokens > token_budget and not parts:
+            record_str = record_str[:token_budget * 4 - 4].rsplit(' ', 1)[0] + ' ...'
+            context.truncated_tokens += record_tokens - estimate_tokens(record_str)
+            record_tokens = estimate_tokens(record_str)
+        if tokens + record_tokens > token_budget:
+            context.records_dropped += 1
+            is_full = True
+            continue
+        parts.append(record_str)
+        tokens += record_tokens
+        context.records_used += 1
+    context.text = RECORD_SEPARATOR.join(parts)
+    context.tokens = tokens
+    return context
@@ -1,71 +1,225 @@
-from math import ceil
-
 import fundus
 import fundus.scraping.article
 
 import config
-from embedding import embed_sentences
+import utils
+from checkpoint import CrawlCheckpoint, content_hash
+from embedding import count_tokens, embed_sentences, get_embedding_cache, get_embedding_model, get_tokenizer
 from graph import NewsGraphClient
-from ner import EntityFinder
-from schema import ArticleChunk, ArticleChunkCategory, Iterable
-from utils import split_into_combined_sentence_chunks
+from metrics import metrics
+from ner import EntityFinder, get_entity_finder
+from pipeline import Pipeline, Stage
+from schema import ArticleChunk, ArticleChunkCategory, Iterable, ProcessedArticle, attach_embeddings
+from utils import batched, chunk_by_tokens
 
 
-MAX_PARAGRAPH_LEN = 1100
 MAX_ARTICLES = 1000
+NER_ARTICLES_PER_BATCH = 8  # articles whose chunks share NER batches
 
 
-def main():
+def main(batch_size:int=config.INGEST_BATCH_SIZE, pipelined:bool=False, incremental:bool=False):
     publishers = (fundus.PublisherCollection.de, fundus.PublisherCollection.uk)
     crawler = fundus.Crawler(*publishers)
-    articles = crawler.crawl(max_articles=MAX_ARTICLES)
+    # The crawl is lazy, so the fetch time is taken per article as it is pulled
+    articles = metrics.timed_iter('fetch', crawler.crawl(max_articles=MAX_ARTICLES))
     db = NewsGraphClient()
+    checkpoint = None
+    if incremental:
+        checkpoint = open_checkpoint(db)
+        articles = skip_known_articles(articles, checkpoint)
+    print(warm_up())
+    entity_finder = get_entity_finder()
+    if pipelined:
+        ingest_pipeline = build_ingest_pipeline(db, entity_finder, batch_size=batch_size, checkpoint=checkpoint)
+        ingest_pipeline.run(articles)
+        print(ingest_pipeline.format_stats())
+        db.save_chunk_index()
+        export_metrics()
+        return
+
+    # Articles are chunked one by one, embedding, NER and writes happen in batches
+    for batch in batched(process_articles(articles), batch_size):
+        try:
+            find_mentioned_entities_in_articles(batch, entity_finder)
+            ingest_batch(db, batch, checkpoint)
+        except Exception as e:
+            log_error('persist', batch, e)
+    db.save_chunk_index()
+    export_metrics()
+
+
+def export_metrics(path=config.METRICS_EXPORT_PATH):
+    if metrics.enabled:
+        metrics.export(path)
+        print(f"Wrote metrics to {path}")
+
+
+def build_ingest_pipeline(
+        db: NewsGraphClient, entity_finder: EntityFinder, batch_size:int=config.INGEST_BATCH_SIZE,
+        workers: dict[str, int] = config.PIPELINE_WORKERS, queue_size:int=config.PIPELINE_QUEUE_SIZE,
+        checkpoint: CrawlCheckpoint | None = None
+    ) -> Pipeline:
+    """
+    Builds a pipeline in which chunking, embedding, NER and graph writes run concurrently.
+
+    Fetching happens in the feeder thread, every other stage has its own bounded input queue.
+    """
+    def embed(processed_articles: list[ProcessedArticle]) -> list[ProcessedArticle]:
+        embed_articles(processed_articles)
+        return processed_articles
+
+    def find_entities(processed_articles: list[ProcessedArticle]) -> list[ProcessedArticle]:
+        find_mentioned_entities_in_articles(processed_articles, entity_finder)
+        return processed_articles
+
+    stages = [
+        Stage('chunk', create_processed_article, workers=workers.get('chunk', 1), queue_size=queue_size),
+        Stage('embed', embed, workers=workers.get('embed', 1), queue_size=queue_size,
+              batch_size=config.EMBEDDING_ARTICLES_PER_BATCH),
+        Stage('ner', find_entities, workers=workers.get('ner', 1), queue_size=queue_size,
+              batch_size=NER_ARTICLES_PER_BATCH),
+        Stage('persist', lambda batch: ingest_batch(db, batch, checkpoint), workers=workers.get('persist', 1),
+              queue_size=queue_size, batch_size=batch_size),
+    ]
+    return Pipeline(stages, on_error=log_error, report_interval=config.PIPELINE_REPORT_INTERVAL)
+
+
+def ingest_batch(db: NewsGraphClient, batch: list[ProcessedArticle], checkpoint: CrawlCheckpoint | None = None):
+    article_ids = db.ingest_articles(batch, batch_size=len(batch))
+    print(article_ids)
+    if checkpoint is not None:
+        checkpoint.add_many((article.url, article.content_hash) for article in batch)
+
+
+def open_checkpoint(db: NewsGraphClient, path=config.CRAWL_CHECKPOINT_PATH) -> CrawlCheckpoint:
+    """Opens the crawl checkpoint, a new one is seeded with the article URLs in the graph"""
+    checkpoint = CrawlCheckpoint(path)
+    if len(checkpoint) == 0:
+        num_urls = checkpoint.seed_from_urls(db.iter_article_urls())
+        print(f"Seeded crawl checkpoint with {num_urls} article URLs from the graph")
+    return checkpoint
+
+
+def skip_known_articles(articles: Iterable[fundus.scraping.article.Article], checkpoint: CrawlCheckpoint):
+    """Filters out articles that were ingested before or occur twice in this crawl"""
+    urls_in_crawl = set()
     for article in articles:
+        url = article.html.responded_url
+        if url in urls_in_crawl or checkpoint.is_known(url, get_content_hash(article)):
+            continue
+        urls_in_crawl.add(url)
+        yield article
+
+
+def get_content_hash(article: fundus.scraping.article.Article) -> str:
+    return content_hash(article.title or '', article.plaintext or '')
+
+
+def warm_up() -> dict[str, float]:
+    """Loads the ingest models up front and returns their load times in seconds"""
+    return utils.warm_up(get_tokenizer, get_embedding_model, get_embedding_cache, get_entity_finder)
+
+
+def log_error(stage: str, item, e: Exception):
+    metrics.increment('errors', stage=stage)
+    if isinstance(item, list):
+        description = str([article.url for article in item])
+    elif isinstance(item, ProcessedArticle):
+        description = item.url
+    elif item is not None:
+        description = f"{item.html.responded_url}\n{str(item)}"
+    else:
+        description = ''
+    with open('error_log.log', 'a') as f:
+        f.write(f"[{stage}] {description}: {e}\n")
+
+
+def process_articles(articles: Iterable[fundus.scraping.article.Article],
+                     articles_per_batch:int=config.EMBEDDING_ARTICLES_PER_BATCH):
+    """Chunks and embeds articles, entities are left to find_mentioned_entities_in_articles"""
+    for batch in batched(articles, articles_per_batch):
+        processed_articles = []
+        for article in batch:
+            try:
+                processed_articles.append(create_processed_article(article))
+            except Exception as e:
+                log_error('process', article, e)
         try:
-            # title, body, plaintext
-            # body contains a summary and sections, each section a headline, paragraphs
-            # lang, publishing_date, topics, authors
-            # Article: contains metadata - links to sections, Sections contain paragraphs
-            article_id = db.create_article(article=article)  # includes metadata and title
-            print(article_id)
-            article_chunks = get_chunks_from_article_body(article)
-            embeddings = embed_sentences(*(chunk.text for chunk in article_chunks))
-            for chunk, embedding in zip(article_chunks, embeddings):
-                chunk.embedding = embedding
-            
-            _ = db.merge_article_chunks(article_chunks, article_id)
-            print(_)
-            topics = article.topics  # name only (Entity Topic)
-            # _ = db.merge_article_topics(topics, article_id)
-            # print(_)
-            source = article.html.source_info  #publisher, type, url (Entity Source)
-            _ = db.merge_article_source(source, article_id)
-            print(_)
-            authors = article.authors or [source.publisher]  # name only (Entity Author, if empty take generic Source?)
-            _ = db.merge_article_authors(authors, article_id)
-            print(_)
-            find_and_add_entities(db, article_id, article_chunks)
+            embed_articles(processed_articles)
         except Exception as e:
-            with open('error_log.log', 'a') as f:
-                f.write(f"{article_id}: {e}\n{str(article)}\n")
+            log_error('embed', processed_articles, e)
+            continue
+        yield from processed_articles
+
+
+def create_processed_article(article: fundus.scraping.article.Article) -> ProcessedArticle:
+    # title, body, plaintext
+    # body contains a summary and sections, each section a headline, paragraphs
+    # lang, publishing_date, topics, authors
+    # Article: contains metadata - links to sections, Sections contain paragraphs
+    source = article.html.source_info  #publisher, type, url (Entity Source)
+    with metrics.span('chunk'):
+        chunks = get_chunks_from_article_body(article)
+    metrics.increment('articles_processed')
+    metrics.increment('chunks_created', len(chunks))
+    return ProcessedArticle(
+        title=article.title,
+        publishing_date=article.publishing_date,
+        language=article.lang,
+        url=article.html.responded_url,
+        source=source.__dict__,
+        authors=article.authors or [source.publisher],  # name only (Entity Author, if empty take generic Source?)
+        chunks=chunks,
+        content_hash=get_content_hash(article)
+    )
+
+
+def embed_articles(processed_articles: list[ProcessedArticle]):
+    """Embeds the chunks of several articles together, so that the model gets full batches of similar length"""
+    embed_chunks([chunk for article in processed_articles for chunk in article.chunks])
+
+
+def embed_chunks(article_chunks: list[ArticleChunk]):
+    embeddings = embed_sentences(*(chunk.text for chunk in article_chunks))
+    attach_embeddings(article_chunks, embeddings)
 
 
 def find_and_add_entities(
         db: NewsGraphClient, article_id: str, article_chunks: Iterable[ArticleChunk],
-        entity_finder=EntityFinder(labels=config.RELEVANT_LABELS)
+        entity_finder: EntityFinder | None = None
     ):
-    mentioned_entities = (
-        {
-            'entity': entity,
-            'section': chunk.section,
-            'chunk': chunk_idx
-        }
-        for chunk_idx, chunk in enumerate(article_chunks)
-        for entity in entity_finder.find(chunk.text)
+    entity_finder = entity_finder or get_entity_finder()
+    mentioned_entities = find_mentioned_entities(article_chunks, entity_finder)
+    db.merge_mentioned_entities(mentioned_entities)
+
+
+def find_mentioned_entities(article_chunks: Iterable[ArticleChunk], entity_finder: EntityFinder) -> list[dict]:
+    return _find_mentioned_entities_batched([list(article_chunks)], entity_finder)[0]
+
+
+def find_mentioned_entities_in_articles(processed_articles: list[ProcessedArticle], entity_finder: EntityFinder):
+    """Runs batched NER over the chunks of all articles and sets their mentioned_entities"""
+    mentions_per_article = _find_mentioned_entities_batched(
+        [article.chunks for article in processed_articles], entity_finder
     )
-    _ = db.merge_mentioned_entities(mentioned_entities, article_id)
-    for r in _:
-        print(r)
+    for article, mentioned_entities in zip(processed_articles, mentions_per_article):
+        article.mentioned_entities = mentioned_entities
+
+
+def _find_mentioned_entities_batched(chunks_per_article: list[list[ArticleChunk]],
+                                     entity_finder: EntityFinder) -> list[list[dict]]:
+    """Runs NER over the chunks of all articles at once and returns the mentions of each article"""
+    entities_per_chunk = iter(entity_finder.find_batched(
+        [chunk.text for article_chunks in chunks_per_article for chunk in article_chunks]
+    ))
+    return [
+        [
+            {'entity': entity, 'section': chunk.section, 'chunk': chunk_idx, 'chunk_uid': chunk.uid}
+            for chunk_idx, (chunk, entities) in enumerate(zip(article_chunks, entities_per_chunk))
+            for entity in entities
+        ]
+        for article_chunks in chunks_per_article
+    ]
 
 
 def get_chunks_from_article_body(article: fundus.scraping.article.Article) -> list[ArticleChunk]:
@@ -91,15 +245,11 @@ def chunk_text_sequence(text_sequence: Iterable[str], category: ArticleChunkCate
     )
 
 
-def ensure_max_len_of_texts(text_sequence: Iterable[str], max_len:int=MAX_PARAGRAPH_LEN):
-    """Splits texts into smaller chunks if their length is above a threshold"""
+def ensure_max_len_of_texts(text_sequence: Iterable[str], max_tokens:int=config.CHUNK_MAX_TOKENS,
+                            overlap_tokens:int=config.CHUNK_OVERLAP_TOKENS):
+    """Splits texts into chunks of sentences if they have more tokens than the embedding model should get at once"""
     for text in text_sequence:
-        if len(text) < max_len:
-            yield text
-        else:
-            # In order to split evenly
-            min_combination_len = int(max_len / ceil(len(text) / max_len))
-            yield from split_into_combined_sentence_chunks(text, min_combination_len)
+        yield from chunk_by_tokens(text, count_tokens, max_tokens, overlap_tokens=overlap_tokens)
 
 
 def map_chunk_records_to_article_chunks(db, article_ids: Iterable[str]):
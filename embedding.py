@@ -1,22 +1,81 @@
 import numpy as np
-from transformers import AutoModel
 from numpy.linalg import norm
 
 import config
+from embedding_cache import EmbeddingCache
+from inference import load_onnx_embedding_model, load_torch_embedding_model
+from metrics import metrics
+from utils import batched, lazy_singleton
 
 
-# trust_remote_code is needed to use the encode method
-embedding_model = AutoModel.from_pretrained(
-    config.EMBEDDING_MODEL_CHECKPOINT,
-    trust_remote_code=True,
-    revision=config.EMBEDDING_MODEL_HASH
-)
+@lazy_singleton
+def get_embedding_model():
+    if config.INFERENCE_BACKEND == 'onnx':
+        # None if onnxruntime is missing or the export failed, then the PyTorch model is used
+        model = load_onnx_embedding_model(get_tokenizer())
+        if model is not None:
+            return model
+    return load_torch_embedding_model()
 
 
-def embed_sentences(*sentences: str, max_length=2048) -> np.ndarray:
-    embeddings = embedding_model.encode(sentences, max_length=max_length)
+@lazy_singleton
+def get_tokenizer():
+    from transformers import AutoTokenizer
+
+    return AutoTokenizer.from_pretrained(config.EMBEDDING_MODEL_CHECKPOINT, revision=config.EMBEDDING_MODEL_HASH)
+
+
+@lazy_singleton
+def get_embedding_cache() -> EmbeddingCache | None:
+    return EmbeddingCache(config.EMBEDDING_CACHE_DIR) if config.EMBEDDING_CACHE_DIR else None
+
+
+def embed_sentences(*sentences: str, max_length=2048, batch_size=config.EMBEDDING_BATCH_SIZE) -> np.ndarray:
+    embedding_cache = get_embedding_cache()
+    metrics.increment('embedded_texts', len(sentences))
+    if embedding_cache is None:
+        return encode_in_batches(sentences, max_length=max_length, batch_size=batch_size)
+
+    # Only encode texts that are not cached yet, each distinct text once
+    embeddings, missing = embedding_cache.get_many(sentences)
+    metrics.increment('embedding_cache_hits', len(sentences) - len(missing))
+    if missing:
+        missing_sentences = list(dict.fromkeys(sentences[i] for i in missing))
+        new_embeddings = encode_in_batches(missing_sentences, max_length=max_length, batch_size=batch_size)
+        embedding_cache.put_many(missing_sentences, new_embeddings)
+        embeddings_by_sentence = dict(zip(missing_sentences, new_embeddings))
+        for i in missing:
+            embeddings[i] = embeddings_by_sentence[sentences[i]]
     return embeddings
 
 
+def encode_in_batches(texts: list[str], max_length=2048, batch_size=config.EMBEDDING_BATCH_SIZE) -> np.ndarray:
+    """
+    Encodes texts in fixed-size batches of similar length and returns the embeddings in input order.
+
+    Texts are sorted by length, so that every batch is padded to about the length of its texts.
+    Character length stands in for token length here to avoid tokenizing twice.
+    """
+    embedding_model = get_embedding_model()
+    embeddings = None
+    for batch_indices in batched(sorted(range(len(texts)), key=lambda i: len(texts[i])), batch_size):
+        with metrics.span('embed'):
+            batch_embeddings = embedding_model.encode(
+                [texts[i] for i in batch_indices], max_length=max_length, batch_size=len(batch_indices)
+            )
+        metrics.increment('embedding_batches')
+        if embeddings is None:
+            embeddings = np.empty((len(texts), batch_embeddings.shape[-1]), dtype=np.float32)
+        embeddings[batch_indices] = batch_embeddings
+    return embeddings if embeddings is not None else np.empty((0, config.EMBEDDING_SIZE), dtype=np.float32)
+
+
+def count_tokens(texts: list[str]) -> list[int]:
+    """Number of tokens of each text for the embedding model, without special tokens"""
+    if not texts:
+        return []
+    return [len(ids) for ids in get_tokenizer()(list(texts), add_special_tokens=False)['input_ids']]
+
+
 def cos_sim(a: np.ndarray, b: np.ndarray) -> float:
     return (a @ b.T) / (norm(a)*norm(b))
@@ -0,0 +1,139 @@
+import json
+import threading
+from hashlib import blake2b
+from pathlib import Path
+
+import numpy as np
+
+import config
+from quantization import dequantize, quantize
+
+
+KEY_SIZE = 16  # bytes of the blake2b digest used as cache key
+EMPTY_KEY = bytes(KEY_SIZE)
+
+
+class EmbeddingCache:
+    """
+    EmbeddingCache is a persistent, content-addressed store of text embeddings.
+
+    Embeddings live in a memory-mapped matrix with a fixed number of slots, stored as
+    float32, float16 or int8 with per-row scales. Each slot is addressed by a hash of the text and the embedding model revision,
+    and the least recently used slots are evicted once the cache is full.
+    """
+    def __init__(self, directory: str | Path, capacity: int = config.EMBEDDING_CACHE_SIZE,
+                 dim: int = config.EMBEDDING_SIZE, dtype: str = config.EMBEDDING_STORAGE_DTYPE,
+                 model_id: str = f"{config.EMBEDDING_MODEL_CHECKPOINT}@{config.EMBEDDING_MODEL_HASH}"):
+        self.directory = Path(directory)
+        self.capacity = capacity
+        self.dim = dim
+        self.dtype = dtype
+        self.model_id = model_id
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._open()
+
+    def key(self, text: str) -> bytes:
+        return blake2b(f"{self.model_id}\0{text}".encode('utf-8'), digest_size=KEY_SIZE).digest()
+
+    def get_many(self, texts: list[str]) -> tuple[np.ndarray, list[int]]:
+        """
+        Looks up the embeddings of texts.
+
+        Returns a matrix with one row per text and the indices of the texts that were not cached.
+        The rows of those texts are left as zeros.
+        """
+        embeddings = np.zeros((len(texts), self.dim), dtype=np.float32)
+        missing = []
+        with self._lock:
+            for i, text in enumerate(texts):
+                slot = self._slots.get(self.key(text))
+                if slot is None:
+                    missing.append(i)
+                    continue
+                embeddings[i] = dequantize(self._embeddings[slot], None if self._scales is None else self._scales[slot])
+                self._touch(slot)
+            self.hits += len(texts) - len(missing)
+            self.misses += len(missing)
+        return embeddings, missing
+
+    def put_many(self, texts: list[str], embeddings: np.ndarray):
+        with self._lock:
+            keys = [self.key(text) for text in texts]
+            new_keys = {key for key in keys if key not in self._slots}
+            free_slots = self._get_free_slots(len(new_keys))
+            codes, scales = quantize(embeddings, self.dtype)
+            for i, key in enumerate(keys):
+                slot = self._slots.get(key)
+                if slot is None:
+                    if not free_slots:
+                        continue
+                    slot = free_slots.pop()
+                    self._slots[key] = slot
+                    self._keys[slot] = np.void(key)
+                self._embeddings[slot] = codes[i]
+                if scales is not None:
+                    self._scales[slot] = scales[i]
+                self._touch(slot)
+
+    def flush(self):
+        with self._lock:
+            for array in (self._embeddings, self._scales, self._keys, self._ticks):
+                if array is not None:
+                    array.flush()
+
+    def stats(self) -> dict[str, int | float]:
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._slots),
+            'capacity': self.capacity,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+        }
+
+    def _open(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        meta_path = self.directory / 'meta.json'
+        meta = {'capacity': self.capacity, 'dim': self.dim, 'dtype': self.dtype}
+        # A cache with another layout cannot be mapped, so it is started from scratch
+        is_compatible = meta_path.exists() and json.loads(meta_path.read_text()) == meta
+        mode = 'r+' if is_compatible else 'w+'
+        self._embeddings = np.memmap(self.directory / f'embeddings.{self.dtype}', dtype=self.dtype, mode=mode,
+                                     shape=(self.capacity, self.dim))
+        self._scales = None
+        if self.dtype == 'int8':
+            self._scales = np.memmap(self.directory / 'scales.f32', dtype=np.float32, mode=mode, shape=(self.capacity,))
+        self._keys = np.memmap(self.directory / 'keys.bin', dtype=f'V{KEY_SIZE}', mode=mode, shape=(self.capacity,))
+        self._ticks = np.memmap(self.directory / 'ticks.i64', dtype=np.int64, mode=mode, shape=(self.capacity,))
+        meta_path.write_text(json.dumps(meta))
+        # Empty slots have an all-zero key
+        keys = [key.tobytes() for key in self._keys]
+        self._slots = {key: slot for slot, key in enumerate(keys) if key != EMPTY_KEY}
+        self._free = [slot for slot in range(self.capacity - 1, -1, -1) if keys[slot] == EMPTY_KEY]
+        self._tick = int(self._ticks.max()) + 1 if self._slots else 1
+
+    def _touch(self, slot: int):
+        self._ticks[slot] = self._tick
+        self._tick += 1
+
+    def _get_free_slots(self, n: int) -> list[int]:
+        missing = n - len(self._free)
+        if missing > 0:
+            self._evict(min(missing, self.capacity))
+        return [self._free.pop() for _ in range(min(n, len(self._free)))]
+
+    def _evict(self, n: int):
+        """Frees the n least recently used slots"""
+        occupied = np.fromiter(self._slots.values(), dtype=np.int64, count=len(self._slots))
+        if n < len(occupied):
+            occupied = occupied[np.argpartition(self._ticks[occupied], n - 1)[:n]]
+        for slot in occupied:
+            del self._slots[self._keys[slot].tobytes()]
+            self._keys[slot] = np.void(EMPTY_KEY)
+            self._ticks[slot] = 0
+            self._free.append(int(slot))
+        self.evictions += len(occupied)
@@ -0,0 +1,235 @@
+"""
+Offline entity resolution for the Person, Organization and Location nodes of the graph.
+
+Spelling variants of an entity ('Ursula von der Leyen', 'Ursula v. d. Leyen') are linked to a
+canonical node by SAME_AS relationships. Only entities that share a blocking key, a prefix of
+one of their name tokens, are compared, and oversized blocks are skipped, so the work grows with
+the number of entities instead of its square. Pairs are scored by Jaro-Winkler similarity of the
+normalised names and cosine similarity of their embeddings.
+Runs are incremental: only pairs with at least one entity that was not resolved before are scored.
+"""
+import re
+import unicodedata
+from collections import defaultdict
+from collections.abc import Iterable, Iterator
+from dataclasses import dataclass, field
+
+import numpy as np
+
+import config
+from embedding import embed_sentences
+from graph import MENTION_LABELS, NewsGraphClient
+from metrics import metrics
+from utils import batched
+
+
+NON_WORD_CHARS = re.compile(r'[\W_]+')
+# Tokens that say little about the identity of an entity
+STOP_TOKENS = {'von', 'van', 'der', 'den', 'de', 'la', 'le', 'du', 'da', 'di', 'the', 'of', 'und', 'and', 'e', 'v'}
+
+
+@dataclass
+class EntityTable:
+    """The entities of one label, with column lists instead of one object per entity to save memory"""
+    uids: list[str] = field(default_factory=list)
+    names: list[str] = field(default_factory=list)
+    normalized: list[str] = field(default_factory=list)
+    mentions: list[int] = field(default_factory=list)
+    resolved: list[bool] = field(default_factory=list)
+
+    def __len__(self):
+        return len(self.uids)
+
+
+class UnionFind:
+    def __init__(self, size: int):
+        self.parents = list(range(size))
+
+    def find(self, i: int) -> int:
+        root = i
+        while self.parents[root] != root:
+            root = self.parents[root]
+        while self.parents[i] != root:
+            self.parents[i], i = root, self.parents[i]
+        return root
+
+    def union(self, i: int, j: int):
+        root_i, root_j = self.find(i), self.find(j)
+        if root_i != root_j:
+            self.parents[max(root_i, root_j)] = min(root_i, root_j)
+
+
+def normalize_name(name: str) -> str:
+    """Lower-cases a name and removes accents and punctuation"""
+    decomposed = unicodedata.normalize('NFKD', name)
+    without_accents = ''.join(char for char in decomposed if not unicodedata.combining(char))
+    return NON_WORD_CHARS.sub(' ', without_accents.casefold()).strip()
+
+
+def blocking_keys(normalized_name: str, prefix_len: int = config.ENTITY_RESOLUTION_PREFIX_LEN) -> set[str]:
+    """Prefixes of the informative tokens of a name, entities are only compared if they share one"""
+    return {
+        token[:prefix_len]
+        for token in normalized_name.split()
+        if len(token) >= 2 and token not in STOP_TOKENS
+    }
+
+
+def jaro_winkler(a: str, b: str, prefix_scale: float = 0.1) -> float:
+    if a == b:
+        return 1.0
+    if not a or not b:
+        return 0.0
+    window = max(len(a), len(b)) // 2 - 1
+    a_matched, b_matched = [False] * len(a), [False] * len(b)
+    matches = 0
+    for i, char in enumerate(a):
+        for j in range(max(0, i - window), min(len(b), i + window + 1)):
+            if not b_matched[j] and b[j] == char:
+                a_matched[i] = b_matched[j] = True
+                matches += 1
+                break
+    if not matches:
+        return 0.0
+    a_chars = [char for char, matched in zip(a, a_matched) if matched]
+    b_chars = [char for char, matched in zip(b, b_matched) if matched]
+    transpositions = sum(x != y for x, y in zip(a_chars, b_chars)) / 2
+    jaro = (matches / len(a) + matches / len(b) + (matches - transpositions) / matches) / 3
+    prefix = 0
+    for x, y in zip(a[:4], b[:4]):
+        if x != y:
+            break
+        prefix += 1
+    return jaro + prefix * prefix_scale * (1 - jaro)
+
+
+def load_entities(db: NewsGraphClient, label: str) -> EntityTable:
+    table = EntityTable()
+    for records in db.iter_entities(label):
+        for record in records:
+            if not record['name']:
+                continue
+            table.uids.append(record['uid'])
+            table.names.append(record['name'])
+            table.normalized.append(normalize_name(record['name']))
+            table.mentions.append(record['mentions'])
+            table.resolved.append(record['resolved'])
+    return table
+
+
+def candidate_pairs(table: EntityTable, max_block_size: int = config.ENTITY_RESOLUTION_MAX_BLOCK_SIZE
+                    ) -> Iterator[tuple[int, int]]:
+    """
+    Yields the pairs of entities that share a blocking key and of which at least one is not resolved yet.
+
+    Blocks larger than max_block_size, e.g. of very common first names, are skipped.
+    Every pair is yielded once, even if it shares several keys: only by the block of the smallest
+    key it shares, so that no set of the pairs seen so far is needed.
+    """
+    keys = [blocking_keys(normalized) for normalized in table.normalized]
+    blocks = defaultdict(list)
+    for i, entity_keys in enumerate(keys):
+        for key in entity_keys:
+            blocks[key].append(i)
+    skipped = {key for key, members in blocks.items() if len(members) > max_block_size}
+    for key, members in blocks.items():
+        if len(members) < 2 or key in skipped:
+            continue
+        for i in members:
+            if table.resolved[i]:
+                continue
+            for j in members:
+                # Pairs of two new entities are met from both sides, they are yielded from the smaller index
+                if i == j or (j < i and not table.resolved[j]):
+                    continue
+                if min(keys[i] & keys[j] - skipped) == key:
+                    yield min(i, j), max(i, j)
+
+
+def score_pairs(table: EntityTable, pairs: Iterable[tuple[int, int]],
+                min_string_similarity: float = config.ENTITY_RESOLUTION_MIN_STRING_SIMILARITY,
+                string_weight: float = config.ENTITY_RESOLUTION_STRING_WEIGHT,
+                batch_size: int = 10_000) -> Iterator[tuple[int, int, float]]:
+    """
+    Yields (i, j, score) for the given pairs.
+
+    The cheap string similarity is computed first, only pairs above min_string_similarity
+    are embedded and get a combined score.
+    """
+    for batch in batched(pairs, batch_size):
+        string_scores = {}
+        for i, j in batch:
+            similarity = jaro_winkler(table.normalized[i], table.normalized[j])
+            if similarity >= min_string_similarity:
+                string_scores[i, j] = similarity
+        if not string_scores:
+            continue
+        indices = sorted({i for pair in string_scores for i in pair})
+        embeddings = embed_sentences(*(table.names[i] for i in indices))
+        embeddings = embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-9)
+        rows = {entity: row for row, entity in enumerate(indices)}
+        for (i, j), string_score in string_scores.items():
+            embedding_score = float(embeddings[rows[i]] @ embeddings[rows[j]])
+            yield i, j, string_weight * string_score + (1 - string_weight) * embedding_score
+
+
+def resolve_label(db: NewsGraphClient, label: str, threshold: float = config.ENTITY_RESOLUTION_THRESHOLD,
+                  write_batch_size: int = 5_000) -> dict[str, int]:
+    """Resolves the entities of one label and writes the SAME_AS links, returns counts of what was done"""
+    table = load_entities(db, label)
+    index_by_uid = {uid: i for i, uid in enumerate(table.uids)}
+    clusters = UnionFind(len(table))
+    # Entities that are the target of SAME_AS links stay canonical if their cluster grows
+    current_targets = {}
+    for link in db.get_same_as_links(label):
+        variant, target = index_by_uid.get(link['variant_uid']), index_by_uid.get(link['canonical_uid'])
+        if variant is not None and target is not None:
+            clusters.union(variant, target)
+            current_targets[variant] = target
+    canonical = set(current_targets.values())
+
+    num_pairs, num_matches, scores = 0, 0, {}
+    for i, j, score in score_pairs(table, candidate_pairs(table)):
+        num_pairs += 1
+        if score >= threshold:
+            num_matches += 1
+            clusters.union(i, j)
+            scores[i] = max(scores.get(i, 0.0), score)
+            scores[j] = max(scores.get(j, 0.0), score)
+
+    members_by_root = defaultdict(list)
+    for i in range(len(table)):
+        members_by_root[clusters.find(i)].append(i)
+    links = []
+    for members in members_by_root.values():
+        if len(members) < 2:
+            continue
+        # The most mentioned entity, preferably one that already is canonical, represents the cluster
+        target = max(members, key=lambda i: (i in canonical, table.mentions[i], -len(table.names[i])))
+        # Links that already point to the right entity are not written again
+        links.extend(
+            {'variant_uid': table.uids[i], 'canonical_uid': table.uids[target], 'score': scores.get(i, 1.0)}
+            for i in members if i != target and current_targets.get(i) != target
+        )
+
+    # Entities are marked as resolved after all links were written, so an interrupted run is repeated
+    for link_batch in batched(links, write_batch_size):
+        db.write_same_as_links(label, link_batch)
+    resolved_uids = [uid for uid, resolved in zip(table.uids, table.resolved) if not resolved]
+    for uid_batch in batched(resolved_uids, write_batch_size):
+        db.mark_entities_resolved(label, uid_batch)
+    stats = {'entities': len(table), 'new_entities': len(resolved_uids), 'scored_pairs': num_pairs,
+             'matches': num_matches, 'links': len(links)}
+    for name, value in stats.items():
+        metrics.increment(f"entity_resolution_{name}", value, label=label)
+    return stats
+
+
+def main():
+    db = NewsGraphClient()
+    for label in MENTION_LABELS:
+        print(label, resolve_label(db, label))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,386 @@
+"""
+Stand-ins for the models, the graph and the LLM, so that the code paths can be benchmarked offline.
+
+The fakes return deterministic results and sleep for a configurable time that scales
+with the size of their inputs, roughly like the real services do.
+"""
+import random
+import time
+from collections import defaultdict
+from collections.abc import Iterator
+from datetime import datetime, timedelta
+from hashlib import blake2b
+from types import SimpleNamespace
+from typing import Optional
+
+import numpy as np
+from langchain_core.callbacks.manager import CallbackManagerForLLMRun
+from langchain_core.language_models.llms import LLM
+from langchain_core.outputs import GenerationChunk
+
+import config
+
+
+PERSONS = ['Olaf Scholz', 'Ursula von der Leyen', 'Emmanuel Macron', 'Giorgia Meloni', 'Keir Starmer', 'Ricarda Lang']
+ORGANIZATIONS = ['EU-Kommission', 'Bundestag', 'NATO', 'Volt', 'BRICS', 'Internationaler Währungsfonds']
+LOCATIONS = ['Berlin', 'Brüssel', 'Paris', 'London', 'Peking', 'Xiamen']
+ENTITY_LABELS = {
+    **{name: 'person' for name in PERSONS},
+    **{name: 'organization' for name in ORGANIZATIONS},
+    **{name: 'location' for name in LOCATIONS},
+}
+WORDS = (
+    'die regierung hat am montag neue pläne vorgestellt wirtschaft wachstum wahl parlament '
+    'the government announced new plans on monday economy growth election parliament '
+    'minister budget reform debate summit agreement crisis market policy vote coalition'
+).split()
+PUBLISHERS = ['Die Zeit', 'Der Spiegel', 'The Guardian', 'BBC', 'Focus Online']
+CYPHER_QUERY = (
+    "MATCH (a:Article)-[:CONTAINS]->(c:Chunk)-[:MENTIONS]->(p:Person) "
+    "WHERE p.name IN ['Olaf Scholz'] RETURN a.title, c.text"
+)
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // 4 + 1
+
+
+def make_sentence(rng: random.Random, num_words: int) -> str:
+    words = rng.choices(WORDS, k=num_words)
+    if rng.random() < 0.5:
+        words.insert(rng.randrange(len(words)), rng.choice(list(ENTITY_LABELS)))
+    return ' '.join(words).capitalize()
+
+
+def make_paragraph(rng: random.Random, min_sentences=2, max_sentences=12) -> str:
+    num_sentences = rng.randint(min_sentences, max_sentences)
+    return '. '.join(make_sentence(rng, rng.randint(6, 25)) for _ in range(num_sentences)) + '.'
+
+
+def make_corpus(num_articles: int, seed: int = 0) -> list[SimpleNamespace]:
+    """Returns synthetic articles with the attributes of fundus articles that the crawler reads"""
+    rng = random.Random(seed)
+    start_date = datetime(2024, 6, 1)
+    articles = []
+    for i in range(num_articles):
+        publisher = rng.choice(PUBLISHERS)
+        sections = [
+            SimpleNamespace(
+                headline=[make_sentence(rng, rng.randint(3, 8))] if section_idx else [],
+                # A few very long paragraphs exercise the splitting of over-long texts
+                paragraphs=[
+                    make_paragraph(rng, max_sentences=60 if rng.random() < 0.05 else 12)
+                    for _ in range(rng.randint(1, 6))
+                ]
+            )
+            for section_idx in range(rng.randint(1, 4))
+        ]
+        summary = [make_paragraph(rng, 1, 3)]
+        title = make_sentence(rng, rng.randint(5, 12))
+        article = SimpleNamespace(
+            title=title,
+            publishing_date=start_date + timedelta(hours=i),
+            lang=rng.choice(['de', 'en']),
+            authors=rng.sample(PERSONS, k=rng.randint(0, 2)),
+            body=SimpleNamespace(summary=summary, sections=sections),
+            html=SimpleNamespace(
+                responded_url=f"https://news.example/{publisher.lower().replace(' ', '-')}/{i}",
+                source_info=SimpleNamespace(publisher=publisher, type='online', url='https://news.example')
+            ),
+        )
+        article.plaintext = '\n'.join(
+            [*summary, *(text for section in sections for text in (*section.headline, *section.paragraphs))]
+        )
+        articles.append(article)
+    return articles
+
+
+def load_corpus(snapshot_directory: str, num_articles: int) -> list[SimpleNamespace]:
+    """Returns the first num_articles articles of a snapshot with the same attributes as make_corpus"""
+    from snapshot import Snapshot
+
+    snapshot = Snapshot(snapshot_directory)
+    articles = snapshot.table('articles').slice(0, num_articles).to_pylist()
+    uids = [article['uid'] for article in articles]
+    chunks_by_article = defaultdict(list)
+    for chunk in snapshot.table('chunks', filters=[('article_uid', 'in', uids)]).to_pylist():
+        chunks_by_article[chunk['article_uid']].append(chunk)
+    relationships = snapshot.table(
+        'relationships', columns=['type', 'start_uid', 'end_uid'],
+        filters=[('type', 'in', ['PUBLISHED', 'AUTHORED']), ('end_uid', 'in', uids)]
+    ).to_pylist()
+    sources = {source['uid']: source for source in snapshot.table('sources').to_pylist()}
+    persons = {
+        person['uid']: person['name']
+        for person in snapshot.table('entities', columns=['uid', 'name'], filters=[('label', '=', 'Person')]).to_pylist()
+    }
+    source_by_article, authors_by_article = {}, defaultdict(list)
+    for relationship in relationships:
+        if relationship['type'] == 'PUBLISHED':
+            source_by_article[relationship['end_uid']] = sources.get(relationship['start_uid'], {})
+        elif relationship['start_uid'] in persons:
+            authors_by_article[relationship['end_uid']].append(persons[relationship['start_uid']])
+
+    corpus = []
+    for article in articles:
+        chunks = sorted(chunks_by_article[article['uid']], key=lambda chunk: chunk['position'] or 0)
+        summary = [chunk['text'] for chunk in chunks if chunk['category'] == 'summary']
+        sections = defaultdict(lambda: SimpleNamespace(headline=[], paragraphs=[]))
+        for chunk in chunks:
+            if chunk['category'] == 'headline':
+                sections[chunk['section']].headline.append(chunk['text'])
+            elif chunk['category'] == 'paragraph':
+                sections[chunk['section']].paragraphs.append(chunk['text'])
+        source = source_by_article.get(article['uid'], {})
+        corpus.append(SimpleNamespace(
+            title=article['title'],
+            publishing_date=article['publishing_date'],
+            lang=article['language'],
+            authors=authors_by_article[article['uid']],
+            body=SimpleNamespace(summary=summary, sections=list(sections.values())),
+            html=SimpleNamespace(
+                responded_url=article['url'],
+                source_info=SimpleNamespace(publisher=source.get('name'), type=source.get('type'), url=source.get('url'))
+            ),
+            plaintext='\n'.join(chunk['text'] for chunk in chunks),
+        ))
+    return corpus
+
+
+class FakeTokenizer:
+    """Stand-in for the tokenizer of the embedding model with about four characters per token"""
+    def __call__(self, texts: list[str], add_special_tokens=True, **kwargs) -> dict[str, list[list[int]]]:
+        special_tokens = 2 if add_special_tokens else 0
+        return {'input_ids': [[0] * (estimate_tokens(text) + special_tokens) for text in texts]}
+
+
+class FakeEmbeddingModel:
+    """
+    Deterministic stand-in for the embedding model.
+
+    A call costs call_seconds plus token_seconds per token of the padded batch,
+    i.e. batch size times the longest text, like a transformer forward pass.
+    """
+    def __init__(self, dim: int = config.EMBEDDING_SIZE, call_seconds=0.005, token_seconds=2e-6):
+        self.dim = dim
+        self.call_seconds = call_seconds
+        self.token_seconds = token_seconds
+
+    def encode(self, sentences, max_length=2048, **kwargs) -> np.ndarray:
+        sentences = list(sentences)
+        longest = min(max_length, max((estimate_tokens(s) for s in sentences), default=0))
+        time.sleep(self.call_seconds + self.token_seconds * len(sentences) * longest)
+        return np.stack([self._vector(sentence) for sentence in sentences]) if sentences else np.zeros((0, self.dim))
+
+    def _vector(self, sentence: str) -> np.ndarray:
+        seed = int.from_bytes(blake2b(sentence.encode('utf-8'), digest_size=8).digest(), 'little')
+        return np.random.default_rng(seed).standard_normal(self.dim).astype(np.float32)
+
+
+class FakeGLiNER:
+    """Stand-in for GLiNER that finds the known entity names of the synthetic corpus"""
+    def __init__(self, call_seconds=0.01, token_seconds=2e-5):
+        self.call_seconds = call_seconds
+        self.token_seconds = token_seconds
+
+    def predict_entities(self, text: str, labels: list[str], threshold=0.5) -> list[dict]:
+        time.sleep(self.call_seconds + self.token_seconds * estimate_tokens(text))
+        return self._find(text, labels)
+
+    def batch_predict_entities(self, texts: list[str], labels: list[str], threshold=0.5) -> list[list[dict]]:
+        longest = max((estimate_tokens(text) for text in texts), default=0)
+        time.sleep(self.call_seconds + self.token_seconds * len(texts) * longest)
+        return [self._find(text, labels) for text in texts]
+
+    @staticmethod
+    def _find(text: str, labels: list[str]) -> list[dict]:
+        entities = []
+        for name, label in ENTITY_LABELS.items():
+            start = text.find(name)
+            if start >= 0 and label in labels:
+                entities.append({'text': name, 'label': label, 'start': start, 'end': start + len(name), 'score': 0.9})
+        return sorted(entities, key=lambda entity: entity['start'])
+
+
+class FakeRecord:
+    def __init__(self, data: dict):
+        self._data = data
+
+    def data(self) -> dict:
+        return dict(self._data)
+
+
+class FakeResult:
+    def __init__(self, records: list[dict], plan: dict | None = None):
+        self._records = records
+        self.plan = plan
+
+    def __iter__(self):
+        return (FakeRecord(record) for record in self._records)
+
+    def data(self) -> list[dict]:
+        return [dict(record) for record in self._records]
+
+    def consume(self):
+        return self
+
+
+class FakeGraph:
+    """
+    Recorded stand-in for langchain's Neo4jGraph and the driver sessions used by NewsGraphClient.
+
+    Every round trip sleeps round_trip_seconds plus row_seconds per parameter row, and the
+    queries are kept in self.statements. Answers are canned, based on what the query calls.
+    """
+    _database = 'neo4j'
+
+    def __init__(self, round_trip_seconds=0.002, row_seconds=2e-6, result_rows=200, seed=0):
+        self.round_trip_seconds = round_trip_seconds
+        self.row_seconds = row_seconds
+        self.statements: list[str] = []
+        self.round_trips = 0
+        rng = random.Random(seed)
+        self.result_rows = [
+            {'a.title': make_sentence(rng, 8), 'c.text': make_paragraph(rng)}
+            for _ in range(result_rows)
+        ]
+        self._driver = SimpleNamespace(session=self.session)
+
+    def query(self, query: str, params: dict | None = None) -> list[dict]:
+        self._round_trip()
+        return self._run(query, params or {}).data()
+
+    def session(self, database=None, fetch_size=None):
+        return FakeSession(self)
+
+    def _round_trip(self):
+        self.round_trips += 1
+        time.sleep(self.round_trip_seconds)
+
+    def _run(self, query: str, params: dict) -> FakeResult:
+        self.statements.append(query)
+        num_rows = sum(len(value) for value in params.values() if isinstance(value, list))
+        time.sleep(self.row_seconds * num_rows)
+        if query.startswith('EXPLAIN'):
+            return FakeResult([], plan={'operatorType': 'ProduceResults@neo4j', 'args': {'EstimatedRows': 50.0},
+                                        'children': []})
+        if 'apoc.meta.data' in query:
+            return FakeResult(self._meta_data())
+        if 'apoc.meta.stats' in query:
+            return FakeResult([{'labels': {'Article': 1000, 'Chunk': 20_000, 'Person': 500}}])
+        if 'db.labels()' in query:
+            return FakeResult([{'labels': ['Article', 'Chunk', 'Source', 'Person', 'Organization', 'Location'],
+                                'rel_types': ['CONTAINS', 'PUBLISHED', 'AUTHORED', 'MENTIONS']}])
+        if 'RETURN chunk.uid AS uid' in query:
+            return FakeResult(self._chunks(query, params))
+        if 'db.index.fulltext.queryNodes' in query:
+            return FakeResult(self._candidates(params))
+        if 'RETURN a.title as article_headline' in query:
+            return FakeResult([{'article_headline': 'title', 'a.uid': params.get('uid', 'Article:fake'),
+                                'num_paragraphs': len(params.get('chunks', [])), 'num_rels': 1,
+                                'source_name': 'source'}])
+        if 'UNWIND' in query:
+            return FakeResult([])
+        return FakeResult(self.result_rows)
+
+    @staticmethod
+    def _meta_data() -> list[dict]:
+        records = [
+            {'label': label, 'property': prop, 'type': 'STRING', 'other': [], 'elementType': 'node'}
+            for label, props in (('Article', ('title', 'url', 'uid')), ('Chunk', ('text', 'category', 'uid')),
+                                 ('Person', ('name', 'uid')), ('Organization', ('name', 'uid')))
+            for prop in props
+        ]
+        records.extend([
+            {'label': 'Article', 'property': 'CONTAINS', 'type': 'RELATIONSHIP', 'other': ['Chunk'], 'elementType': 'node'},
+            {'label': 'Chunk', 'property': 'MENTIONS', 'type': 'RELATIONSHIP', 'other': ['Person', 'Organization'],
+             'elementType': 'node'},
+            {'label': 'MENTIONS', 'property': 'count', 'type': 'INTEGER', 'other': [], 'elementType': 'relationship'},
+        ])
+        return records
+
+    def _chunks(self, query: str, params: dict) -> list[dict]:
+        k = params.get('k') or len(params.get('hits', []))
+        # Vector and fulltext search find overlapping chunks, as real retrievers would
+        offset = k // 2 if 'fulltext' in query else 0
+        return [
+            {'uid': f"Chunk:{i}", 'title': row['a.title'], 'text': row['c.text'], 'date': None,
+             'source': PUBLISHERS[i % len(PUBLISHERS)], 'url': f"https://example.com/{i}", 'score': 1.0 / (rank + 1)}
+            for rank, (i, row) in enumerate(
+                (i % len(self.result_rows), self.result_rows[i % len(self.result_rows)]) for i in range(offset, offset + k)
+            )
+        ]
+
+    @staticmethod
+    def _candidates(params: dict) -> list[dict]:
+        lookups = params.get('lookups') or [{'id': None, 'fulltext_query': params.get('fulltext_query', '')}]
+        records = []
+        for lookup in lookups:
+            name = lookup['fulltext_query'].split('~')[0]
+            for i in range(3):
+                record = {'uid': f"Person:{name}{i}", 'name': f"{name} {i}", 'label': 'Person', 'score': 1.0 / (i + 1)}
+                if lookup['id'] is not None:
+                    record['lookup_id'] = lookup['id']
+                records.append(record)
+        return records
+
+
+class FakeSession:
+    def __init__(self, graph: FakeGraph):
+        self.graph = graph
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def run(self, query: str, params: dict | None = None) -> FakeResult:
+        self.graph._round_trip()
+        return self.graph._run(query, params or {})
+
+    def execute_write(self, work):
+        # All statements of a transaction share one round trip
+        self.graph._round_trip()
+        return work(SimpleNamespace(run=lambda query, params=None: self.graph._run(query, params or {})))
+
+
+class StubLLM(LLM):
+    """Stand-in for Cortex that answers after a fixed latency, streaming at a fixed rate"""
+    latency: float = 0.3
+    token_seconds: float = 0.01
+    cypher_query: str = CYPHER_QUERY
+    answer: str = ' '.join(WORDS)
+
+    @property
+    def _llm_type(self) -> str:
+        return "stub"
+
+    def _call(
+        self,
+        prompt: str,
+        stop: Optional[list[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs
+    ) -> str:
+        response = self._response(prompt)
+        time.sleep(self.latency + self.token_seconds * len(response.split()))
+        return response
+
+    def _stream(
+        self,
+        prompt: str,
+        stop: Optional[list[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs
+    ) -> Iterator[GenerationChunk]:
+        time.sleep(self.latency)
+        for word in self._response(prompt).split():
+            time.sleep(self.token_seconds)
+            chunk = GenerationChunk(text=word + ' ')
+            if run_manager:
+                run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+
+    def _response(self, prompt: str) -> str:
+        return self.cypher_query if 'Cypher query:' in prompt else self.answer
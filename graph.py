@@ -1,4 +1,12 @@
+import json
+import logging
 import os
+import re
+import time
+from collections import Counter
+from dataclasses import asdict
+from datetime import datetime
+from pathlib import Path
 
 import numpy as np
 from fundus.scraping.article import Article
@@ -6,8 +14,14 @@ from fundus.scraping.html import SourceInfo
 from langchain.graphs import Neo4jGraph
 
 import config
-from schema import ArticleChunk, Entity, Iterable
-from utils import generate_short_uid, generate_full_text_query
+from ann_index import ChunkIndex
+from cache import TTLCache
+from metrics import log_slow_query, metrics
+from schema import ArticleChunk, Entity, GraphSchema, Iterable, ProcessedArticle
+from utils import batched, generate_short_uid, generate_full_text_query, remove_special_chars
+
+
+logger = logging.getLogger(__name__)
 
 
 # URI examples: "neo4j://localhost", "neo4j+s://xxx.databases.neo4j.io"
@@ -15,16 +29,44 @@ URI = os.getenv('DB_URL', 'neo4j://localhost:7687')
 USERNAME = os.getenv('DB_USERNAME', 'neo4j')
 PASSWORD = os.getenv('DB_PASSWORD', '<secret>')
 AUTH = (USERNAME, PASSWORD)
+MENTION_LABELS = tuple(label.title() for label in config.RELEVANT_LABELS)
+IDENTIFIER_PATTERN = re.compile(r'[A-Za-z_][A-Za-z0-9_]*')
+AGGREGATE_REL_TYPES = ('MENTIONS_ENTITY', 'MENTIONED_ON', 'CO_MENTIONED')
+AGGREGATE_PROPERTIES = ('mention_count', 'article_count', 'source_count')
+# Completes chunk searches that yield chunk and score, like the retrieval query of vector_index.ipynb
+CHUNK_RESULT_CLAUSE = (
+    "MATCH (chunk)<-[:CONTAINS]-(a:Article) "
+    "OPTIONAL MATCH (a)<-[:PUBLISHED]-(s:Source) "
+    "RETURN chunk.uid AS uid, a.title AS title, chunk.text AS text, a.publishing_date AS date, "
+    "s.name AS source, a.url AS url, score "
+    "ORDER BY score DESC"
+)
 
 
 class NewsGraphClient:
-    def __init__(self, uri:str=URI, user:str=USERNAME, password:str=PASSWORD, **db_kwargs):
-        self.graph = Neo4jGraph(
+    def __init__(self, uri:str=URI, user:str=USERNAME, password:str=PASSWORD,
+                 schema_cache_path:str|None=config.SCHEMA_CACHE_PATH, chunk_index: ChunkIndex|None=None,
+                 chunk_index_dir:str|None=config.CHUNK_INDEX_DIR, graph: Neo4jGraph|None=None, **db_kwargs):
+        # The verbose langchain schema is only computed on demand, prompts use get_schema()
+        db_kwargs.setdefault('refresh_schema', False)
+        # An existing graph, e.g. a stand-in for benchmarks, can be passed instead of connecting
+        self.graph = graph or Neo4jGraph(
             url=uri, 
             username=user, 
             password=password,
             **db_kwargs
         )
+        self.schema_cache_path = Path(schema_cache_path) if schema_cache_path else None
+        self._schema = None
+        self._schema_checked_at = 0.0
+        # Optional local ANN index that is kept up to date with the chunks written through this client,
+        # loaded from chunk_index_dir unless one is passed, see save_chunk_index and load_chunk_index
+        self.chunk_index_dir = Path(chunk_index_dir) if chunk_index_dir else None
+        if chunk_index is None and self.chunk_index_dir is not None:
+            chunk_index = load_chunk_index(self.chunk_index_dir)
+        self.chunk_index = chunk_index
+        self._candidate_cache = TTLCache(max_size=config.CANDIDATE_CACHE_SIZE, ttl=config.CANDIDATE_CACHE_TTL)
+        self.last_lookup_stats = {}
     
     def create_article(self, article: Article) -> str:
         query = (
@@ -42,7 +84,8 @@ class NewsGraphClient:
         article_id = records[0]['a.uid']
         return article_id
         
-    def merge_article_chunks(self, article_chunks: Iterable[ArticleChunk], article_id: str):
+    def merge_article_chunks(self, article_chunks: Iterable[ArticleChunk], article_id: str,
+                             publishing_date: datetime | None = None, source: str | None = None):
         query = (
             "MATCH (a:Article { uid: $uid}) "
             "WITH a "
@@ -51,12 +94,18 @@ class NewsGraphClient:
             "MERGE (a)-[:CONTAINS]->(p) "
             "RETURN a.title as article_headline, count(p) as num_paragraphs"
         )
-        records = self.query(query, chunks=[chunk.to_dict(serialize=True) for chunk in article_chunks], uid=article_id)
+        records = self.query(
+            query, chunks=[chunk.to_dict(serialize=True, include_embedding=False) for chunk in article_chunks], uid=article_id
+        )
         embeddings = {
             chunk.uid: chunk.embedding
             for chunk in article_chunks
         }
         _ = self.set_embeddings(embeddings)
+        if self.chunk_index is not None:
+            # Without date and source the chunks would never pass the filters of ChunkIndex.search
+            self.chunk_index.add_chunks(article_chunks, publishing_date, source)
+        self._note_written(['Article', 'Chunk'], ['CONTAINS'])
         return records[0]
 
     def merge_article_authors(self, authors: Iterable[str], article_id: str):
@@ -71,49 +120,219 @@ class NewsGraphClient:
         query = (
             "MATCH (a:Article { uid: $uid}) "
             "WITH a "
-            "MERGE (s:Source {name: $source.publisher, type: $source.type, url: $source.url}) "
-            f"ON CREATE SET s.uid = '{generate_short_uid('Source', config.UID_LEN)}' "
+            # A publisher has several feeds with their own type and url, it is one Source with the first of them
+            "MERGE (s:Source {name: $source.publisher}) "
+            f"ON CREATE SET s.uid = '{generate_short_uid('Source', config.UID_LEN)}', s.type = $source.type, s.url = $source.url "
             "MERGE (s)-[:PUBLISHED]->(a) "
             "RETURN a.title as article_headline, s.name as source_name"
         )
         records = self.query(query, source=source.__dict__, uid=article_id)
+        self._note_written(['Article', 'Source'], ['PUBLISHED'])
         return records[0]
 
-    def merge_mentioned_entities(self, mentioned_entities: Iterable[dict[str, str]], article_id: str):
+    def merge_mentioned_entities(self, mentioned_entities: Iterable[dict]):
+        """
+        Merges the mentioned entities and their MENTIONS relationships with a single statement.
+
+        Each mention needs the entity and the uid of the chunk it was found in.
+        Repeated mentions of an entity in a chunk are written once, with their number as count.
+        """
+        query, params = self._get_mention_statement(mentioned_entities)
+        records = self.query(query + " RETURN p.uid, e.uid", **params)
+        self._note_written(['Chunk', *MENTION_LABELS], ['MENTIONS'])
+        return records
+
+    @staticmethod
+    def _get_mention_statement(mentioned_entities: Iterable[dict]) -> tuple[str, dict]:
         query = (
-            "MATCH (a:Article { uid: $uid}) "
-            "WITH a "
-            "UNWIND $entities as entity "
-            "MERGE (e:Entity {name: entity.name}) "
-            # "ON CREATE CALL apoc.create.addLabels(e, [entity.label]) YIELD e "
-            "ON CREATE SET e.uid = entity.uid "
-            "WITH a, e, entity "
-            "MATCH (a)-[:CONTAINS]->(p:Chunk {position: entity.chunk}) "
-            "MERGE (p)-[:MENTIONS]->(e) "
-            "RETURN p.uid, e.uid"
-        )
-        persons, organizations, locations = [], [], []
-        for entity in mentioned_entities:
-            title_case_label = entity['entity'].label.title()
-            data = {
-                'name': entity['entity'].name,
-                'label': title_case_label,
-                'chunk': entity['chunk'],
-                'uid': generate_short_uid(title_case_label, config.UID_LEN)
+            "UNWIND $mentions as mention "
+            "MATCH (p:Chunk { uid: mention.chunk_uid}) "
+            "CALL apoc.merge.node([mention.label], {name: mention.name}, {uid: mention.uid}) YIELD node AS e "
+            "MERGE (p)-[r:MENTIONS]->(e) "
+            "SET r.count = mention.count"
+        )
+        # Labels are passed as data, so only known ones are allowed
+        mention_counts = Counter(
+            (mention['chunk_uid'], mention['entity'].name, mention['entity'].label.title())
+            for mention in mentioned_entities
+            if mention['entity'].label.title() in MENTION_LABELS
+        )
+        mentions = [
+            {
+                'chunk_uid': chunk_uid,
+                'name': name,
+                'label': label,
+                'count': count,
+                'uid': generate_short_uid(label, config.UID_LEN)
             }
-            if entity['entity'].label == 'person':
-                persons.append(data)
-            elif entity['entity'].label == 'organization':
-                organizations.append(data)
-            elif entity['entity'].label == 'location':
-                locations.append(data)
-
-        records = []
-        for entities, label in zip((persons, organizations, locations), ('Person', 'Organization', 'Location')):
-            new_records = self.query(query.replace('Entity', label), entities=entities, uid=article_id)
-            records.extend(new_records)
+            for (chunk_uid, name, label), count in mention_counts.items()
+        ]
+        return query, {'mentions': mentions}
 
-        return records
+    def ingest_articles(self, articles: Iterable[ProcessedArticle], batch_size:int=config.INGEST_BATCH_SIZE) -> list[str]:
+        """
+        Writes fully processed articles to the graph in bulk.
+
+        Each batch of articles is written by a few UNWIND statements within a single
+        transaction, instead of several round trips per article. Returns the article uids.
+        """
+        article_ids = []
+        for batch in batched(articles, batch_size):
+            statements = self._get_ingest_statements(batch)
+            if config.MAINTAIN_AGGREGATES:
+                statements.extend(self._get_aggregate_statements([article.uid for article in batch]))
+            self.run_in_transaction(statements)
+            article_ids.extend(article.uid for article in batch)
+            metrics.increment('articles_written', len(batch))
+            metrics.increment('chunks_written', sum(len(article.chunks) for article in batch))
+            metrics.increment('mentions_written', sum(len(article.mentioned_entities) for article in batch))
+            if self.chunk_index is not None:
+                for article in batch:
+                    self.chunk_index.add_chunks(article.chunks, article.publishing_date, article.source.get('publisher'))
+        self._note_written(
+            ['Article', 'Chunk', 'Source', 'Person', *MENTION_LABELS, *(['Day'] if config.MAINTAIN_AGGREGATES else [])],
+            ['CONTAINS', 'PUBLISHED', 'AUTHORED', 'MENTIONS', *(AGGREGATE_REL_TYPES if config.MAINTAIN_AGGREGATES else [])]
+        )
+        return article_ids
+
+    @staticmethod
+    def _get_aggregate_statements(article_uids: list[str]) -> list[tuple[str, dict]]:
+        """
+        Statements that add the mentions of newly written articles to the aggregates.
+
+        Each article must be counted exactly once, so they only run for articles that were just created.
+        """
+        entity_query = (
+            "UNWIND $article_uids AS article_uid "
+            "MATCH (a:Article {uid: article_uid})-[:CONTAINS]->(:Chunk)-[m:MENTIONS]->(e) "
+            "WITH a, e, sum(coalesce(m.count, 1)) AS mentions "
+            "SET e.mention_count = coalesce(e.mention_count, 0) + mentions, "
+            "    e.article_count = coalesce(e.article_count, 0) + 1 "
+            "WITH a, e, mentions WHERE a.publishing_date IS NOT NULL "
+            "MERGE (d:Day {date: date(a.publishing_date)}) "
+            "MERGE (e)-[r:MENTIONED_ON]->(d) "
+            "SET r.mention_count = coalesce(r.mention_count, 0) + mentions, "
+            "    r.article_count = coalesce(r.article_count, 0) + 1"
+        )
+        source_query = (
+            "UNWIND $article_uids AS article_uid "
+            "MATCH (s:Source)-[:PUBLISHED]->(a:Article {uid: article_uid})-[:CONTAINS]->(:Chunk)-[:MENTIONS]->(e) "
+            "WITH DISTINCT s, a, e "
+            "MERGE (s)-[r:MENTIONS_ENTITY]->(e) "
+            "ON CREATE SET e.source_count = coalesce(e.source_count, 0) + 1 "
+            "SET r.article_count = coalesce(r.article_count, 0) + 1"
+        )
+        # Pairs grow quadratically with the entities of an article, so only the most mentioned ones are paired
+        co_mention_query = (
+            "UNWIND $article_uids AS article_uid "
+            "MATCH (a:Article {uid: article_uid})-[:CONTAINS]->(:Chunk)-[m:MENTIONS]->(e) "
+            "WITH a, e, sum(coalesce(m.count, 1)) AS mentions ORDER BY mentions DESC "
+            "WITH a, collect(e)[..$max_entities] AS entities "
+            "UNWIND entities AS e1 "
+            "UNWIND entities AS e2 "
+            "WITH e1, e2 WHERE e1.uid < e2.uid "
+            "MERGE (e1)-[r:CO_MENTIONED]->(e2) "
+            "SET r.article_count = coalesce(r.article_count, 0) + 1"
+        )
+        params = {'article_uids': article_uids}
+        return [
+            (entity_query, params),
+            (source_query, params),
+            (co_mention_query, {**params, 'max_entities': config.AGGREGATE_MAX_CO_MENTIONED}),
+        ]
+
+    def rebuild_aggregates(self, batch_size=500) -> int:
+        """Drops and recomputes all aggregates from the articles in the graph, returns the number of articles"""
+        rel_types = '|'.join(AGGREGATE_REL_TYPES)
+        self.query(f"MATCH ()-[r:{rel_types}]->() CALL {{ WITH r DELETE r }} IN TRANSACTIONS OF 10000 ROWS")
+        self.query("MATCH (d:Day) CALL { WITH d DETACH DELETE d } IN TRANSACTIONS OF 10000 ROWS")
+        properties = ', '.join(f"e.{name}" for name in AGGREGATE_PROPERTIES)
+        self.query(
+            "MATCH (e) WHERE e.mention_count IS NOT NULL "
+            f"CALL {{ WITH e REMOVE {properties} }} IN TRANSACTIONS OF 10000 ROWS"
+        )
+        num_articles = 0
+        for article_uids in self._iter_article_uid_pages(batch_size):
+            self.run_in_transaction(self._get_aggregate_statements(article_uids))
+            num_articles += len(article_uids)
+        self._note_written(['Day', *MENTION_LABELS], AGGREGATE_REL_TYPES)
+        return num_articles
+
+    def _iter_article_uid_pages(self, page_size: int):
+        query = "MATCH (a:Article) WHERE a.uid > $after RETURN a.uid AS uid ORDER BY a.uid LIMIT $limit"
+        after = ''
+        while records := self.query(query, after=after, limit=page_size):
+            yield [record['uid'] for record in records]
+            after = records[-1]['uid']
+
+    def _get_ingest_statements(self, articles: list[ProcessedArticle]) -> list[tuple[str, dict]]:
+        article_query = (
+            "UNWIND $articles as article "
+            "CREATE (a:Article { title: article.title, publishing_date: article.date, language: article.language, url: article.url, uid: article.uid})"
+        )
+        chunk_query = (
+            "UNWIND $chunks as chunk "
+            "MATCH (a:Article { uid: chunk.article_uid}) "
+            "CREATE (p:Chunk {text: chunk.text, category: chunk.category, section: chunk.section, position: chunk.position, uid: chunk.uid}) "
+            "MERGE (a)-[:CONTAINS]->(p) "
+            "WITH p, chunk "
+            "CALL db.create.setNodeVectorProperty(p, 'embedding', chunk.embedding)"
+        )
+        source_query = (
+            "UNWIND $sources as source "
+            "MATCH (a:Article { uid: source.article_uid}) "
+            "MERGE (s:Source {name: source.publisher}) "
+            "ON CREATE SET s.uid = source.uid, s.type = source.type, s.url = source.url "
+            "MERGE (s)-[:PUBLISHED]->(a)"
+        )
+        author_query = (
+            "UNWIND $authors as author "
+            "MATCH (a:Article { uid: author.article_uid}) "
+            "MERGE (t:Person {name: author.name}) "
+            "ON CREATE SET t.uid = author.uid "
+            "MERGE (a)<-[:AUTHORED]-(t)"
+        )
+        articles_data, chunks, sources, authors, mentions = [], [], [], [], []
+        for article in articles:
+            articles_data.append({
+                'uid': article.uid,
+                'title': article.title,
+                'date': article.publishing_date,
+                'language': article.language,
+                'url': article.url
+            })
+            chunks.extend(
+                {
+                    'article_uid': article.uid,
+                    'text': chunk.text,
+                    'category': chunk.category.value,
+                    'section': chunk.section,
+                    'position': chunk.position,
+                    'uid': chunk.uid,
+                    # The driver packs numpy arrays directly, a float32 row view is passed without copying
+                    'embedding': np.asarray(chunk.embedding, dtype=np.float32)
+                }
+                for chunk in article.chunks
+            )
+            sources.append({
+                'article_uid': article.uid,
+                'uid': generate_short_uid('Source', config.UID_LEN),
+                **article.source
+            })
+            authors.extend(
+                {'article_uid': article.uid, 'name': author, 'uid': generate_short_uid('Person', config.UID_LEN)}
+                for author in article.authors
+            )
+            mentions.extend(article.mentioned_entities)
+
+        statements = [
+            (article_query, {'articles': articles_data}),
+            (chunk_query, {'chunks': chunks}),
+            (source_query, {'sources': sources}),
+            (author_query, {'authors': authors}),
+            self._get_mention_statement(mentions),
+        ]
+        return statements
 
     def set_embeddings(self, embeddings: dict[str, np.ndarray], node_type='Chunk', property_name='embedding'):
         query = (
@@ -137,14 +356,219 @@ class NewsGraphClient:
         records = self.query(query, article_ids=article_ids)
         return records
     
-    def lookup_mentioned_entities(self, entities: Iterable[Entity], per_entity_limit=10):
-        all_candidates = []
-        for entity in entities:
-            entity_candidates = self.get_entity_candidates(entity.name, f"{entity.label}Name", limit=per_entity_limit)
-            all_candidates.extend(entity_candidates)
-        
+    def iter_article_urls(self, page_size=10_000):
+        """Yields the URLs of all articles, fetched page by page"""
+        query = (
+            "MATCH (a:Article) WHERE a.uid > $after "
+            "RETURN a.uid AS uid, a.url AS url ORDER BY a.uid LIMIT $limit"
+        )
+        after = ''
+        while records := self.query(query, after=after, limit=page_size):
+            yield from (record['url'] for record in records if record['url'] is not None)
+            after = records[-1]['uid']
+
+    def iter_chunk_embeddings(self, page_size=5_000):
+        """Yields pages of chunk embeddings with the metadata used to filter retrieval"""
+        query = (
+            "MATCH (a:Article)-[:CONTAINS]->(c:Chunk) "
+            "WHERE c.embedding IS NOT NULL AND c.uid > $after "
+            "OPTIONAL MATCH (s:Source)-[:PUBLISHED]->(a) "
+            "RETURN c.uid AS uid, c.embedding AS embedding, c.category AS category, "
+            "a.publishing_date AS publishing_date, s.name AS source "
+            "ORDER BY c.uid LIMIT $limit"
+        )
+        after = ''
+        while records := self.query(query, after=after, limit=page_size):
+            yield records
+            after = records[-1]['uid']
+
+    def iter_entities(self, label: str, page_size=10_000):
+        """Yields pages of the entities of a mention label with their number of mentions and resolution state"""
+        _check_mention_label(label)
+        query = (
+            f"MATCH (e:{label}) WHERE e.uid > $after "
+            "RETURN e.uid AS uid, e.name AS name, COUNT { (e)<-[:MENTIONS]-() } AS mentions, "
+            "e.resolved_at IS NOT NULL AS resolved "
+            "ORDER BY e.uid LIMIT $limit"
+        )
+        after = ''
+        while records := self.query(query, after=after, limit=page_size):
+            yield records
+            after = records[-1]['uid']
+
+    def get_same_as_links(self, label: str) -> list[dict[str, str]]:
+        """Returns the existing SAME_AS links between entities of a label as variant and canonical uids"""
+        _check_mention_label(label)
+        query = (
+            f"MATCH (v:{label})-[:SAME_AS]->(c:{label}) "
+            "RETURN v.uid AS variant_uid, c.uid AS canonical_uid"
+        )
+        return self.query(query)
+
+    def write_same_as_links(self, label: str, links: list[dict]):
+        """
+        Links variant entities to their canonical entity of the same label.
+
+        A variant has at most one SAME_AS link, a link to a different canonical entity is replaced.
+        """
+        _check_mention_label(label)
+        query = (
+            "UNWIND $links AS link "
+            f"MATCH (v:{label} {{uid: link.variant_uid}}), (c:{label} {{uid: link.canonical_uid}}) "
+            "CALL { WITH v, c MATCH (v)-[old:SAME_AS]->(other) WHERE other <> c DELETE old } "
+            "MERGE (v)-[r:SAME_AS]->(c) "
+            "SET r.score = link.score"
+        )
+        self.query(query, links=links)
+        self._note_written([label], ['SAME_AS'])
+
+    def mark_entities_resolved(self, label: str, uids: list[str]):
+        _check_mention_label(label)
+        query = (
+            "UNWIND $uids AS uid "
+            f"MATCH (e:{label} {{uid: uid}}) "
+            "SET e.resolved_at = datetime()"
+        )
+        self.query(query, uids=uids)
+
+    def iter_nodes(self, label: str, properties: Iterable[str], page_size=10_000):
+        """Yields pages of the given properties of all nodes of a label, ordered by uid"""
+        properties = [name for name in properties if name != 'uid']
+        _check_identifier(label, *properties)
+        query = (
+            f"MATCH (n:{label}) WHERE n.uid > $after "
+            f"RETURN {''.join(f'n.{name} AS {name}, ' for name in properties)}n.uid AS uid "
+            "ORDER BY n.uid LIMIT $limit"
+        )
+        after = ''
+        while records := self.query(query, after=after, limit=page_size):
+            yield records
+            after = records[-1]['uid']
+
+    def iter_chunks(self, page_size=5_000):
+        """Yields pages of all chunks with the uid of their article and their embedding"""
+        query = (
+            "MATCH (a:Article)-[:CONTAINS]->(c:Chunk) WHERE c.uid > $after "
+            "RETURN c.uid AS uid, a.uid AS article_uid, c.text AS text, c.category AS category, "
+            "c.section AS section, c.position AS position, c.embedding AS embedding "
+            "ORDER BY c.uid LIMIT $limit"
+        )
+        after = ''
+        while records := self.query(query, after=after, limit=page_size):
+            yield records
+            after = records[-1]['uid']
+
+    def iter_relationships(self, start_label: str, rel_type: str, end_label: str, properties: Iterable[str] = (),
+                           page_size=10_000):
+        """Yields pages of the relationships of a type between two labels, paged by their start nodes"""
+        properties = list(properties)
+        _check_identifier(start_label, rel_type, end_label, *properties)
+        query = (
+            f"MATCH (s:{start_label}) WHERE s.uid > $after "
+            "WITH s ORDER BY s.uid LIMIT $limit "
+            f"OPTIONAL MATCH (s)-[r:{rel_type}]->(e:{end_label}) "
+            "RETURN s.uid AS start_uid, e.uid AS end_uid"
+            + ''.join(f", r.{name} AS {name}" for name in properties)
+        )
+        after = ''
+        while records := self.query(query, after=after, limit=page_size):
+            # Start nodes without relationships are returned once with end_uid null, to keep paging going
+            yield [record for record in records if record['end_uid'] is not None]
+            after = max(record['start_uid'] for record in records)
+
+    def create_nodes(self, label: str, rows: list[dict]):
+        """Creates one node of label per dict of properties, without checking for existing nodes"""
+        _check_identifier(label)
+        self.query(f"UNWIND $rows AS row CREATE (n:{label}) SET n = row", rows=rows)
+        self._note_written([label], [])
+
+    def create_chunks(self, rows: list[dict]):
+        """Creates chunks from dicts with article_uid, properties and embedding, which may be None"""
+        query = (
+            "UNWIND $rows AS row "
+            "MATCH (a:Article {uid: row.article_uid}) "
+            "CREATE (a)-[:CONTAINS]->(c:Chunk) SET c = row.properties "
+            "WITH c, row WHERE row.embedding IS NOT NULL "
+            "CALL db.create.setNodeVectorProperty(c, 'embedding', row.embedding)"
+        )
+        self.query(query, rows=rows)
+        self._note_written(['Article', 'Chunk'], ['CONTAINS'])
+
+    def create_relationships(self, start_label: str, rel_type: str, end_label: str, rows: list[dict]):
+        """Creates relationships from dicts with start_uid, end_uid and properties"""
+        _check_identifier(start_label, rel_type, end_label)
+        query = (
+            "UNWIND $rows AS row "
+            f"MATCH (s:{start_label} {{uid: row.start_uid}}) "
+            f"MATCH (e:{end_label} {{uid: row.end_uid}}) "
+            f"CREATE (s)-[r:{rel_type}]->(e) SET r = row.properties"
+        )
+        self.query(query, rows=rows)
+        self._note_written([start_label, end_label], [rel_type])
+
+    def lookup_mentioned_entities(self, entities: Iterable[Entity], per_entity_limit=10) -> list[dict[str, str]]:
+        """
+        Retrieves candidates for all entities with a single fulltext query.
+
+        Lookups are grouped by label index and answered from an in-process cache if possible.
+        Spelling variants linked by SAME_AS are replaced by their canonical entity, and candidates
+        found several times are returned once with their best score.
+        The latency of the last call is kept in self.last_lookup_stats.
+        """
+        start = time.perf_counter()
+        lookups = {
+            (f"{entity.label}Name", generate_full_text_query(entity.name), per_entity_limit)
+            for entity in entities
+        }
+        results = {lookup: self._candidate_cache.get(lookup) for lookup in lookups}
+        missing = sorted(lookup for lookup, candidates in results.items() if candidates is None)
+        if missing:
+            fetched = self._query_entity_candidates(missing)
+            for lookup in missing:
+                results[lookup] = fetched.get(lookup, [])
+                self._candidate_cache.set(lookup, results[lookup])
+
+        candidates_by_node = {}
+        for candidates in results.values():
+            for candidate in candidates:
+                node_key = candidate['uid'] or (candidate['label'], candidate['name'])
+                best = candidates_by_node.get(node_key)
+                if best is None or candidate['score'] > best['score']:
+                    candidates_by_node[node_key] = candidate
+        all_candidates = sorted(candidates_by_node.values(), key=lambda c: c['score'], reverse=True)
+        self.last_lookup_stats = {
+            'seconds': time.perf_counter() - start,
+            'lookups': len(lookups),
+            'cache_hits': len(lookups) - len(missing),
+            'candidates': len(all_candidates)
+        }
         return all_candidates
 
+    def _query_entity_candidates(self, lookups: list[tuple[str, str, int]]) -> dict[tuple, list[dict]]:
+        """Runs several (index, fulltext query, limit) lookups in one round trip"""
+        candidate_query = (
+            "UNWIND $lookups AS lookup "
+            "CALL { "
+            "  WITH lookup "
+            "  CALL db.index.fulltext.queryNodes(lookup.index, lookup.fulltext_query, {limit: lookup.limit}) "
+            "  YIELD node, score "
+            "  RETURN node, score "
+            "} "
+            # Resolved spelling variants are replaced by their canonical entity
+            "OPTIONAL MATCH (node)-[:SAME_AS]->(canonical) "
+            "WITH lookup, coalesce(canonical, node) AS node, score "
+            "RETURN lookup.id AS lookup_id, node.uid AS uid, node.name AS name, labels(node)[0] AS label, score"
+        )
+        params = [
+            {'id': i, 'index': index, 'fulltext_query': ft_query, 'limit': limit}
+            for i, (index, ft_query, limit) in enumerate(lookups)
+        ]
+        results = {}
+        for record in self.query(candidate_query, lookups=params):
+            lookup_id = record.pop('lookup_id')
+            results.setdefault(lookups[lookup_id], []).append(record)
+        return results
+
     def get_entity_candidates(self, input: str, index: str, limit=10) -> list[dict[str, str]]:
         """
         Taken from https://github.com/langchain-ai/langchain/blob/master/templates/neo4j-semantic-ollama/neo4j_semantic_ollama/utils.py
@@ -159,12 +583,147 @@ class NewsGraphClient:
         candidate_query = (
             "CALL db.index.fulltext.queryNodes($index, $fulltext_query, {limit: $limit}) "
             "YIELD node, score "
-            "RETURN node.uid AS uid, node.name AS name, labels(node)[0] AS label, score"
+            "OPTIONAL MATCH (node)-[:SAME_AS]->(canonical) "
+            "WITH coalesce(canonical, node) AS node, max(score) AS score "
+            "RETURN node.uid AS uid, node.name AS name, labels(node)[0] AS label, score "
+            "ORDER BY score DESC"
         )
         ft_query = generate_full_text_query(input)
         candidates = self.query(candidate_query, fulltext_query=ft_query, index=index, limit=limit)
         return candidates
 
+    def save_chunk_index(self):
+        """Writes the chunk index with the chunks added since it was loaded back to chunk_index_dir"""
+        if self.chunk_index is not None and self.chunk_index_dir is not None:
+            self.chunk_index.save(self.chunk_index_dir)
+
+    def vector_search_chunks(self, embedding: np.ndarray, k=10) -> list[dict]:
+        """
+        Returns the k chunks most similar to an embedding, best first, with their article and source.
+
+        Uses the in-process chunk index if there is one, the chunkEmbedding vector index otherwise.
+        """
+        embedding = np.asarray(embedding, dtype=np.float32)
+        if self.chunk_index is not None:
+            hits = [{'uid': uid, 'score': score} for uid, score in self.chunk_index.search(embedding, k=k)]
+            query = (
+                "UNWIND $hits AS hit "
+                "MATCH (chunk:Chunk {uid: hit.uid}) "
+                "WITH chunk, hit.score AS score "
+            )
+            return self.query(query + CHUNK_RESULT_CLAUSE, hits=hits)
+        query = (
+            "CALL db.index.vector.queryNodes('chunkEmbedding', $k, $embedding) "
+            "YIELD node AS chunk, score "
+        )
+        return self.query(query + CHUNK_RESULT_CLAUSE, k=k, embedding=embedding)
+
+    def fulltext_search_chunks(self, text: str, k=10) -> list[dict]:
+        """Returns the k chunks that match the words of text best in the chunkText fulltext index"""
+        # Questions are long compared to entity names, so words are matched exactly and any of them may match.
+        # Lower case keeps words like AND from being read as operators, the index is case-insensitive anyway
+        ft_query = ' OR '.join(remove_special_chars(text.casefold()).split())
+        if not ft_query:
+            return []
+        query = (
+            "CALL db.index.fulltext.queryNodes('chunkText', $fulltext_query, {limit: $k}) "
+            "YIELD node AS chunk, score "
+        )
+        return self.query(query + CHUNK_RESULT_CLAUSE, fulltext_query=ft_query, k=k)
+
+    def get_schema(self, refresh=False, include_counts=True) -> GraphSchema:
+        """
+        Returns a compact schema of the graph for use in prompts.
+
+        The schema is computed once and cached in memory and on disk. A cached schema is
+        reused as long as the database has the same labels and relationship types, which is
+        checked on load and every config.SCHEMA_CHECK_INTERVAL seconds, its node counts are
+        refreshed with each check.
+        """
+        if refresh:
+            self._schema = None
+        elif self._schema is None:
+            self._schema = self._load_cached_schema()
+        elif time.monotonic() - self._schema_checked_at > config.SCHEMA_CHECK_INTERVAL:
+            if not self._check_schema(self._schema):
+                self._schema = None
+        if self._schema is None:
+            self._schema = self._compute_schema(include_counts=include_counts)
+            self._schema_checked_at = time.monotonic()
+            self._save_cached_schema(self._schema)
+        return self._schema
+
+    def _compute_schema(self, include_counts=True) -> GraphSchema:
+        meta_query = (
+            "CALL apoc.meta.data() YIELD label, other, elementType, type, property "
+            "RETURN label, other, elementType, type, property"
+        )
+        node_properties, relationships, relationship_properties = {}, [], {}
+        for record in self.query(meta_query):
+            if record['elementType'] == 'relationship':
+                if record['property'] and record['property'] not in config.SCHEMA_EXCLUDED_PROPERTIES:
+                    relationship_properties.setdefault(record['label'], {})[record['property']] = record['type']
+            elif record['type'] == 'RELATIONSHIP':
+                relationships.extend(
+                    (record['label'], record['property'], other) for other in record['other']
+                )
+            elif record['property'] not in config.SCHEMA_EXCLUDED_PROPERTIES:
+                node_properties.setdefault(record['label'], {})[record['property']] = record['type']
+        node_counts = self._query_node_counts(node_properties) if include_counts else {}
+        return GraphSchema(node_properties=node_properties, relationships=relationships, node_counts=node_counts,
+                           relationship_properties=relationship_properties)
+
+    def _load_cached_schema(self) -> GraphSchema | None:
+        if self.schema_cache_path is None or not self.schema_cache_path.exists():
+            return None
+        data = json.loads(self.schema_cache_path.read_text())
+        schema = GraphSchema(
+            node_properties=data['node_properties'],
+            relationships=[tuple(rel) for rel in data['relationships']],
+            node_counts=data['node_counts'],
+            relationship_properties=data.get('relationship_properties', {})
+        )
+        return schema if self._check_schema(schema) else None
+
+    def _check_schema(self, schema: GraphSchema) -> bool:
+        """Tells whether the schema still has all labels and relationship types, refreshes its node counts"""
+        # Two cheap procedure calls tell whether the cached schema is still complete, the subquery
+        # returns one row even if the database has no relationship types
+        records = self.query(
+            "CALL db.labels() YIELD label WITH collect(label) AS labels "
+            "CALL { CALL db.relationshipTypes() YIELD relationshipType RETURN collect(relationshipType) AS rel_types } "
+            "RETURN labels, rel_types"
+        )
+        if not records:
+            return False
+        if not (set(records[0]['labels']) <= schema.labels and set(records[0]['rel_types']) <= schema.relationship_types):
+            return False
+        if schema.node_counts:
+            # Counts change with every ingest, they are read from the count store and cost next to nothing
+            schema.node_counts = self._query_node_counts(schema.node_properties)
+        self._schema_checked_at = time.monotonic()
+        return True
+
+    def _query_node_counts(self, labels: Iterable[str]) -> dict[str, int]:
+        records = self.query("CALL apoc.meta.stats() YIELD labels RETURN labels")
+        if not records:
+            return {}
+        labels = set(labels)
+        return {label: count for label, count in records[0]['labels'].items() if label in labels}
+
+    def _save_cached_schema(self, schema: GraphSchema):
+        if self.schema_cache_path is not None:
+            self.schema_cache_path.write_text(json.dumps(asdict(schema)))
+
+    def _note_written(self, labels: Iterable[str], rel_types: Iterable[str]):
+        """Invalidates the cached schema if a write may have added labels or relationship types"""
+        if self._schema is None:
+            return
+        if not (set(labels) <= self._schema.labels and set(rel_types) <= self._schema.relationship_types):
+            self._schema = None
+            if self.schema_cache_path is not None:
+                self.schema_cache_path.unlink(missing_ok=True)
+
     def setup_indexes(self):
         self.setup_performance_indexes()
         self.setup_fulltext_indexes()
@@ -175,22 +734,33 @@ class NewsGraphClient:
             (label, 'uid', True) for label
             in ('Article', 'Chunk', 'Person', 'Organization', 'Location', 'Source', 'Topic')
         ]
+        index_list.append(('Day', 'date', True))
         index_list.extend(
             (label, 'name', True) for label
             in ('Person', 'Organization', 'Location', 'Source', 'Topic')
         )
+        # Article urls are not unique, without incremental crawling an article can be crawled again
         index_list.extend((
-            ('Article', 'url', True),
+            ('Article', 'url', False),
             ('Article', 'title', False),
             ('Article', 'publishing_date', False),
             ('Chunk', 'category', False)
         ))
+        index_names = {f"{label.lower()}_{property_name}_index" for label, property_name, _ in index_list}
+        # Graphs set up by earlier versions have these indexes on a property named after the index,
+        # IF NOT EXISTS would keep them, so they are dropped and created on the right property
+        for record in self.query("SHOW INDEXES YIELD name, properties, owningConstraint"):
+            if record['name'] in index_names and record['properties'] == [record['name']]:
+                if record['owningConstraint']:
+                    self.query(f"DROP CONSTRAINT {record['owningConstraint']} IF EXISTS")
+                else:
+                    self.query(f"DROP INDEX {record['name']} IF EXISTS")
         for label, property_name, is_unique in index_list:
             index_name = f"{label.lower()}_{property_name}_index"
             query = (
                 f"CREATE {'CONSTRAINT' if is_unique else 'INDEX'} {index_name} "
                 f"IF NOT EXISTS FOR (n:{label}) "
-                f"{'REQUIRE' if is_unique else 'ON'} (n.{index_name}){' IS UNIQUE' if is_unique else ''}"
+                f"{'REQUIRE' if is_unique else 'ON'} (n.{property_name}){' IS UNIQUE' if is_unique else ''}"
             )
             _ = self.query(query)
         
@@ -233,8 +803,77 @@ class NewsGraphClient:
             "RETURN a.title as article_headline, count(t) as num_rels"
         )
         records = self.query(query, iterable=iterable_with_ids, uid=article_id)
+        self._note_written(['Article', node_type], [rel_type])
         return records[0]
 
+    def run_in_transaction(self, statements: Iterable[tuple[str, dict]]) -> list[list[dict]]:
+        """Runs several (query, params) pairs within a single write transaction"""
+        statements = list(statements)
+
+        def work(tx):
+            return [tx.run(query, params).data() for query, params in statements]
+
+        start = time.perf_counter()
+        with self.graph._driver.session(database=self.graph._database) as session:
+            results = session.execute_write(work)
+        self._note_query_time(
+            '\n'.join(query for query, _ in statements),
+            {key: value for _, params in statements for key, value in params.items()},
+            time.perf_counter() - start, kind='transaction'
+        )
+        return results
+
+    def explain(self, query, **params) -> dict:
+        """Returns the plan of a query without running it"""
+        start = time.perf_counter()
+        with self.graph._driver.session(database=self.graph._database) as session:
+            plan = session.run("EXPLAIN " + query, params).consume().plan
+        self._note_query_time(query, params, time.perf_counter() - start, kind='explain')
+        return plan
+
+    def iter_query(self, query, fetch_size=100, **params):
+        """Yields the records of a query as they are fetched instead of loading all of them at once"""
+        start = time.perf_counter()
+        try:
+            with self.graph._driver.session(database=self.graph._database, fetch_size=fetch_size) as session:
+                for record in session.run(query, params):
+                    yield record.data()
+        finally:
+            # Includes the time the consumer spent between records, as the query stays open meanwhile
+            self._note_query_time(query, params, time.perf_counter() - start, kind='stream')
+
     def query(self, query, **params):
         """Simple wrapper around self.graph.query"""
-        return self.graph.query(query=query, params=params)
\ No newline at end of file
+        start = time.perf_counter()
+        records = self.graph.query(query=query, params=params)
+        self._note_query_time(query, params, time.perf_counter() - start)
+        return records
+
+    @staticmethod
+    def _note_query_time(query: str, params: dict, seconds: float, kind='query'):
+        metrics.observe('neo4j_query', seconds, kind=kind)
+        threshold = config.SLOW_TRANSACTION_SECONDS if kind == 'transaction' else config.SLOW_QUERY_SECONDS
+        log_slow_query(query, params, seconds, kind=kind, threshold=threshold)
+
+
+def _check_mention_label(label: str):
+    # Labels cannot be query parameters, so only known ones are put into queries
+    if label not in MENTION_LABELS:
+        raise ValueError(f"Unknown entity label {label}, use one of {MENTION_LABELS}")
+
+
+def _check_identifier(*names: str):
+    # Labels, relationship types and property names cannot be query parameters
+    for name in names:
+        if not IDENTIFIER_PATTERN.fullmatch(name):
+            raise ValueError(f"Invalid label, relationship type or property name {name!r}")
+
+
+def load_chunk_index(directory: str | Path) -> ChunkIndex | None:
+    """Loads the chunk index saved in directory, None if it was not built yet"""
+    if (Path(directory) / 'sources.json').exists():
+        return ChunkIndex.load(directory)
+    # An empty index would answer every search with nothing instead of falling back to the vector index
+    logger.warning("No chunk index in %s, vector search uses the chunkEmbedding index. Build it with "
+                   "ChunkIndex.build_from_graph and save it there to use it", directory)
+    return None
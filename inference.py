@@ -0,0 +1,247 @@
+"""
+Inference backends for the embedding and NER models on CPU.
+
+The embedding model can be exported once to ONNX and run with ONNX Runtime, optionally with
+dynamically int8-quantised weights. GLiNER runs in PyTorch, its linear layers can be
+quantised to int8. Exported models are kept in config.ONNX_MODEL_DIR, in a directory per
+checkpoint and pinned revision. Whenever the optimised backend is unavailable, the PyTorch
+model is used instead.
+
+    python inference.py export --int8  # export the embedding model
+    python inference.py check --int8   # compare the optimised models with the reference models
+"""
+import argparse
+import json
+import logging
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+import config
+from utils import batched
+
+
+logger = logging.getLogger(__name__)
+
+SAMPLE_TEXTS = [
+    "Bundeskanzler Olaf Scholz hat sich in Berlin mit dem französischen Präsidenten Emmanuel Macron getroffen.",
+    "Die EU-Kommission unter Ursula von der Leyen legte am Mittwoch in Brüssel neue Vorschläge zur Migrationspolitik vor.",
+    "Die Türkei hat über eine mögliche Mitgliedschaft in der BRICS-Gruppe gesprochen, sagte Außenminister Hakan Fidan in Peking.",
+    "Prime Minister Keir Starmer met NATO Secretary General Jens Stoltenberg in London on Thursday.",
+    "Volt gewann bei der Europawahl in Deutschland drei Sitze im Europäischen Parlament.",
+    "Der Internationale Währungsfonds senkte seine Wachstumsprognose für die Eurozone.",
+    "Giorgia Meloni said Italy would support the agreement reached at the summit in Rome.",
+    "Politikwissenschaftler Berthold Kuhn lebt in Xiamen und berät internationale Organisationen.",
+]
+
+
+def artifact_dir(checkpoint: str, revision: str) -> Path:
+    return Path(config.ONNX_MODEL_DIR) / f"{checkpoint.replace('/', '--')}@{revision}"
+
+
+def set_torch_threads():
+    if config.EMBEDDING_NUM_THREADS:
+        import torch
+
+        torch.set_num_threads(config.EMBEDDING_NUM_THREADS)
+
+
+def load_torch_embedding_model():
+    # Importing transformers alone takes seconds, so it is deferred until the model is needed
+    from transformers import AutoModel
+
+    set_torch_threads()
+    # trust_remote_code is needed to use the encode method
+    return AutoModel.from_pretrained(
+        config.EMBEDDING_MODEL_CHECKPOINT,
+        trust_remote_code=True,
+        revision=config.EMBEDDING_MODEL_HASH
+    )
+
+
+class OnnxEmbeddingModel:
+    """
+    OnnxEmbeddingModel runs an exported embedding model with ONNX Runtime.
+
+    encode mirrors the encode method of the jina models: the token embeddings of a batch are
+    mean-pooled over the attention mask.
+    """
+    def __init__(self, model_path: str | Path, tokenizer, num_threads: int = config.EMBEDDING_NUM_THREADS):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(str(model_path), options, providers=['CPUExecutionProvider'])
+        self.input_names = [model_input.name for model_input in self.session.get_inputs()]
+        self.tokenizer = tokenizer
+
+    def encode(self, sentences, max_length=2048, batch_size=32, **kwargs) -> np.ndarray:
+        embeddings = []
+        for batch in batched(sentences, batch_size):
+            inputs = self.tokenizer(batch, padding=True, truncation=True, max_length=max_length, return_tensors='np')
+            token_embeddings = self.session.run(
+                None, {name: inputs[name].astype(np.int64) for name in self.input_names}
+            )[0]
+            mask = inputs['attention_mask'][..., None].astype(np.float32)
+            embeddings.append((token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None))
+        if not embeddings:
+            return np.empty((0, config.EMBEDDING_SIZE), dtype=np.float32)
+        return np.concatenate(embeddings)
+
+
+def export_embedding_model(quantize_int8: bool = config.INFERENCE_QUANTIZE_INT8) -> Path:
+    """Exports the embedding model to ONNX unless it was exported before and returns the path of the model file"""
+    import torch
+    from transformers import AutoTokenizer
+
+    directory = artifact_dir(config.EMBEDDING_MODEL_CHECKPOINT, config.EMBEDDING_MODEL_HASH)
+    model_path = directory / 'model.onnx'
+    if not model_path.exists():
+        directory.mkdir(parents=True, exist_ok=True)
+        model = load_torch_embedding_model().eval()
+        tokenizer = AutoTokenizer.from_pretrained(config.EMBEDDING_MODEL_CHECKPOINT, revision=config.EMBEDDING_MODEL_HASH)
+        sample = tokenizer(SAMPLE_TEXTS[:2], padding=True, return_tensors='pt')
+        tmp_path = directory / 'model.onnx.tmp'
+        with torch.no_grad():
+            torch.onnx.export(
+                model, (sample['input_ids'], sample['attention_mask']), str(tmp_path),
+                input_names=['input_ids', 'attention_mask'], output_names=['last_hidden_state'],
+                dynamic_axes={
+                    'input_ids': {0: 'batch', 1: 'sequence'},
+                    'attention_mask': {0: 'batch', 1: 'sequence'},
+                    'last_hidden_state': {0: 'batch', 1: 'sequence'},
+                },
+                opset_version=17,
+            )
+        tmp_path.replace(model_path)
+        logger.info("Exported %s to %s", config.EMBEDDING_MODEL_CHECKPOINT, model_path)
+    if not quantize_int8:
+        return model_path
+
+    quantized_path = directory / 'model.int8.onnx'
+    if not quantized_path.exists():
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        quantize_dynamic(str(model_path), str(quantized_path), weight_type=QuantType.QInt8)
+        logger.info("Quantized %s to int8 in %s", model_path, quantized_path)
+    return quantized_path
+
+
+def load_onnx_embedding_model(tokenizer, quantize_int8: bool = config.INFERENCE_QUANTIZE_INT8) -> OnnxEmbeddingModel | None:
+    """Loads the exported embedding model, exporting it first if needed, or returns None if that fails"""
+    try:
+        return OnnxEmbeddingModel(export_embedding_model(quantize_int8=quantize_int8), tokenizer)
+    except Exception as e:
+        logger.warning("ONNX embedding model unavailable, falling back to PyTorch: %s", e)
+        return None
+
+
+def load_ner_model(checkpoint: str, revision: str, quantize_int8: bool = config.INFERENCE_QUANTIZE_INT8):
+    """
+    Loads GLiNER, with int8 weights in its linear layers if quantize_int8 is set.
+
+    GLiNER's span decoding is Python code around the network, so it stays in PyTorch
+    and only the matrix multiplications are quantised.
+    """
+    # Importing gliner pulls in torch and transformers, so it is deferred until a model is loaded
+    from gliner import GLiNER
+
+    set_torch_threads()
+    model = GLiNER.from_pretrained(checkpoint, revision=revision)
+    if quantize_int8:
+        model = quantize_torch_model(model)
+    return model
+
+
+def quantize_torch_model(model):
+    import torch
+
+    try:
+        return torch.quantization.quantize_dynamic(model.eval(), {torch.nn.Linear}, dtype=torch.qint8)
+    except Exception as e:
+        logger.warning("Dynamic quantisation failed, using the full-precision model: %s", e)
+        return model
+
+
+def check_accuracy(texts: list[str], quantize_int8: bool = config.INFERENCE_QUANTIZE_INT8,
+                   repeat: int = 3) -> dict:
+    """Compares embeddings and entity spans of the optimised models with the PyTorch reference models"""
+    from transformers import AutoTokenizer
+
+    import ner
+
+    report = {}
+    tokenizer = AutoTokenizer.from_pretrained(config.EMBEDDING_MODEL_CHECKPOINT, revision=config.EMBEDDING_MODEL_HASH)
+    reference = load_torch_embedding_model()
+    candidate = OnnxEmbeddingModel(export_embedding_model(quantize_int8=quantize_int8), tokenizer)
+    (reference_embeddings, reference_seconds), (candidate_embeddings, candidate_seconds) = (
+        _timed(lambda: np.asarray(model.encode(texts, max_length=2048)), repeat) for model in (reference, candidate)
+    )
+    similarities = (
+        (reference_embeddings * candidate_embeddings).sum(axis=1)
+        / (np.linalg.norm(reference_embeddings, axis=1) * np.linalg.norm(candidate_embeddings, axis=1))
+    )
+    report['embedding'] = {
+        'min_cosine_similarity': float(similarities.min()),
+        'mean_cosine_similarity': float(similarities.mean()),
+        'speedup': reference_seconds / candidate_seconds,
+    }
+    report['embedding']['passed'] = report['embedding']['min_cosine_similarity'] >= config.INFERENCE_MIN_COSINE_SIMILARITY
+
+    if quantize_int8:
+        labels = [label.lower() for label in config.RELEVANT_LABELS]
+        reference = load_ner_model(ner.PRETRAINED_CHECKPOINT, ner.REVISION, quantize_int8=False)
+        candidate = load_ner_model(ner.PRETRAINED_CHECKPOINT, ner.REVISION, quantize_int8=True)
+        (reference_entities, reference_seconds), (candidate_entities, candidate_seconds) = (
+            _timed(lambda: model.batch_predict_entities(texts, labels, threshold=0.5), repeat)
+            for model in (reference, candidate)
+        )
+        reference_spans = {(i, e['start'], e['end'], e['label']) for i, ents in enumerate(reference_entities) for e in ents}
+        candidate_spans = {(i, e['start'], e['end'], e['label']) for i, ents in enumerate(candidate_entities) for e in ents}
+        matches = len(reference_spans & candidate_spans)
+        precision = matches / len(candidate_spans) if candidate_spans else 1.0
+        recall = matches / len(reference_spans) if reference_spans else 1.0
+        report['ner'] = {
+            'reference_spans': len(reference_spans),
+            'span_f1': 2 * precision * recall / (precision + recall) if precision + recall else 0.0,
+            'speedup': reference_seconds / candidate_seconds,
+        }
+        report['ner']['passed'] = report['ner']['span_f1'] >= config.INFERENCE_MIN_SPAN_F1
+    return report
+
+
+def _timed(func, repeat: int):
+    """Returns the result of func and the fastest of repeat runs in seconds"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return result, best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export and check the optimised inference models')
+    parser.add_argument('command', choices=['export', 'check'])
+    parser.add_argument('--int8', action='store_true', default=config.INFERENCE_QUANTIZE_INT8,
+                        help='use dynamically int8-quantised weights')
+    parser.add_argument('--texts-file', help='file with one text per line to check with, sample texts by default')
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        print(export_embedding_model(quantize_int8=args.int8))
+        return
+    texts = Path(args.texts_file).read_text().splitlines() if args.texts_file else SAMPLE_TEXTS
+    report = check_accuracy([text for text in texts if text.strip()], quantize_int8=args.int8)
+    print(json.dumps(report, indent=2))
+    if not all(result['passed'] for result in report.values()):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()
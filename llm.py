@@ -1,23 +1,49 @@
 # Taken from https://github.com/b-art-b/langchain-snowpoc/tree/main/langchain_snowpoc
 # Copyright lies with the initial creator, MIT licence does not apply to this part of the source
 
+import asyncio
 import logging
+import threading
+import time
+from collections.abc import Iterator
 from typing import Optional
 
-from langchain_core.callbacks.manager import CallbackManagerForLLMRun
+import snowflake.connector
+from langchain_core.callbacks.manager import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
 from langchain_core.language_models.llms import LLM
 from langchain_core.messages import AIMessage
+from langchain_core.outputs import GenerationChunk
+from langchain_core.pydantic_v1 import PrivateAttr
 from snowflake import snowpark
 from snowflake.connector.connection import SnowflakeConnection
+from snowflake.connector.errors import OperationalError
 from snowflake.cortex import Complete
+from snowflake.snowpark.exceptions import SnowparkSessionException
+
+from context_builder import estimate_tokens
+from metrics import metrics
 
 logger = logging.getLogger(__name__)
 
+# Errors after which a call is retried once with a fresh session
+RECONNECT_ERRORS = (OperationalError, SnowparkSessionException)
+
 
 class Cortex(LLM):
     connection: SnowflakeConnection = None
+    # If given, a closed connection is re-established with these parameters
+    connection_params: Optional[dict] = None
 
     model: str = "mistral-7b"
+    # Max. number of idle Snowpark sessions kept for reuse
+    pool_size: int = 4
+    # Idle sessions older than this (in seconds) are checked before they are reused
+    health_check_interval: float = 300.0
+    # Seconds between status checks of asynchronous completions
+    poll_interval: float = 0.1
+
+    _idle_sessions: list = PrivateAttr(default_factory=list)
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
 
     @property
     def _llm_type(self) -> str:
@@ -33,12 +59,161 @@ class Cortex(LLM):
         if stop is not None:
             raise ValueError("stop kwargs are not permitted.")
 
-        res = Complete(
-            self.model,
-            prompt,
-            snowpark.Session.builder.configs({"connection": self.connection}).create(),
-        )
-        return res
+        for attempt in range(2):
+            session = self._acquire_session(fresh=attempt > 0)
+            try:
+                with metrics.span('cortex_complete', model=self.model, mode='call'):
+                    res = Complete(self.model, prompt, session)
+            except RECONNECT_ERRORS:
+                self._discard_session(session)
+                if attempt:
+                    raise
+                logger.warning("Cortex call failed on a broken session, retrying with a new one")
+                continue
+            except Exception:
+                self._discard_session(session)
+                raise
+            self._release_session(session)
+            self._count_tokens(prompt, res)
+            return res
+
+    async def _acall(
+        self,
+        prompt: str,
+        stop: Optional[list[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs
+    ) -> str:
+        """Submits the completion as an asynchronous query and awaits its result without blocking a thread"""
+        if stop is not None:
+            raise ValueError("stop kwargs are not permitted.")
+
+        for attempt in range(2):
+            session = await asyncio.to_thread(self._acquire_session, fresh=attempt > 0)
+            job = None
+            try:
+                # Every status check is a round trip to Snowflake, so it runs in a worker thread, not on the event loop
+                job = await asyncio.to_thread(
+                    session.sql("SELECT SNOWFLAKE.CORTEX.COMPLETE(?, ?)", params=[self.model, prompt]).collect_nowait
+                )
+                start = time.perf_counter()
+                while not await asyncio.to_thread(job.is_done):
+                    await asyncio.sleep(self.poll_interval)
+                res = (await asyncio.to_thread(job.result))[0][0]
+                metrics.observe('cortex_complete', time.perf_counter() - start, model=self.model, mode='async')
+            except RECONNECT_ERRORS:
+                self._discard_session(session)
+                if attempt:
+                    raise
+                logger.warning("Cortex call failed on a broken session, retrying with a new one")
+                continue
+            except BaseException:
+                # Also reached when the awaiting task is cancelled, the query must not keep running in Snowflake
+                if job is not None:
+                    await asyncio.to_thread(self._cancel_job, job)
+                self._discard_session(session)
+                raise
+            self._release_session(session)
+            self._count_tokens(prompt, res)
+            return res
+
+    def _stream(
+        self,
+        prompt: str,
+        stop: Optional[list[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs
+    ) -> Iterator[GenerationChunk]:
+        """Yields the answer in pieces as Cortex generates it"""
+        if stop is not None:
+            raise ValueError("stop kwargs are not permitted.")
+
+        session = self._acquire_session()
+        start = time.perf_counter()
+        completion_tokens = 0
+        is_broken = False
+        try:
+            tokens = Complete(self.model, prompt, session=session, use_rest_api_experimental=True, stream=True)
+            for token in tokens:
+                if not completion_tokens:
+                    metrics.observe('cortex_first_token', time.perf_counter() - start, model=self.model)
+                completion_tokens += 1
+                chunk = GenerationChunk(text=token)
+                if run_manager:
+                    run_manager.on_llm_new_token(token, chunk=chunk)
+                yield chunk
+        except Exception:
+            is_broken = True
+            self._discard_session(session)
+            raise
+        finally:
+            # Also returns the session when the consumer stops early and the generator is closed
+            if not is_broken:
+                self._release_session(session)
+        metrics.observe('cortex_complete', time.perf_counter() - start, model=self.model, mode='stream')
+        metrics.increment('llm_prompt_tokens', estimate_tokens(prompt), model=self.model)
+        metrics.increment('llm_completion_tokens', completion_tokens, model=self.model)
+
+    def close(self):
+        """Drops all idle sessions and closes the connection"""
+        with self._lock:
+            self._idle_sessions = []
+            if self.connection is not None:
+                self.connection.close()
+
+    def _acquire_session(self, fresh=False) -> snowpark.Session:
+        """
+        Takes an idle session from the pool, checks it if it was idle for long, or creates a new one.
+
+        With fresh set, the pool is skipped and a new session is created, e.g. to retry after a broken one.
+        """
+        while not fresh:
+            with self._lock:
+                if not self._idle_sessions:
+                    break
+                session, last_used = self._idle_sessions.pop()
+            if time.monotonic() - last_used < self.health_check_interval or self._is_healthy(session):
+                return session
+            self._discard_session(session)
+
+        with self._lock:
+            if self.connection is None or self.connection.is_closed():
+                if self.connection_params is None:
+                    raise OperationalError(msg="No open Snowflake connection and no connection_params to open one")
+                self.connection = snowflake.connector.connect(**self.connection_params)
+        return snowpark.Session.builder.configs({"connection": self.connection}).create()
+
+    def _release_session(self, session: snowpark.Session):
+        with self._lock:
+            if len(self._idle_sessions) < self.pool_size:
+                self._idle_sessions.append((session, time.monotonic()))
+                return
+        self._discard_session(session)
+
+    def _count_tokens(self, prompt: str, completion: str):
+        metrics.increment('llm_prompt_tokens', estimate_tokens(prompt), model=self.model)
+        metrics.increment('llm_completion_tokens', estimate_tokens(completion), model=self.model)
+
+    @staticmethod
+    def _cancel_job(job):
+        try:
+            job.cancel()
+        except Exception as e:
+            logger.warning("Could not cancel Cortex query %s: %s", getattr(job, 'query_id', job), e)
+
+    @staticmethod
+    def _is_healthy(session: snowpark.Session) -> bool:
+        try:
+            session.sql("SELECT 1").collect()
+        except Exception:
+            return False
+        return True
+
+    @staticmethod
+    def _discard_session(session: snowpark.Session):
+        # All sessions share self.connection and closing one of them would close
+        # the connection for the others, so discarded sessions are only dropped
+        logger.debug("Discarding Snowpark session %s", session)
 
     @property
     def _identifying_params(self) -> dict[str, SnowflakeConnection|str]:
@@ -0,0 +1,214 @@
+import json
+import threading
+import time
+from collections.abc import Callable, Iterable, Iterator
+from contextlib import nullcontext
+from dataclasses import dataclass, field, replace
+from functools import wraps
+from pathlib import Path
+
+import config
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+_NULL_SPAN = nullcontext()
+
+
+@dataclass
+class TimerStats:
+    """Number, total, maximum and histogram of the durations of a span"""
+    buckets: tuple[float, ...]
+    count: int = 0
+    errors: int = 0
+    total_seconds: float = 0.0
+    max_seconds: float = 0.0
+    bucket_counts: list[int] = field(default_factory=list)
+
+    def observe(self, seconds: float, failed=False):
+        if not self.bucket_counts:
+            self.bucket_counts = [0] * len(self.buckets)
+        self.count += 1
+        self.errors += failed
+        self.total_seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        for i, upper_bound in enumerate(self.buckets):
+            if seconds <= upper_bound:
+                self.bucket_counts[i] += 1
+                break
+
+
+class Span:
+    def __init__(self, metrics: 'Metrics', name: str, labels: dict[str, str]):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.observe(self.name, time.perf_counter() - self.start, failed=exc_type is not None, **self.labels)
+        return False
+
+
+class Metrics:
+    """
+    Metrics collects counters and timing spans in process and exports them as JSON or in Prometheus text format.
+
+    While disabled, span() returns a shared no-op context manager and increment() returns right away,
+    so instrumented code pays for little more than a function call.
+    """
+    def __init__(self, enabled: bool = False, buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.enabled = enabled
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._counters: dict[tuple, float] = {}
+        self._timers: dict[tuple, TimerStats] = {}
+
+    def increment(self, name: str, value: float = 1, **labels: str):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def span(self, name: str, **labels: str):
+        """Context manager that records how long its block took as a sample of the timer name"""
+        if not self.enabled:
+            return _NULL_SPAN
+        return Span(self, name, labels)
+
+    def observe(self, name: str, seconds: float, failed=False, **labels: str):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            timer = self._timers.get(key)
+            if timer is None:
+                timer = self._timers[key] = TimerStats(self.buckets)
+            timer.observe(seconds, failed=failed)
+
+    def timed(self, name: str, **labels: str) -> Callable:
+        """Decorator that wraps every call of a function in a span"""
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                with Span(self, name, labels):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def timed_iter(self, name: str, iterable: Iterable, **labels: str) -> Iterator:
+        """Yields the items of iterable and records the time spent waiting for each of them"""
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.observe(name, time.perf_counter() - start, **labels)
+            yield item
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._timers.clear()
+
+    def to_json(self) -> dict:
+        with self._lock:
+            return {
+                'counters': [
+                    {'name': name, 'labels': dict(labels), 'value': value}
+                    for (name, labels), value in sorted(self._counters.items())
+                ],
+                'timers': [
+                    {
+                        'name': name,
+                        'labels': dict(labels),
+                        'count': timer.count,
+                        'errors': timer.errors,
+                        'total_seconds': timer.total_seconds,
+                        'mean_seconds': timer.total_seconds / timer.count,
+                        'max_seconds': timer.max_seconds,
+                    }
+                    for (name, labels), timer in sorted(self._timers.items())
+                ],
+            }
+
+    def to_prometheus(self, prefix: str = 'newsgraph_') -> str:
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            timers = sorted(
+                ((key, replace(timer, bucket_counts=list(timer.bucket_counts))) for key, timer in self._timers.items()),
+                key=lambda item: item[0]
+            )
+        for name in dict.fromkeys(name for (name, _), _ in counters):
+            lines.append(f"# TYPE {prefix}{name}_total counter")
+            lines.extend(
+                f"{prefix}{name}_total{_format_labels(labels)} {value}"
+                for (counter_name, labels), value in counters if counter_name == name
+            )
+        for name in dict.fromkeys(name for (name, _), _ in timers):
+            metric = f"{prefix}{name}_seconds"
+            lines.append(f"# TYPE {metric} histogram")
+            for (timer_name, labels), timer in timers:
+                if timer_name != name:
+                    continue
+                cumulative = 0
+                for upper_bound, bucket_count in zip(timer.buckets, timer.bucket_counts):
+                    cumulative += bucket_count
+                    lines.append(f"{metric}_bucket{_format_labels(labels, le=str(upper_bound))} {cumulative}")
+                lines.append(f"{metric}_bucket{_format_labels(labels, le='+Inf')} {timer.count}")
+                lines.append(f"{metric}_sum{_format_labels(labels)} {timer.total_seconds}")
+                lines.append(f"{metric}_count{_format_labels(labels)} {timer.count}")
+        return '\n'.join(lines) + '\n'
+
+    def export(self, path: str | Path):
+        """Writes the metrics to path, in Prometheus text format if it ends with .prom, as JSON otherwise"""
+        path = Path(path)
+        if path.suffix == '.prom':
+            path.write_text(self.to_prometheus())
+        else:
+            path.write_text(json.dumps(self.to_json(), indent=2))
+
+
+def _format_labels(labels: tuple[tuple[str, str], ...], **extra: str) -> str:
+    items = [*labels, *extra.items()]
+    if not items:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(str(value))}"' for key, value in items) + '}'
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+_slow_query_lock = threading.Lock()
+
+
+def log_slow_query(query: str, params: dict, seconds: float, kind: str = 'query',
+                   threshold: float | None = config.SLOW_QUERY_SECONDS, path: str | None = config.SLOW_QUERY_LOG_PATH):
+    """Appends a Cypher query that took longer than threshold seconds to the slow query log as a JSON line"""
+    if not metrics.enabled or threshold is None or seconds < threshold or not path:
+        return
+    metrics.increment('slow_queries', kind=kind)
+    entry = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'seconds': round(seconds, 4),
+        'kind': kind,
+        'query': query,
+        # Parameter values can be large, e.g. lists of embeddings, so only their sizes are logged
+        'params': {key: len(value) if isinstance(value, (list, tuple, dict)) else value for key, value in params.items()
+                   if isinstance(value, (list, tuple, dict, str, int, float, bool, type(None)))},
+    }
+    with _slow_query_lock, open(path, 'a') as f:
+        f.write(json.dumps(entry, default=str) + '\n')
+
+
+# Shared instance used by the instrumented modules
+metrics = Metrics(enabled=config.METRICS_ENABLED)
@@ -1,6 +1,10 @@
-from gliner import GLiNER
+from collections.abc import Sequence
 
+import config
+from inference import load_ner_model
+from metrics import metrics
 from schema import Entity, Iterable
+from utils import batched, lazy_singleton
 
 
 PRETRAINED_CHECKPOINT = 'urchade/gliner_multi-v2.1'  # multi-lingual
@@ -13,24 +17,56 @@ class EntityFinder:
     """
     EntityFinder finds entity in texts given a set of labels for which to look
     """
-    def __init__(self, labels: Iterable[str] = DEFAULT_LABELS, pretrained_checkpoint=PRETRAINED_CHECKPOINT, revision=REVISION):
+    def __init__(self, labels: Iterable[str] = DEFAULT_LABELS, pretrained_checkpoint=PRETRAINED_CHECKPOINT, revision=REVISION,
+                 model=None):
         # NOTE: NuZero requires labels to be lower-cased!
         self.labels = [label.lower() for label in labels]
-        self.model = GLiNER.from_pretrained(pretrained_checkpoint, revision=revision)
+        self.model = model if model is not None else load_ner_model(pretrained_checkpoint, revision)
     
     def find(self, *texts: str, threshold=0.5):
         return list(self.find_iter(*texts, threshold=threshold))
 
     def find_iter(self, *texts: str, threshold=0.5):
         for text in texts:
-            new_entities = self.model.predict_entities(text, self.labels, threshold=threshold)
+            metrics.increment('ner_texts')
+            with metrics.span('ner'):
+                new_entities = self.model.predict_entities(text, self.labels, threshold=threshold)
             new_entities = merge_entities(text, new_entities)
+            metrics.increment('entities_found', len(new_entities))
             new_entities = (
                 Entity(name=entity['text'], label=entity['label'])
                 for entity in new_entities
             )
             yield from new_entities
 
+    def find_batched(self, texts: Sequence[str], threshold=0.5, batch_size=config.NER_BATCH_SIZE) -> list[list[Entity]]:
+        """
+        Finds entities in many texts at once and returns one list of entities per text.
+
+        Texts are sorted by length before batching, so that texts of similar length
+        share a forward pass and little compute is spent on padding.
+        """
+        results = [[] for _ in texts]
+        indices_by_length = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        for batch_indices in batched(indices_by_length, batch_size):
+            batch_texts = [texts[i] for i in batch_indices]
+            with metrics.span('ner', batched='true'):
+                batch_entities = self.model.batch_predict_entities(batch_texts, self.labels, threshold=threshold)
+            for i, text, new_entities in zip(batch_indices, batch_texts, batch_entities):
+                results[i] = [
+                    Entity(name=entity['text'], label=entity['label'])
+                    for entity in merge_entities(text, new_entities)
+                ]
+        metrics.increment('ner_texts', len(texts))
+        metrics.increment('entities_found', sum(len(entities) for entities in results))
+        return results
+
+
+@lazy_singleton
+def get_entity_finder() -> EntityFinder:
+    """Shared EntityFinder for the labels relevant to the news graph"""
+    return EntityFinder(labels=config.RELEVANT_LABELS)
+
 
 def merge_entities(text, entities):
     """Merges entity tokens that directly follow each other"""
@@ -0,0 +1,210 @@
+import queue
+import threading
+import time
+from collections.abc import Callable, Iterable
+from dataclasses import dataclass
+
+from metrics import metrics
+
+
+_DONE = object()
+
+
+@dataclass
+class StageStats:
+    """Counters of a single pipeline stage"""
+    name: str
+    processed: int = 0
+    failed: int = 0
+    busy_seconds: float = 0.0
+    started_at: float | None = None  # when the stage got its first item
+
+    def start(self):
+        if self.started_at is None:
+            self.started_at = time.perf_counter()
+
+    @property
+    def throughput(self) -> float:
+        """Processed items per second since the stage got its first item"""
+        if self.started_at is None:
+            return 0.0
+        elapsed = time.perf_counter() - self.started_at
+        return self.processed / elapsed if elapsed > 0 else 0.0
+
+
+class Stage:
+    """
+    A Stage applies func to the items of its bounded input queue with a number of worker threads.
+
+    If batch_size is set, func receives lists of up to batch_size items instead of single items.
+    Partial batches are flushed when no new item arrived within batch_timeout seconds.
+    Lists returned by a batched stage are passed on to the next stage item by item.
+    Returning None from func drops the item.
+    """
+    def __init__(self, name: str, func: Callable, workers: int = 1, queue_size: int = 16,
+                 batch_size: int | None = None, batch_timeout: float = 1.0):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
+        self.input = queue.Queue(maxsize=queue_size)
+        self.stats = StageStats(name)
+        self._lock = threading.Lock()
+        self._active_workers = workers
+
+    def put(self, item):
+        """Blocks while the input queue is full, which propagates backpressure upstream"""
+        self.input.put(item)
+
+    def close(self):
+        for _ in range(self.workers):
+            self.input.put(_DONE)
+
+
+class Pipeline:
+    """
+    A Pipeline connects stages by bounded queues so that they run concurrently.
+
+    A single feeder thread pulls items from the source into the first stage.
+    on_error is called with (stage_name, item, exception) for every failing item.
+    """
+    def __init__(self, stages: list[Stage], on_error: Callable | None = None, report_interval: float | None = None):
+        self.stages = stages
+        self.on_error = on_error
+        self.report_interval = report_interval
+        self.source_stats = StageStats('fetch')
+        self._stopped = threading.Event()
+
+    def run(self, source: Iterable):
+        threads = [threading.Thread(target=self._feed, args=(source,), name='fetch', daemon=True)]
+        for i, stage in enumerate(self.stages):
+            next_stage = self.stages[i + 1] if i + 1 < len(self.stages) else None
+            threads.extend(
+                threading.Thread(target=self._work, args=(stage, next_stage), name=f"{stage.name}-{n}", daemon=True)
+                for n in range(stage.workers)
+            )
+        self._stopped.clear()
+        if self.report_interval:
+            threading.Thread(target=self._report, name='report', daemon=True).start()
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            self._stopped.set()
+
+    def stats(self) -> list[dict]:
+        """Returns queue depth and throughput counters of each stage"""
+        result = [self._stats_to_dict(self.source_stats, depth=None, capacity=None)]
+        result.extend(
+            self._stats_to_dict(stage.stats, depth=stage.input.qsize(), capacity=stage.input.maxsize)
+            for stage in self.stages
+        )
+        return result
+
+    def format_stats(self) -> str:
+        return ' | '.join(
+            f"{s['stage']}: {s['processed']} done, {s['failed']} failed, {s['throughput']:.2f}/s"
+            + (f", queue {s['queue_depth']}/{s['queue_capacity']}" if s['queue_depth'] is not None else '')
+            for s in self.stats()
+        )
+
+    def _feed(self, source: Iterable):
+        first_stage = self.stages[0]
+        iterator = iter(source)
+        self.source_stats.start()
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                except Exception as e:
+                    self.source_stats.failed += 1
+                    self._handle_error(self.source_stats.name, None, e)
+                    break
+                self.source_stats.busy_seconds += time.perf_counter() - start
+                self.source_stats.processed += 1
+                first_stage.put(item)
+        finally:
+            first_stage.close()
+
+    def _work(self, stage: Stage, next_stage: Stage | None):
+        if stage.batch_size:
+            items = self._iter_batches(stage)
+        else:
+            items = iter(stage.input.get, _DONE)
+        for item in items:
+            start = time.perf_counter()
+            with stage._lock:
+                stage.stats.start()
+            try:
+                result = stage.func(item)
+            except Exception as e:
+                with stage._lock:
+                    stage.stats.failed += len(item) if stage.batch_size else 1
+                self._handle_error(stage.name, item, e)
+                continue
+            finally:
+                busy_seconds = time.perf_counter() - start
+                metrics.observe('pipeline_stage', busy_seconds, stage=stage.name)
+                with stage._lock:
+                    stage.stats.busy_seconds += busy_seconds
+            with stage._lock:
+                stage.stats.processed += len(item) if stage.batch_size else 1
+            if result is None or next_stage is None:
+                continue
+            if stage.batch_size and isinstance(result, list):
+                for result_item in result:
+                    next_stage.put(result_item)
+            else:
+                next_stage.put(result)
+
+        with stage._lock:
+            stage._active_workers -= 1
+            is_last_worker = stage._active_workers == 0
+        if is_last_worker and next_stage is not None:
+            next_stage.close()
+
+    @staticmethod
+    def _iter_batches(stage: Stage):
+        batch = []
+        while True:
+            try:
+                item = stage.input.get(timeout=stage.batch_timeout)
+            except queue.Empty:
+                if batch:
+                    yield batch
+                    batch = []
+                continue
+            if item is _DONE:
+                break
+            batch.append(item)
+            if len(batch) >= stage.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def _handle_error(self, stage_name: str, item, exception: Exception):
+        if self.on_error is not None:
+            self.on_error(stage_name, item, exception)
+
+    def _report(self):
+        while not self._stopped.wait(self.report_interval):
+            print(self.format_stats())
+
+    @staticmethod
+    def _stats_to_dict(stats: StageStats, depth: int | None, capacity: int | None) -> dict:
+        return {
+            'stage': stats.name,
+            'processed': stats.processed,
+            'failed': stats.failed,
+            'throughput': stats.throughput,
+            'busy_seconds': stats.busy_seconds,
+            'queue_depth': depth,
+            'queue_capacity': capacity,
+        }
@@ -0,0 +1,31 @@
+import numpy as np
+
+
+STORAGE_DTYPES = ('float32', 'float16', 'int8')
+
+
+def quantize(embeddings: np.ndarray, dtype: str = 'float32') -> tuple[np.ndarray, np.ndarray | None]:
+    """
+    Converts a matrix of embeddings to a storage dtype.
+
+    int8 uses symmetric per-row scaling, the scales are returned alongside the codes.
+    For float dtypes no scales are needed and None is returned instead.
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    if dtype == 'float32':
+        return embeddings, None
+    if dtype == 'float16':
+        return embeddings.astype(np.float16), None
+    if dtype == 'int8':
+        scales = np.abs(embeddings).max(axis=-1, keepdims=True) / 127
+        scales[scales == 0] = 1
+        return np.round(embeddings / scales).astype(np.int8), scales.astype(np.float32).squeeze(-1)
+    raise ValueError(f"Unsupported storage dtype {dtype}, use one of {STORAGE_DTYPES}")
+
+
+def dequantize(codes: np.ndarray, scales: np.ndarray | None = None) -> np.ndarray:
+    """Converts stored embeddings back to float32"""
+    embeddings = np.asarray(codes, dtype=np.float32)
+    if scales is not None:
+        embeddings = embeddings * np.asarray(scales, dtype=np.float32)[..., None]
+    return embeddings
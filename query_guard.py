@@ -0,0 +1,105 @@
+import logging
+import re
+from dataclasses import dataclass, field
+
+import config
+from context_builder import limit_query
+
+
+logger = logging.getLogger(__name__)
+
+WRITE_CLAUSES = re.compile(r'\b(CREATE|MERGE|DELETE|DETACH|SET|REMOVE|DROP|LOAD\s+CSV|FOREACH)\b', re.IGNORECASE)
+# Procedures that write, which the clause check does not see
+WRITE_PROCEDURES = re.compile(
+    r'\bCALL\s+(apoc\.(create|merge|refactor|nodes\.(delete|link|collapse)|atomic|periodic|do|trigger|lock'
+    r'|schema\.assert|cypher\.(doit|runwrite|runmany|runschema))|db\.(create|index\.fulltext\.(create|drop))'
+    r'|gds\.[\w.]*\.(write|mutate))\b',
+    re.IGNORECASE
+)
+# Variable-length relationships, of which those without upper bound are bounded, e.g. [*], [:REL*], [r*2..], [*..]
+VAR_LENGTH = re.compile(r'(\[[^\]]*\*\s*)(\d+)?(\s*\.\.)?(\s*\])')
+LABEL_SCAN_OPERATORS = {'AllNodesScan', 'NodeByLabelScan'}
+STRING_LITERALS = re.compile(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"")
+
+
+class ExpensiveQueryError(ValueError):
+    """Raised for generated queries that are rejected by the cost guard"""
+
+
+@dataclass
+class QueryPlanReport:
+    """What EXPLAIN tells about the cost of a query"""
+    query: str
+    estimated_rows: float = 0.0
+    label_scans: list[str] = field(default_factory=list)
+    cartesian_products: int = 0
+    problems: list[str] = field(default_factory=list)
+
+    @property
+    def is_expensive(self) -> bool:
+        return bool(self.problems)
+
+
+def rewrite_query(query: str, max_records: int = config.ANSWER_MAX_RECORDS,
+                  max_path_length: int = config.QUERY_MAX_PATH_LENGTH) -> str:
+    """Bounds variable-length relationships and the number of returned records"""
+    def bound_var_length(match: re.Match) -> str:
+        start, lower, dots, end = match.groups()
+        if lower is not None and dots is None:
+            # A fixed length like [*3]
+            if int(lower) > max_path_length:
+                raise ExpensiveQueryError(f"Generated query has paths longer than {max_path_length}: {query}")
+            return match.group(0)
+        if lower is not None and int(lower) > max_path_length:
+            raise ExpensiveQueryError(f"Generated query has paths longer than {max_path_length}: {query}")
+        return f"{start}{lower or ''}..{max_path_length}{end}"
+
+    query = VAR_LENGTH.sub(bound_var_length, query)
+    return limit_query(query, max_records)
+
+
+def inspect_plan(plan: dict, query: str, max_estimated_rows: float = config.QUERY_MAX_ESTIMATED_ROWS) -> QueryPlanReport:
+    report = QueryPlanReport(query=query)
+    operators = [plan]
+    while operators:
+        operator = operators.pop()
+        operators.extend(operator.get('children', []))
+        operator_type = operator['operatorType'].split('@')[0]
+        # The driver keeps the operator arguments of a plan under 'args'
+        arguments = operator.get('args', {})
+        report.estimated_rows = max(report.estimated_rows, float(arguments.get('EstimatedRows', 0)))
+        if operator_type in LABEL_SCAN_OPERATORS:
+            report.label_scans.append(arguments.get('Details', operator_type))
+        elif operator_type == 'CartesianProduct':
+            report.cartesian_products += 1
+
+    if report.cartesian_products:
+        report.problems.append(f"{report.cartesian_products} Cartesian product(s)")
+    if report.estimated_rows > max_estimated_rows:
+        report.problems.append(f"estimated {report.estimated_rows:.0f} rows, more than {max_estimated_rows}")
+    return report
+
+
+def guard_query(db, query: str, max_estimated_rows: float = config.QUERY_MAX_ESTIMATED_ROWS) -> str:
+    """
+    Checks an LLM-generated query before it runs and returns the query that should be run instead.
+
+    Write clauses and write procedures are rejected outright, and so are paths that must be longer
+    than config.QUERY_MAX_PATH_LENGTH. Unbounded paths and missing LIMITs are rewritten, then the plan from EXPLAIN is inspected and the query is rejected with ExpensiveQueryError
+    if it contains Cartesian products or is estimated to touch too many rows.
+    """
+    # Entity names in string literals must not be mistaken for clauses
+    unquoted_query = STRING_LITERALS.sub("''", query)
+    if WRITE_CLAUSES.search(unquoted_query) or WRITE_PROCEDURES.search(unquoted_query):
+        raise ExpensiveQueryError(f"Generated query must not write to the graph: {query}")
+
+    rewritten_query = rewrite_query(query)
+    report = inspect_plan(db.explain(rewritten_query), rewritten_query, max_estimated_rows=max_estimated_rows)
+    if report.label_scans:
+        logger.info("Query scans whole labels %s: %s", report.label_scans, rewritten_query)
+    if report.is_expensive:
+        logger.warning("Rejected expensive query (%s): %s", ', '.join(report.problems), rewritten_query)
+        raise ExpensiveQueryError(f"Generated query is too expensive: {', '.join(report.problems)}")
+    if rewritten_query != query:
+        logger.info("Rewrote generated query %r to %r", query, rewritten_query)
+    return rewritten_query
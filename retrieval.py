@@ -0,0 +1,114 @@
+"""
+Concurrent retrieval with reciprocal rank fusion.
+
+Each retriever returns a ranked list of (key, record) pairs. All retrievers of a question run at
+the same time, so retrieval takes about as long as the slowest of them, and retrievers that fail
+or do not finish within the timeout are left out instead of failing the question. The rankings
+are fused with reciprocal rank fusion: a record scores sum(1 / (k + rank)) over the rankings it
+appears in, so records found by several retrievers rise to the top.
+
+A retriever that timed out cannot be interrupted and keeps its worker until it returns. So that
+such calls do not pile up and take the whole pool, at most config.RETRIEVAL_MAX_RUNNING calls of
+a retriever run at a time, further calls skip it.
+"""
+import logging
+import threading
+import time
+from collections import Counter
+from collections.abc import Callable, Hashable, Mapping, Sequence
+from concurrent.futures import Executor, wait
+from dataclasses import dataclass, field
+
+import config
+from metrics import metrics
+
+
+logger = logging.getLogger(__name__)
+
+Ranking = list[tuple[Hashable, dict]]
+_running = Counter()  # retriever name -> calls that have not returned yet
+_running_lock = threading.Lock()
+
+
+@dataclass
+class RetrievalResult:
+    """The fused records, best first, and what each retriever contributed"""
+    records: list[dict]
+    scores: list[float]
+    counts: dict[str, int] = field(default_factory=dict)  # retriever -> number of results
+    seconds: dict[str, float] = field(default_factory=dict)  # retriever -> time until it finished
+    failed: list[str] = field(default_factory=list)  # retrievers that raised or timed out
+
+
+def reciprocal_rank_fusion(rankings: Mapping[str, Sequence[Hashable]], k: int = config.RETRIEVAL_RRF_K,
+                           weights: Mapping[str, float] | None = None) -> list[tuple[Hashable, float]]:
+    """Fuses rankings of keys into one, returns (key, score) pairs sorted by descending score"""
+    scores = {}
+    for name, ranking in rankings.items():
+        weight = 1.0 if weights is None else weights.get(name, 1.0)
+        for rank, key in enumerate(ranking, start=1):
+            scores[key] = scores.get(key, 0.0) + weight / (k + rank)
+    # Ties keep the order in which keys were first seen, i.e. the order of the retrievers
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+
+def _release(name: str):
+    with _running_lock:
+        _running[name] -= 1
+
+
+def retrieve(retrievers: Mapping[str, Callable[[], Ranking]], executor: Executor,
+             timeout: float | None = config.RETRIEVAL_TIMEOUT, limit: int | None = None,
+             weights: Mapping[str, float] | None = None,
+             max_running: int = config.RETRIEVAL_MAX_RUNNING) -> RetrievalResult:
+    """Runs the retrievers concurrently and fuses their rankings, returns at most limit records"""
+    start = time.perf_counter()
+    finished_at = {}
+    result = RetrievalResult(records=[], scores=[])
+
+    def run(name, retriever):
+        try:
+            with metrics.span('retriever', retriever=name):
+                return retriever()
+        finally:
+            finished_at[name] = time.perf_counter() - start
+
+    futures = {}
+    for name, retriever in retrievers.items():
+        with _running_lock:
+            busy = _running[name] >= max_running
+            if not busy:
+                _running[name] += 1
+        if busy:
+            logger.warning("Skipped retriever %s, %s earlier calls are still running", name, max_running)
+            result.failed.append(name)
+            continue
+        futures[name] = executor.submit(run, name, retriever)
+        # Also called when a queued call is cancelled below and run never starts
+        futures[name].add_done_callback(lambda _, name=name: _release(name))
+    wait(futures.values(), timeout=timeout)
+    rankings, records = {}, {}
+    for name, future in futures.items():
+        if not future.done():
+            # The retriever keeps running in its thread, but its results are not waited for
+            future.cancel()
+            logger.warning("Retriever %s did not finish within %s seconds", name, timeout)
+            result.failed.append(name)
+            continue
+        if (error := future.exception()) is not None:
+            logger.warning("Retriever %s failed: %s", name, error)
+            result.failed.append(name)
+            continue
+        ranking = future.result()
+        rankings[name] = [key for key, _ in ranking]
+        for key, record in ranking:
+            records.setdefault(key, record)
+        result.counts[name] = len(ranking)
+        result.seconds[name] = finished_at[name]
+    for name in result.failed:
+        metrics.increment('retriever_failures', retriever=name)
+
+    for key, score in reciprocal_rank_fusion(rankings, weights=weights)[:limit]:
+        result.records.append(records[key])
+        result.scores.append(score)
+    return result
@@ -1,5 +1,6 @@
 from collections.abc import Iterable
 from dataclasses import dataclass, field
+from datetime import datetime
 from enum import Enum
 
 import numpy as np
@@ -14,25 +15,89 @@ class ArticleChunkCategory(Enum):
     PARAGRAPH = 'paragraph'
 
 
-@dataclass
+@dataclass(slots=True)
 class ArticleChunk:
-    """An ArticleChunk is a text piece from an article with metadata"""
+    """
+    An ArticleChunk is a text piece from an article with metadata
+
+    The embedding is usually a row view into the embedding matrix of a whole batch
+    of chunks (see attach_embeddings), so chunks do not own separate arrays.
+    """
     text: str
     category: ArticleChunkCategory
     section: int
     position: int = 0
-    embedding: np.ndarray = np.zeros(config.EMBEDDING_SIZE)
+    embedding: np.ndarray | None = None
     uid: str = field(default_factory=lambda: generate_short_uid('Chunk', config.UID_LEN))
 
-    def to_dict(self, serialize=False):
-        result = self.__dict__
-        if serialize:
-            result['category'] = self.category.value
-        
+    def to_dict(self, serialize=False, include_embedding=True):
+        """Returns the fields as a new dict, the embedding array is shared and not copied"""
+        result = {
+            'text': self.text,
+            'category': self.category.value if serialize else self.category,
+            'section': self.section,
+            'position': self.position,
+            'uid': self.uid,
+        }
+        if include_embedding:
+            result['embedding'] = self.embedding
         return result
 
 
-@dataclass(frozen=True)
+def attach_embeddings(chunks: list[ArticleChunk], embeddings: np.ndarray) -> np.ndarray:
+    """Sets the embedding of each chunk to a row of one contiguous float32 matrix and returns the matrix"""
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+    for chunk, embedding in zip(chunks, embeddings):
+        chunk.embedding = embedding
+    return embeddings
+
+
+@dataclass(frozen=True, slots=True)
 class Entity:
     name: str
     label: str
+
+
+@dataclass(slots=True)
+class ProcessedArticle:
+    """A ProcessedArticle holds everything needed to write an article to the graph in one go"""
+    title: str
+    publishing_date: datetime | None
+    language: str | None
+    url: str
+    source: dict[str, str]
+    authors: list[str]
+    chunks: list[ArticleChunk]
+    mentioned_entities: list[dict] = field(default_factory=list)
+    content_hash: str | None = None
+    uid: str = field(default_factory=lambda: generate_short_uid('Article', config.UID_LEN))
+
+
+@dataclass
+class GraphSchema:
+    """A compact description of the graph for use in LLM prompts"""
+    node_properties: dict[str, dict[str, str]]  # label -> property name -> type
+    relationships: list[tuple[str, str, str]]  # (start label, type, end label)
+    node_counts: dict[str, int] = field(default_factory=dict)
+    relationship_properties: dict[str, dict[str, str]] = field(default_factory=dict)  # type -> property name -> type
+
+    @property
+    def labels(self) -> set[str]:
+        return set(self.node_properties)
+
+    @property
+    def relationship_types(self) -> set[str]:
+        return {rel_type for _, rel_type, _ in self.relationships}
+
+    def to_prompt(self) -> str:
+        node_lines = []
+        for label, properties in sorted(self.node_properties.items()):
+            property_str = ', '.join(f"{name}: {type_}" for name, type_ in sorted(properties.items()))
+            count_str = f"  // {self.node_counts[label]} nodes" if label in self.node_counts else ''
+            node_lines.append(f"(:{label} {{{property_str}}}){count_str}")
+        rel_lines = []
+        for start, rel_type, end in sorted(self.relationships):
+            properties = self.relationship_properties.get(rel_type)
+            property_str = ' {' + ', '.join(f"{name}: {type_}" for name, type_ in sorted(properties.items())) + '}' if properties else ''
+            rel_lines.append(f"(:{start})-[:{rel_type}{property_str}]->(:{end})")
+        return "Nodes:\n" + '\n'.join(node_lines) + "\nRelationships:\n" + '\n'.join(rel_lines)
@@ -0,0 +1,317 @@
+"""
+Columnar snapshots of the news graph.
+
+A snapshot is a directory with one Parquet file per table and the chunk embeddings as a raw
+matrix for memory-mapping, like the chunk index:
+
+    manifest.json           format version, row counts, embedding dim and dtype
+    articles.parquet        uid, title, publishing_date, language, url
+    chunks.parquet          uid, article_uid, text, category, section, position, embedding_row
+    sources.parquet         uid, name, type, url
+    entities.parquet        uid, label, name, resolved_at
+    relationships.parquet   type, start_label, start_uid, end_label, end_uid, count, score
+    embeddings.<dtype>      one row per chunk with an embedding, embedding_scales.npy for int8
+
+The manifest is written last, a directory without it is an incomplete export. Aggregates are
+not exported, they are rebuilt after an import. Imports write into an empty database with
+large UNWIND transactions: the uid constraints are created first, as relationships are matched
+by uid, the fulltext and vector indexes only after all data is loaded.
+Snapshots can also be read without a database, e.g. to build the chunk index or as benchmark corpus.
+
+    python snapshot.py export snapshots/2024-06
+    python snapshot.py import snapshots/2024-06
+    python snapshot.py index snapshots/2024-06 chunk_index
+"""
+import argparse
+import json
+import time
+from collections import defaultdict
+from collections.abc import Iterable, Iterator
+from pathlib import Path
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import config
+from graph import MENTION_LABELS, NewsGraphClient
+from quantization import STORAGE_DTYPES, dequantize, quantize
+
+
+FORMAT_VERSION = 1
+TIMESTAMP = pa.timestamp('us', tz='UTC')
+NODE_TABLES = {
+    'articles': ('Article', pa.schema([
+        ('uid', pa.string()), ('title', pa.string()), ('publishing_date', TIMESTAMP),
+        ('language', pa.string()), ('url', pa.string()),
+    ])),
+    'sources': ('Source', pa.schema([
+        ('uid', pa.string()), ('name', pa.string()), ('type', pa.string()), ('url', pa.string()),
+    ])),
+}
+CHUNKS_SCHEMA = pa.schema([
+    ('uid', pa.string()), ('article_uid', pa.string()), ('text', pa.string()), ('category', pa.string()),
+    ('section', pa.int64()), ('position', pa.int64()), ('embedding_row', pa.int64()),
+])
+ENTITY_LABELS = (*MENTION_LABELS, 'Topic')
+ENTITIES_SCHEMA = pa.schema([
+    ('uid', pa.string()), ('label', pa.string()), ('name', pa.string()), ('resolved_at', TIMESTAMP),
+])
+# (start label, type, end label, properties), CONTAINS is stored as the article_uid of chunks
+RELATIONSHIPS = (
+    ('Source', 'PUBLISHED', 'Article', ()),
+    ('Person', 'AUTHORED', 'Article', ()),
+    ('Article', 'HAS_TOPIC', 'Topic', ()),
+    *(('Chunk', 'MENTIONS', label, ('count',)) for label in MENTION_LABELS),
+    *((label, 'SAME_AS', label, ('score',)) for label in MENTION_LABELS),
+)
+RELATIONSHIPS_SCHEMA = pa.schema([
+    ('type', pa.string()), ('start_label', pa.string()), ('start_uid', pa.string()),
+    ('end_label', pa.string()), ('end_uid', pa.string()), ('count', pa.int64()), ('score', pa.float64()),
+])
+
+
+class Snapshot:
+    """Read access to a snapshot directory, tables and embeddings are memory-mapped"""
+    def __init__(self, directory: str | Path):
+        self.directory = Path(directory)
+        manifest_path = self.directory / 'manifest.json'
+        if not manifest_path.exists():
+            raise FileNotFoundError(f"{self.directory} is not a complete snapshot, {manifest_path.name} is missing")
+        self.manifest = json.loads(manifest_path.read_text())
+        if self.manifest['format_version'] != FORMAT_VERSION:
+            raise ValueError(f"Unsupported snapshot format {self.manifest['format_version']}, expected {FORMAT_VERSION}")
+        self.dtype = self.manifest['embedding_dtype']
+        self.embeddings = np.memmap(
+            self.directory / f'embeddings.{self.dtype}', dtype=self.dtype, mode='r',
+            shape=(self.manifest['embedding_rows'], self.manifest['embedding_dim'])
+        ) if self.manifest['embedding_rows'] else np.empty((0, self.manifest['embedding_dim']), dtype=self.dtype)
+        scales_path = self.directory / 'embedding_scales.npy'
+        self.scales = np.load(scales_path, mmap_mode='r') if scales_path.exists() else None
+
+    def table(self, name: str, columns: list[str] | None = None, filters=None) -> pa.Table:
+        return pq.read_table(self.directory / f'{name}.parquet', columns=columns, filters=filters, memory_map=True)
+
+    def iter_rows(self, name: str, batch_size: int = config.SNAPSHOT_IMPORT_BATCH_SIZE) -> Iterator[list[dict]]:
+        """Yields the rows of a table as lists of dicts of at most batch_size rows"""
+        parquet_file = pq.ParquetFile(self.directory / f'{name}.parquet', memory_map=True)
+        for batch in parquet_file.iter_batches(batch_size=batch_size):
+            yield batch.to_pylist()
+
+    def get_embeddings(self, rows: Iterable[int]) -> np.ndarray:
+        """Returns the embeddings in the given rows as float32"""
+        rows = np.fromiter(rows, dtype=np.int64)
+        return dequantize(self.embeddings[rows], None if self.scales is None else self.scales[rows])
+
+    def iter_chunk_embeddings(self, page_size=5_000) -> Iterator[list[dict]]:
+        """Yields pages like NewsGraphClient.iter_chunk_embeddings, so ChunkIndex.build_from_graph can read snapshots"""
+        articles = self.table('articles', columns=['uid', 'publishing_date']).to_pydict()
+        publishing_dates = dict(zip(articles['uid'], articles['publishing_date']))
+        sources = self.table('sources', columns=['uid', 'name']).to_pydict()
+        source_names = dict(zip(sources['uid'], sources['name']))
+        published = self.table('relationships', columns=['start_uid', 'end_uid'], filters=[('type', '=', 'PUBLISHED')])
+        article_sources = {
+            article_uid: source_names.get(source_uid)
+            for source_uid, article_uid in zip(*published.to_pydict().values())
+        }
+        for rows in self.iter_rows('chunks', page_size):
+            rows = [row for row in rows if row['embedding_row'] >= 0]
+            if not rows:
+                continue
+            embeddings = self.get_embeddings(row['embedding_row'] for row in rows)
+            yield [
+                {
+                    'uid': row['uid'],
+                    'embedding': embedding,
+                    'category': row['category'],
+                    'publishing_date': publishing_dates.get(row['article_uid']),
+                    'source': article_sources.get(row['article_uid']),
+                }
+                for row, embedding in zip(rows, embeddings)
+            ]
+
+
+def export_snapshot(db: NewsGraphClient, directory: str | Path, dtype: str = 'float32',
+                    page_size: int = config.SNAPSHOT_PAGE_SIZE) -> dict[str, int]:
+    """Writes the graph to a snapshot directory page by page and returns the number of rows per table"""
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    # Files of an earlier export in another dtype would be read together with the new ones,
+    # e.g. int8 scales would be applied to float embeddings
+    for path in [directory / 'manifest.json', directory / 'embedding_scales.npy', *directory.glob('embeddings.*')]:
+        path.unlink(missing_ok=True)
+    counts = {}
+    for table, (label, schema) in NODE_TABLES.items():
+        counts[table] = _write_table(directory / f'{table}.parquet', schema, db.iter_nodes(label, schema.names, page_size))
+    counts['entities'] = _write_table(directory / 'entities.parquet', ENTITIES_SCHEMA, (
+        [{**record, 'label': label} for record in records]
+        for label in ENTITY_LABELS
+        for records in db.iter_nodes(label, ('name', 'resolved_at'), page_size)
+    ))
+
+    # Embeddings are streamed to disk page by page, in the order of the chunks that have one
+    embedding_rows, scales = 0, []
+
+    def chunk_pages(embeddings_file):
+        nonlocal embedding_rows
+        for records in db.iter_chunks(page_size):
+            with_embedding = [record for record in records if record['embedding'] is not None]
+            if with_embedding:
+                codes, page_scales = quantize(np.asarray([record['embedding'] for record in with_embedding]), dtype)
+                embeddings_file.write(np.ascontiguousarray(codes).tobytes())
+                if page_scales is not None:
+                    scales.append(page_scales)
+            for record in records:
+                if record['embedding'] is None:
+                    record['embedding_row'] = -1
+                else:
+                    record['embedding_row'] = embedding_rows
+                    embedding_rows += 1
+            yield records
+
+    tmp_path = directory / f'embeddings.{dtype}.tmp'
+    with open(tmp_path, 'wb') as f:
+        counts['chunks'] = _write_table(directory / 'chunks.parquet', CHUNKS_SCHEMA, chunk_pages(f))
+    tmp_path.replace(directory / f'embeddings.{dtype}')
+    if scales:
+        np.save(directory / 'embedding_scales.npy', np.concatenate(scales))
+
+    counts['relationships'] = _write_table(directory / 'relationships.parquet', RELATIONSHIPS_SCHEMA, (
+        [
+            {'type': rel_type, 'start_label': start_label, 'start_uid': record['start_uid'],
+             'end_label': end_label, 'end_uid': record['end_uid'], **{name: record[name] for name in properties}}
+            for record in records
+        ]
+        for start_label, rel_type, end_label, properties in RELATIONSHIPS
+        for records in db.iter_relationships(start_label, rel_type, end_label, properties, page_size)
+    ))
+    manifest = {
+        'format_version': FORMAT_VERSION,
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'counts': counts,
+        'embedding_dim': config.EMBEDDING_SIZE,
+        'embedding_dtype': dtype,
+        'embedding_rows': embedding_rows,
+        'embedding_model': f"{config.EMBEDDING_MODEL_CHECKPOINT}@{config.EMBEDDING_MODEL_HASH}",
+    }
+    (directory / 'manifest.json').write_text(json.dumps(manifest, indent=2))
+    return counts
+
+
+def import_snapshot(db: NewsGraphClient, directory: str | Path, batch_size: int = config.SNAPSHOT_IMPORT_BATCH_SIZE,
+                    rebuild_aggregates: bool = config.MAINTAIN_AGGREGATES) -> dict[str, int]:
+    """Loads a snapshot into an empty database and returns the number of rows per table"""
+    snapshot = Snapshot(directory)
+    if snapshot.manifest['embedding_rows'] and snapshot.manifest['embedding_dim'] != config.EMBEDDING_SIZE:
+        raise ValueError(
+            f"Snapshot embeddings have {snapshot.manifest['embedding_dim']} dimensions, expected {config.EMBEDDING_SIZE}"
+        )
+    if db.query("MATCH (a:Article) RETURN count(a) > 0 AS has_articles")[0]['has_articles']:
+        raise ValueError("Snapshots can only be imported into an empty database")
+    db.setup_performance_indexes()
+    counts = defaultdict(int)
+    for rows in snapshot.iter_rows('articles', batch_size):
+        db.create_nodes('Article', [_properties(row) for row in rows])
+        counts['articles'] += len(rows)
+    # Older graphs have a Source per feed of a publisher, they are merged into one per name,
+    # as required by the Source.name constraint
+    uid_by_name, source_uids = {}, {}
+    for rows in snapshot.iter_rows('sources', batch_size):
+        new_sources = []
+        for row in rows:
+            if row['name'] not in uid_by_name:
+                uid_by_name[row['name']] = row['uid']
+                new_sources.append(_properties(row))
+            source_uids[row['uid']] = uid_by_name[row['name']]
+        db.create_nodes('Source', new_sources)
+        counts['sources'] += len(new_sources)
+    for rows in snapshot.iter_rows('entities', batch_size):
+        rows_by_label = defaultdict(list)
+        for row in rows:
+            rows_by_label[row.pop('label')].append(_properties(row))
+        for label, label_rows in rows_by_label.items():
+            db.create_nodes(label, label_rows)
+        counts['entities'] += len(rows)
+    for rows in snapshot.iter_rows('chunks', batch_size):
+        embedding_rows = [row.pop('embedding_row') for row in rows]
+        embedded = [i for i, embedding_row in enumerate(embedding_rows) if embedding_row >= 0]
+        embeddings = dict(zip(embedded, snapshot.get_embeddings(embedding_rows[i] for i in embedded)))
+        db.create_chunks([
+            {'article_uid': row.pop('article_uid'), 'properties': _properties(row), 'embedding': embeddings.get(i)}
+            for i, row in enumerate(rows)
+        ])
+        counts['chunks'] += len(rows)
+    for rows in snapshot.iter_rows('relationships', batch_size):
+        rows_by_type = defaultdict(list)
+        for row in rows:
+            key = (row.pop('start_label'), row.pop('type'), row.pop('end_label'))
+            if key[0] == 'Source':
+                row['start_uid'] = source_uids.get(row['start_uid'], row['start_uid'])
+            rows_by_type[key].append({
+                'start_uid': row.pop('start_uid'), 'end_uid': row.pop('end_uid'), 'properties': _properties(row)
+            })
+        for (start_label, rel_type, end_label), rel_rows in rows_by_type.items():
+            db.create_relationships(start_label, rel_type, end_label, rel_rows)
+        counts['relationships'] += len(rows)
+    # Maintaining these during the load would slow down every write
+    db.setup_fulltext_indexes()
+    db.setup_vector_indexes()
+    if rebuild_aggregates:
+        db.rebuild_aggregates()
+    return dict(counts)
+
+
+def _write_table(path: Path, schema: pa.Schema, pages: Iterable[list[dict]]) -> int:
+    """Writes pages of records to a Parquet file, one row group per page, and returns the number of rows"""
+    num_rows = 0
+    with pq.ParquetWriter(path, schema, compression='zstd') as writer:
+        for records in pages:
+            if not records:
+                continue
+            rows = [{name: _to_native(record.get(name)) for name in schema.names} for record in records]
+            writer.write_table(pa.Table.from_pylist(rows, schema=schema))
+            num_rows += len(rows)
+    return num_rows
+
+
+def _to_native(value):
+    # neo4j temporal values are converted to their Python counterparts
+    return value.to_native() if hasattr(value, 'to_native') else value
+
+
+def _properties(row: dict) -> dict:
+    # Missing values are left out instead of being written as null
+    return {key: value for key, value in row.items() if value is not None}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export the graph to a snapshot or import a snapshot into the graph')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    export_parser = subparsers.add_parser('export')
+    export_parser.add_argument('directory')
+    export_parser.add_argument('--dtype', choices=STORAGE_DTYPES, default='float32', help='storage dtype of embeddings')
+    import_parser = subparsers.add_parser('import')
+    import_parser.add_argument('directory')
+    import_parser.add_argument('--batch-size', type=int, default=config.SNAPSHOT_IMPORT_BATCH_SIZE)
+    import_parser.add_argument('--skip-aggregates', action='store_true', help='do not rebuild the aggregates')
+    index_parser = subparsers.add_parser('index', help='build the chunk index from a snapshot')
+    index_parser.add_argument('directory')
+    index_parser.add_argument('index_directory')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    if args.command == 'export':
+        print(export_snapshot(NewsGraphClient(), args.directory, dtype=args.dtype))
+    elif args.command == 'import':
+        print(import_snapshot(NewsGraphClient(), args.directory, batch_size=args.batch_size,
+                              rebuild_aggregates=not args.skip_aggregates))
+    else:
+        from ann_index import ChunkIndex
+
+        index = ChunkIndex.build_from_graph(Snapshot(args.directory), args.index_directory)
+        print(f"Indexed {len(index)} chunks")
+    print(f"Done in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import retrieval
+
+
+def test_cancelled_retriever_releases_its_slot():
+    release = threading.Event()
+
+    def blocking():
+        release.wait()
+        return [('a', {'uid': 'a'})]
+
+    def queued():
+        return [('b', {'uid': 'b'})]
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        try:
+            # The only worker is blocked, so the second retriever is still queued at the timeout
+            result = retrieval.retrieve({'blocking': blocking, 'queued': queued}, executor, timeout=0.05)
+            assert set(result.failed) == {'blocking', 'queued'}
+            assert retrieval._running['queued'] == 0
+        finally:
+            release.set()
+    assert retrieval._running['blocking'] == 0
+
+
+def test_busy_retriever_is_skipped():
+    release = threading.Event()
+
+    def blocking():
+        release.wait()
+        return []
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        try:
+            retrieval.retrieve({'blocking': blocking}, executor, timeout=0.01, max_running=1)
+            result = retrieval.retrieve({'blocking': blocking}, executor, timeout=0.01, max_running=1)
+            assert result.failed == ['blocking']
+        finally:
+            release.set()
+    assert retrieval._running['blocking'] == 0
@@ -1,16 +1,79 @@
 import re
+import threading
+import time
 from base64 import urlsafe_b64encode
+from collections import deque
+from collections.abc import Callable, Iterable, Iterator
+from functools import wraps
+from itertools import islice
+from typing import TypeVar
 from uuid import uuid4
 
-from huggingface_hub import HfApi
-
 
 LUCENE_SPECIAL_CHARS = re.compile(r'[-+&|!(){}\[\]\^"~*?:\\]')
+# Closing punctuation of a sentence and the whitespace that follows. Punctuation within a word,
+# as in decimals like 3.5 or in URLs, is not followed by whitespace and does not end a sentence.
+SENTENCE_END_PATTERN = re.compile(r'[.:;?!]+(?:\s+|$)')
+LAST_WORD_PATTERN = re.compile(r'(\w+)\W*$')
+# Words whose period does not end a sentence, besides single letters as in initials, "e.g." or "z. B."
+ABBREVIATIONS = {
+    'dr', 'mr', 'mrs', 'ms', 'prof', 'st', 'jr', 'sr', 'vs', 'etc', 'no', 'approx', 'jan', 'feb', 'aug', 'sept',
+    'oct', 'nov', 'dec', 'ca', 'bzw', 'usw', 'vgl', 'inkl', 'evtl', 'ggf', 'sog', 'str', 'nr', 'mio', 'mrd', 'dt',
+}
+WORD_PATTERN = re.compile(r'\s*\S+\s*')
+
+T = TypeVar('T')
 
 def generate_short_uid(prefix:str='', max_len:int=22) -> str:
     return prefix+':'+urlsafe_b64encode(uuid4().bytes).rstrip(b'=').decode('ascii')[:max_len]
 
 
+def lazy_singleton(loader: Callable[[], T]) -> Callable[[], T]:
+    """
+    Turns a loader function into a getter of a shared instance that is created on first use.
+
+    The time the loader took is kept in the load_seconds attribute of the getter.
+    getter.override(instance) replaces the shared instance, e.g. with a stand-in for benchmarks.
+    """
+    lock = threading.Lock()
+    instances = []
+
+    @wraps(loader)
+    def getter() -> T:
+        if not instances:
+            with lock:
+                if not instances:
+                    start = time.perf_counter()
+                    instances.append(loader())
+                    getter.load_seconds = time.perf_counter() - start
+        return instances[0]
+
+    def override(instance: T):
+        with lock:
+            instances[:] = [instance]
+            getter.load_seconds = 0.0
+
+    getter.load_seconds = None
+    getter.override = override
+    return getter
+
+
+def warm_up(*getters: Callable) -> dict[str, float]:
+    """Creates the instances of lazy_singleton getters and returns their load times in seconds"""
+    timings = {}
+    for getter in getters:
+        getter()
+        timings[getter.__name__] = getter.load_seconds
+    return timings
+
+
+def batched(iterable: Iterable, batch_size: int) -> Iterator[list]:
+    """Yields lists of at most batch_size items from iterable"""
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, batch_size)):
+        yield batch
+
+
 def split_into_combined_sentence_chunks(text:str, min_combination_len:int=1000, len_threshold:int=1): 
     sentences = split_into_sentences(text, len_threshold=len_threshold)
     return combine_sentences(sentences, min_combination_len=min_combination_len)
@@ -25,20 +88,107 @@ def split_into_sentences(text:str, len_threshold:int=1) -> list[str]:
 
 
 def combine_sentences(sentences:list[str], min_combination_len:int=1000) -> list[str]:
+    """Joins consecutive sentences into groups of at least min_combination_len characters, the last group may be shorter"""
     temp_sentence_list = []
+    temp_len = 0
     combined_sentences = []
     for sentence in sentences:
-        if sum(len(sentence) for sentence in temp_sentence_list) < min_combination_len:
-            temp_sentence_list.append(sentence)
-        else:
-            combined_sentence = '.'.join(temp_sentence_list)
-            combined_sentences.append(combined_sentence)
+        temp_sentence_list.append(sentence)
+        temp_len += len(sentence)
+        if temp_len >= min_combination_len:
+            combined_sentences.append('.'.join(temp_sentence_list))
             temp_sentence_list = []
+            temp_len = 0
+    if temp_sentence_list:
+        combined_sentences.append('.'.join(temp_sentence_list))
 
     return combined_sentences
 
 
+def chunk_by_tokens(text: str, count_tokens: Callable[[list[str]], list[int]], max_tokens: int,
+                    overlap_tokens: int = 0) -> Iterator[str]:
+    """
+    Splits a text into chunks of whole sentences with at most max_tokens tokens each.
+
+    count_tokens returns the number of tokens of each of a list of texts, it is called once per text
+    and again for words longer than max_tokens.
+    Chunks are built in a single pass, so the time is linear in the length of the text, and no text
+    is dropped. With overlap_tokens, a chunk starts with the last sentences of the previous one
+    that fit into that many tokens. Sentences longer than max_tokens are split between words, and
+    words longer than that into parts of at most max_tokens tokens.
+    """
+    sentences = split_sentences(text)
+    pieces = []
+    for sentence, num_tokens in zip(sentences, count_tokens(sentences)):
+        if num_tokens <= max_tokens:
+            pieces.append((sentence, num_tokens))
+        else:
+            pieces.extend(_split_between_words(sentence, num_tokens, max_tokens, count_tokens))
+
+    window, window_tokens = deque(), 0
+    for piece, num_tokens in pieces:
+        if window and window_tokens + num_tokens > max_tokens:
+            if chunk := ''.join(p for p, _ in window).strip():
+                yield chunk
+            overlap, overlap_len = deque(), 0
+            while window and overlap_len + window[-1][1] <= min(overlap_tokens, max_tokens - num_tokens):
+                overlap.appendleft(window.pop())
+                overlap_len += overlap[0][1]
+            window, window_tokens = overlap, overlap_len
+        window.append((piece, num_tokens))
+        window_tokens += num_tokens
+    if chunk := ''.join(p for p, _ in window).strip():
+        yield chunk
+
+
+def split_sentences(text: str) -> list[str]:
+    """Splits a text into sentences, each with its closing punctuation and the whitespace that follows"""
+    sentences, start = [], 0
+    for match in SENTENCE_END_PATTERN.finditer(text):
+        if match.group().rstrip() == '.' and (word := LAST_WORD_PATTERN.search(text, start, match.start())):
+            if len(word.group(1)) == 1 or word.group(1).lower() in ABBREVIATIONS:
+                continue
+        sentences.append(text[start:match.end()])
+        start = match.end()
+    if start < len(text):
+        sentences.append(text[start:])
+    return sentences
+
+
+def _split_between_words(sentence: str, num_tokens: int, max_tokens: int,
+                         count_tokens: Callable[[list[str]], list[int]]) -> Iterator[tuple[str, int]]:
+    """Splits an over-long sentence, the tokens of each piece are estimated from its share of characters"""
+    tokens_per_char = num_tokens / len(sentence)
+    piece, piece_len = [], 0
+    for word in WORD_PATTERN.findall(sentence):
+        if piece and (piece_len + len(word)) * tokens_per_char > max_tokens:
+            yield ''.join(piece), min(max_tokens, int(piece_len * tokens_per_char) + 1)
+            piece, piece_len = [], 0
+        if len(word) * tokens_per_char > max_tokens:
+            # A single word over the limit, e.g. a long URL, is split between tokens
+            yield from _split_word(word, count_tokens([word])[0], max_tokens, count_tokens)
+            continue
+        piece.append(word)
+        piece_len += len(word)
+    if piece:
+        yield ''.join(piece), min(max_tokens, int(piece_len * tokens_per_char) + 1)
+
+
+def _split_word(word: str, num_tokens: int, max_tokens: int,
+                count_tokens: Callable[[list[str]], list[int]]) -> Iterator[tuple[str, int]]:
+    """Cuts a word into parts of at most max_tokens tokens, parts that still have too many are cut again"""
+    if num_tokens <= max_tokens or len(word) == 1:
+        yield word, num_tokens
+        return
+    size = max(1, len(word) * max_tokens // num_tokens)
+    parts = [word[i:i + size] for i in range(0, len(word), size)]
+    for part, part_tokens in zip(parts, count_tokens(parts)):
+        yield from _split_word(part, part_tokens, max_tokens, count_tokens)
+
+
 def get_commit_hashes(repo_id):
+    from huggingface_hub import HfApi
+
     refs = HfApi().list_repo_refs(repo_id)
     return [branch.target_commit for branch in refs.branches]
 